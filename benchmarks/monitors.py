@@ -0,0 +1,175 @@
+"""
+Throughput and latency benchmark of the monitors. Local stand-ins of an HTTP
+server (also standing for the Cachet API), a TeamSpeak 3 server and an Arma 3
+server are started on the loopback interface, with injected latency and packet
+loss, and the monitors are run against them from a pool of threads. The
+arma3-full monitor queries the players and rules of the Arma 3 server too. Each
+monitor is benchmarked for a number of executions and the throughput along
+with the p50, p95 and p99 execution times are reported. No network access is
+required.
+"""
+
+import argparse
+import concurrent.futures
+import os
+import sys
+import tempfile
+import time
+
+from monitoring_scripts import arma3_monitor
+from monitoring_scripts import check_runner
+from monitoring_scripts import http_monitor
+from monitoring_scripts import nagios_common as nagios
+from monitoring_scripts import ts3_monitor
+
+from servers import A2SStandIn, HTTPStandIn, TS3StandIn
+
+MONITORS = ('http', 'ts3', 'arma3', 'arma3-full', 'runner')
+
+parser = argparse.ArgumentParser(
+    description=__doc__,
+    formatter_class=argparse.RawDescriptionHelpFormatter
+)
+parser.add_argument(
+    'monitor',
+    help='monitors to benchmark among %s, all by default' % ', '.join(MONITORS),
+    nargs='*'
+)
+parser.add_argument(
+    '--executions',
+    help='number of executions of each monitor',
+    type=int,
+    default=200
+)
+parser.add_argument(
+    '--concurrency',
+    help='number of executions running at the same time',
+    type=int,
+    default=8
+)
+parser.add_argument(
+    '--latency',
+    help='time (in seconds) taken by the stand-in servers to answer',
+    type=float,
+    default=0.0
+)
+parser.add_argument(
+    '--loss',
+    help='fraction (between 0 and 1) of requests dropped by the stand-in servers',
+    type=float,
+    default=0.0
+)
+parser.add_argument(
+    '--timeout',
+    help='timeout (in seconds) of every monitor execution',
+    type=float,
+    default=1.0
+)
+
+CONFIG_TEMPLATE = """[Cachet]
+base-url: %s/api/v1
+api-key: benchmark
+"""
+
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of a sorted list"""
+
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+
+def execute(function):
+    """Run a monitor, return its status name (ERROR if it raised an exception) and its duration
+    in seconds"""
+
+    start = time.perf_counter()
+    try:
+        with nagios.captured_output():
+            function()
+    except SystemExit as plugin_exit:
+        return nagios.Codes(plugin_exit.code).name, time.perf_counter() - start
+    except Exception:  # pylint: disable=W0703
+        return 'ERROR', time.perf_counter() - start
+    return nagios.Codes.OK.name, time.perf_counter() - start
+
+
+def benchmark(function, executions, concurrency):
+    """Execute `function` (a callable without arguments) concurrently and return the wall-clock
+    time, the sorted list of execution durations and the count of every status"""
+
+    start = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(lambda _: execute(function), range(executions)))
+    wall = time.perf_counter() - start
+    statuses = {}
+    for status, _ in results:
+        statuses[status] = statuses.get(status, 0) + 1
+    return wall, sorted(duration for _, duration in results), statuses
+
+
+def started(*stand_ins):
+    """Start stand-ins and return them as a list"""
+
+    for stand_in in stand_ins:
+        stand_in.start()
+    return list(stand_ins)
+
+
+def monitors(names, latency, loss, timeout, directory):
+    """Generate (name, function, stand-ins) tuples for the monitors, the stand-ins of each one
+    being started as it is generated"""
+
+    for name in names:
+        if name == 'http':
+            server, = stand_ins = started(HTTPStandIn(latency, loss))
+            yield name, lambda server=server: http_monitor.main(
+                server.url + '/', timeout=timeout), stand_ins
+        elif name == 'ts3':
+            server, = stand_ins = started(TS3StandIn(latency, loss))
+            yield name, lambda server=server: ts3_monitor.main(
+                *server.address, timeout=timeout), stand_ins
+        elif name == 'arma3':
+            server, = stand_ins = started(A2SStandIn(latency, loss))
+            yield name, lambda server=server: arma3_monitor.main(
+                *server.address, timeout=timeout), stand_ins
+        elif name == 'arma3-full':
+            server, = stand_ins = started(A2SStandIn(latency, loss))
+            yield name, lambda server=server: arma3_monitor.main(
+                *server.address, timeout=timeout, players=True, rules=True), stand_ins
+        elif name == 'runner':
+            # Loss is not injected into Cachet updates, which the runner does not retry
+            server, cachet = stand_ins = started(TS3StandIn(latency, loss), HTTPStandIn(latency))
+            # Written once before the concurrent executions, which only read it
+            config_file = os.path.join(directory, 'config.ini')
+            with open(config_file, 'w') as config:
+                config.write(CONFIG_TEMPLATE % cachet.url)
+            yield name, lambda server=server: check_runner.main(
+                'cnto-ts3-monitor', 1, config_file, retries=0, deadline=timeout,
+                script_args=['%s:%d' % server.address]), stand_ins
+
+
+def main(monitor, executions, concurrency, latency, loss, timeout):
+    """Benchmark execution"""
+
+    print('%-10s %10s %12s %10s %10s %10s  %s' % ('monitor', 'executions', 'throughput', 'p50',
+                                                  'p95', 'p99', 'statuses'))
+    with tempfile.TemporaryDirectory() as directory:
+        for name, function, stand_ins in monitors(monitor or MONITORS, latency, loss, timeout,
+                                                  directory):
+            try:
+                wall, durations, statuses = benchmark(function, executions, concurrency)
+            finally:
+                for stand_in in stand_ins:
+                    stand_in.stop()
+            print('%-10s %10d %10.1f/s %8.1fms %8.1fms %8.1fms  %s' % (
+                name, executions, executions / wall, percentile(durations, 0.5) * 1000,
+                percentile(durations, 0.95) * 1000, percentile(durations, 0.99) * 1000,
+                ', '.join('%s %d' % item for item in sorted(statuses.items()))))
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    unknown = set(args.monitor) - set(MONITORS)
+    if unknown:
+        parser.error('unknown monitors: ' + ', '.join(sorted(unknown)))
+    sys.exit(main(**args.__dict__))
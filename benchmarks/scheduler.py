@@ -0,0 +1,145 @@
+"""
+Scheduling benchmark of `cnto-check-daemon`. A large number of checks sharing
+the same interval are scheduled by the daemon, each execution only sleeping for
+--execution-time seconds, so that the scheduler and its workers are measured
+without the cost of the plugins. Every second the number of started checks
+and the CPU time used by the process are sampled, and the scheduling lag
+(delay between the due time of a check and its start on a worker) is reported
+from the daemon histogram: it grows once the workers cannot keep up with the
+checks. With phase spreading the starts and CPU usage are steady, with
+--no-spread every check is due at once on every interval.
+"""
+
+import argparse
+import statistics
+import sys
+import threading
+import time
+
+from monitoring_scripts import daemon
+from monitoring_scripts import metrics
+from monitoring_scripts.retry import RetryPolicy
+from monitoring_scripts.settings import Check
+
+parser = argparse.ArgumentParser(
+    description=__doc__,
+    formatter_class=argparse.RawDescriptionHelpFormatter
+)
+parser.add_argument(
+    '--checks',
+    help='number of scheduled checks',
+    type=int,
+    default=10000
+)
+parser.add_argument(
+    '--interval',
+    help='interval (in seconds) of every check',
+    type=float,
+    default=60.0
+)
+parser.add_argument(
+    '--duration',
+    help='time (in seconds) the scheduler is run, at least one interval for the steady state',
+    type=float,
+    default=120.0
+)
+parser.add_argument(
+    '--workers',
+    help='number of workers of the daemon',
+    type=int,
+    default=daemon.DEFAULT_WORKERS
+)
+parser.add_argument(
+    '--execution-time',
+    help='time (in seconds) every check execution sleeps, standing for the plugin',
+    type=float,
+    default=0.01
+)
+parser.add_argument(
+    '--no-spread',
+    help='run every check right away instead of spreading them within their interval',
+    dest='spread',
+    action='store_false'
+)
+
+
+class BenchmarkDaemon(daemon.CheckDaemon):
+    """Daemon whose checks count their executions and sleep for `execution_time` seconds"""
+
+    def __init__(self, *args, execution_time=0.0, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.execution_time = execution_time
+        self.started = 0
+        self._lock = threading.Lock()
+
+    def run_check(self, check):
+        with self._lock:
+            self.started += 1
+        time.sleep(self.execution_time)
+
+
+def sample(scheduler, duration):
+    """Return the number of checks started and the CPU time used (in seconds) during every second
+    of `duration`"""
+
+    starts, cpu_times = [], []
+    started, cpu_time = scheduler.started, time.process_time()
+    deadline = time.monotonic() + 1
+    for _ in range(int(duration)):
+        time.sleep(max(deadline - time.monotonic(), 0))
+        deadline += 1
+        starts.append(scheduler.started - started)
+        cpu_times.append(time.process_time() - cpu_time)
+        started, cpu_time = scheduler.started, time.process_time()
+    return starts, cpu_times
+
+
+def lag_distribution():
+    """Return the scheduling lag histogram as a list of (upper bound, cumulative fraction)"""
+
+    buckets = metrics.SCHEDULER_LAG.labels()
+    total = sum(buckets.counts) or 1
+    cumulative, distribution = 0, []
+    for bound, count in zip(metrics.SCHEDULER_LAG.buckets + (float('inf'),), buckets.counts):
+        cumulative += count
+        distribution.append((bound, cumulative / total))
+    return distribution
+
+
+def main(checks, interval, duration, workers, execution_time,  # pylint: disable=R0913
+         spread):
+    """Benchmark execution"""
+
+    scheduler = BenchmarkDaemon(
+        [Check(name='check-%05d' % index, script='cnto-ts3-monitor', args=[], component_id=index,
+               interval=interval, retry_policy=RetryPolicy(retries=0), pass_timeout=False)
+         for index in range(checks)],
+        components=None, workers=workers, spread=spread, execution_time=execution_time
+    )
+    thread = threading.Thread(target=scheduler.run)
+    thread.start()
+    try:
+        starts, cpu_times = sample(scheduler, duration)
+    finally:
+        scheduler.stop()
+        thread.join()
+
+    print('%d checks every %.0fs (%.0f checks per minute), phase spreading %s' % (
+        checks, interval, checks * 60 / interval, 'on' if spread else 'off'))
+    print('%-22s %10s %10s %10s %10s' % ('per second', 'min', 'mean', 'max', 'stdev'))
+    print('%-22s %10d %10.1f %10d %10.1f' % ('started checks', min(starts),
+                                             statistics.mean(starts), max(starts),
+                                             statistics.pstdev(starts)))
+    cpu_percents = [cpu_time * 100 for cpu_time in cpu_times]
+    print('%-22s %9.1f%% %9.1f%% %9.1f%% %10.1f' % (
+        'CPU usage', min(cpu_percents), statistics.mean(cpu_percents), max(cpu_percents),
+        statistics.pstdev(cpu_percents)))
+    print('scheduling lag:')
+    for bound, fraction in lag_distribution():
+        print('  <= %-8s %6.2f%%' % ('%gs' % bound, fraction * 100))
+        if fraction >= 1:
+            break
+
+
+if __name__ == '__main__':
+    sys.exit(main(**parser.parse_args().__dict__))
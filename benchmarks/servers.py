@@ -0,0 +1,203 @@
+"""Local stand-ins of the monitored services, answering on the loopback interface after an
+injected latency and dropping a fraction of the requests to simulate packet loss"""
+
+import http.server
+import random
+import socket
+import socketserver
+import struct
+import threading
+import time
+
+from monitoring_scripts import ts3_monitor
+
+A2S_HEADER = b'\xff\xff\xff\xff'
+A2S_INFO_REQUEST = A2S_HEADER + b'TSource Engine Query\x00'
+
+
+class StandIn():
+    """Base of the stand-in servers: requests are answered after `latency` seconds, a fraction
+    `loss` (between 0 and 1) of them is dropped. Use as a context manager to run the server on a
+    background thread, `address` is the (host, port) it listens on."""
+
+    def __init__(self, latency=0.0, loss=0.0):
+        self.latency = latency
+        self.loss = loss
+        self.requests = 0
+        self.address = None
+
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def drop(self):
+        """Count a request and tell if it must be dropped, waiting for the latency otherwise"""
+
+        with self._lock:
+            self.requests += 1
+        if random.random() < self.loss:
+            return True
+        if self.latency:
+            time.sleep(self.latency)
+        return False
+
+    def start(self):
+        """Start serving on a background thread"""
+
+        raise NotImplementedError
+
+    def stop(self):
+        """Stop serving"""
+
+        raise NotImplementedError
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *_):
+        self.stop()
+
+
+class _ThreadingHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+
+class HTTPStandIn(StandIn):
+    """HTTP server answering 200 with an empty JSON document to any HEAD, GET or PUT request, so
+    that it stands for both a monitored website and the Cachet API. A dropped request has its
+    connection closed without response."""
+
+    def start(self):
+        stand_in = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            """Request handler of the stand-in"""
+
+            protocol_version = 'HTTP/1.1'
+
+            def respond(self, body=True):
+                """Answer the request, or close the connection if dropped"""
+
+                length = int(self.headers.get('Content-Length') or 0)
+                if length:
+                    self.rfile.read(length)
+                if stand_in.drop():
+                    self.close_connection = True
+                    return
+                payload = b'{"data": {}}'
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                if body:
+                    self.wfile.write(payload)
+
+            def do_HEAD(self):  # pylint: disable=C0103
+                """Answer HEAD requests"""
+
+                self.respond(body=False)
+
+            do_GET = do_PUT = respond
+
+            def log_message(self, *_):  # pylint: disable=W0221
+                pass
+
+        self._server = _ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.address = self._server.server_address
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+
+    @property
+    def url(self):
+        """Base URL of the stand-in"""
+
+        return 'http://%s:%d' % self.address
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+
+class UDPStandIn(StandIn):
+    """UDP server answering datagrams with `answer(datagram)`, ignoring them if it returns None.
+    Each answer is sent from its own thread, so that latency does not delay other requests."""
+
+    def start(self):
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._socket.bind(('127.0.0.1', 0))
+        self._socket.settimeout(0.1)
+        self.address = self._socket.getsockname()
+        self._running = True
+        self._thread = threading.Thread(target=self._serve, daemon=True)
+        self._thread.start()
+
+    def _serve(self):
+        while self._running:
+            try:
+                datagram, client = self._socket.recvfrom(2048)
+            except socket.timeout:
+                continue
+            threading.Thread(target=self._reply, args=(datagram, client), daemon=True).start()
+
+    def _reply(self, datagram, client):
+        if self.drop():
+            return
+        response = self.answer(datagram)
+        if response is not None:
+            self._socket.sendto(response, client)
+
+    def answer(self, datagram):
+        """Return the response to a datagram, None for no response"""
+
+        raise NotImplementedError
+
+    def stop(self):
+        self._running = False
+        self._thread.join()
+        self._socket.close()
+
+
+class TS3StandIn(UDPStandIn):
+    """TeamSpeak 3 server answering the connection handshake of `ts3_monitor`"""
+
+    HANDSHAKE = bytes.fromhex(ts3_monitor.CONNECTION_DGRAM)
+
+    def answer(self, datagram):
+        random_bytes = ts3_monitor.HANDSHAKE_RANDOM
+        if len(datagram) != len(self.HANDSHAKE) or \
+                datagram[:random_bytes.start] != self.HANDSHAKE[:random_bytes.start]:
+            return None
+        # Header, step 1 and server cookie followed by the client random bytes reversed
+        return ts3_monitor.VALID_CONNECTION_MARKER + bytes(25) + datagram[random_bytes][::-1]
+
+
+class A2SStandIn(UDPStandIn):
+    """Source engine server answering A2S_INFO queries, and A2S_PLAYER and A2S_RULES queries
+    carrying its challenge number, sent instead of the response to any other challenge"""
+
+    CHALLENGE = 0x1234
+
+    def __init__(self, latency=0.0, loss=0.0, players=12, max_players=64):
+        super().__init__(latency, loss)
+        self.players = players
+        self.max_players = max_players
+
+    def answer(self, datagram):
+        if datagram[:4] == A2S_HEADER and datagram[4:5] in (b'U', b'V') and len(datagram) == 9:
+            if struct.unpack('<l', datagram[5:])[0] != self.CHALLENGE:
+                return A2S_HEADER + b'A' + struct.pack('<l', self.CHALLENGE)
+            if datagram[4:5] == b'V':
+                return A2S_HEADER + b'E' + struct.pack('<h', 1) + b'mission\x00Stand-in\x00'
+            return A2S_HEADER + b'D' + bytes([self.players]) + b''.join(
+                bytes([index]) + b'Player%d\x00' % index + struct.pack('<lf', 0, 60.0)
+                for index in range(self.players))
+        if datagram != A2S_INFO_REQUEST:
+            return None
+        return b''.join([
+            A2S_HEADER, b'I', bytes([17]),
+            b'Stand-in\x00', b'Altis\x00', b'Arma3\x00', b'Arma 3\x00',
+            struct.pack('<hBBB', 0, self.players, self.max_players, 0),
+            b'd', b'l', bytes([0, 0]), b'1.0\x00',
+        ])
@@ -0,0 +1,166 @@
+"""
+Startup benchmark of the `cnto-monitor` commands forked by Nagios. Every
+command is run in a new interpreter against local stand-ins of the monitored
+services (and of the Cachet API for the runner), so that the measure includes
+everything a plugin pays before its result: interpreter start, imports, the
+dependencies imported once the arguments are validated, and a single check
+answered without latency. The daemon is long-lived and not benchmarked. Runs
+are repeated and the median is reported, both cold (bytecode compiled from
+scratch in an empty cache) and warm (bytecode cache primed). Import times come
+from `-X importtime`, requiring Python 3.7 or later. No network access is
+required.
+"""
+
+import argparse
+import os
+import re
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from servers import A2SStandIn, HTTPStandIn, TS3StandIn
+
+IMPORT_TIME_LINE = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \|(\s+)(\S+)$')
+
+COMMANDS = ('http', 'ts3', 'arma3', 'runner')
+
+CONFIG_TEMPLATE = """[Cachet]
+base-url: %s/api/v1
+api-key: benchmark
+"""
+
+parser = argparse.ArgumentParser(
+    description=__doc__,
+    formatter_class=argparse.RawDescriptionHelpFormatter
+)
+parser.add_argument(
+    'command',
+    help='commands to benchmark among %s, all by default' % ', '.join(COMMANDS),
+    nargs='*'
+)
+parser.add_argument(
+    '--repeat',
+    help='number of runs of each command',
+    type=int,
+    default=10
+)
+parser.add_argument(
+    '--top',
+    help='number of slowest imports listed for each command',
+    type=int,
+    default=5
+)
+parser.add_argument(
+    '--max-warm',
+    help='exit with status 1 if the warm median wall-clock time (in milliseconds) of a command '
+         'exceeds this value',
+    type=float,
+    default=None
+)
+
+
+def invocations(web, ts3, arma3, config_file):
+    """Return the arguments of a single check of every command against the stand-ins"""
+
+    return {
+        'http': [web.url + '/', '--timeout', '1'],
+        'ts3': ['%s:%d' % ts3.address, '--timeout', '1'],
+        'arma3': [arma3.address[0], str(arma3.address[1]), '--timeout', '1'],
+        'runner': ['cnto-ts3-monitor', '1', config_file, '--retries', '0',
+                   '--script-args', '%s:%d' % ts3.address],
+    }
+
+
+def run_command(arguments, cache_prefix):
+    """Run a command with `arguments` in a new interpreter, return its wall-clock time in
+    seconds and its import times as a {module: (self, cumulative)} dict in microseconds"""
+
+    environment = dict(os.environ, PYTHONPYCACHEPREFIX=cache_prefix)
+    start = time.perf_counter()
+    process = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-m', 'monitoring_scripts.cli'] + arguments,
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=environment,
+        universal_newlines=True
+    )
+    elapsed = time.perf_counter() - start
+    # The stand-ins answer every check, anything but OK means the command did not run as timed
+    if process.returncode != 0:
+        raise RuntimeError('%s exited with status %d: %s' % (
+            ' '.join(arguments), process.returncode,
+            process.stdout.strip() or process.stderr.strip().splitlines()[-1]))
+
+    imports = {}
+    for line in process.stderr.splitlines():
+        match = IMPORT_TIME_LINE.match(line)
+        if match:
+            imports[match.group(4)] = (int(match.group(1)), int(match.group(2)))
+    return elapsed, imports
+
+
+def benchmark(arguments, repeat):
+    """Return the cold and warm runs of a command as two lists of `run_command` results"""
+
+    cold = []
+    for _ in range(repeat):
+        with tempfile.TemporaryDirectory() as cache_prefix:
+            cold.append(run_command(arguments, cache_prefix))
+    with tempfile.TemporaryDirectory() as cache_prefix:
+        run_command(arguments, cache_prefix)
+        warm = [run_command(arguments, cache_prefix) for _ in range(repeat)]
+    return cold, warm
+
+
+def summary(runs):
+    """Median wall-clock time (in milliseconds), median total import time (in milliseconds) and
+    median self time of every imported module (in microseconds) of a list of runs"""
+
+    wall = statistics.median(elapsed for elapsed, _ in runs) * 1000
+    imports = statistics.median(sum(self_time for self_time, _ in run.values())
+                                for _, run in runs) / 1000
+    modules = {}
+    for _, run in runs:
+        for module, (self_time, _) in run.items():
+            modules.setdefault(module, []).append(self_time)
+    return wall, imports, {module: statistics.median(times) for module, times in modules.items()}
+
+
+def main(command, repeat, top, max_warm):
+    """Benchmark execution, return the exit status"""
+
+    status = 0
+    print('%-8s %12s %12s %12s %12s' % ('command', 'cold wall', 'cold import', 'warm wall',
+                                        'warm import'))
+    stand_ins = web, ts3, arma3 = HTTPStandIn(), TS3StandIn(), A2SStandIn()
+    with tempfile.TemporaryDirectory() as directory:
+        config_file = os.path.join(directory, 'config.ini')
+        for stand_in in stand_ins:
+            stand_in.start()
+        try:
+            with open(config_file, 'w') as config:
+                config.write(CONFIG_TEMPLATE % web.url)
+            arguments = invocations(web, ts3, arma3, config_file)
+            for name in command or COMMANDS:
+                cold, warm = benchmark([name] + arguments[name], repeat)
+                cold_wall, cold_imports, _ = summary(cold)
+                warm_wall, warm_imports, modules = summary(warm)
+                print('%-8s %10.1fms %10.1fms %10.1fms %10.1fms' % (
+                    name, cold_wall, cold_imports, warm_wall, warm_imports))
+                for module in sorted(modules, key=modules.get, reverse=True)[:top]:
+                    print('%8s %-40s %8dus' % ('', module, modules[module]))
+                if max_warm is not None and warm_wall > max_warm:
+                    print('%s: warm start %.1fms exceeds %.1fms' % (name, warm_wall, max_warm))
+                    status = 1
+        finally:
+            for stand_in in stand_ins:
+                stand_in.stop()
+    return status
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    unknown = set(args.command) - set(COMMANDS)
+    if unknown:
+        parser.error('unknown commands: ' + ', '.join(sorted(unknown)))
+    sys.exit(main(**args.__dict__))
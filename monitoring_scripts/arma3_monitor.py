@@ -3,16 +3,23 @@ Nagios-compatible plugin to check an Arma3 Server availability using A2S
 server queries. If the server responds a OK status is triggered, if the
 response exceeds the timeout a CRITICAL status is triggered, if either one
 of the provided hostname/address and port is invalid a UNKNOWN status is
-triggered.
+triggered. When a list of servers is given with --targets they are queried
+concurrently and the worst status is returned, followed by one result line
+per server. With --players and --rules the players list and server rules are
+queried too, on the same socket, reusing the challenge numbers of previous
+queries of the server.
 """
 
 import argparse
+import concurrent.futures
 import logging
+import threading
+import time
 from socket import gaierror
 
-import valve.source.a2s
-
 from . import nagios_common as nagios
+from . import net
+from . import persist
 
 parser = argparse.ArgumentParser(
     prog='cnto-arma3-monitor',
@@ -21,64 +28,395 @@ parser = argparse.ArgumentParser(
 )
 parser.add_argument(
     'host',
+    nargs='?',
     help='Arma3 Server hostname in Internet domain notation or IPv4 address'
 )
 parser.add_argument(
     'port',
+    nargs='?',
     type=int,
     help='port for the Steam server API service'
 )
 parser.add_argument(
-    '--timeout',
+    '--targets',
+    nargs='+',
+    default=[],
+    metavar='HOST:PORT',
+    help='servers to query concurrently, in addition to host and port if given'
+)
+parser.add_argument(
+    '--workers',
     type=int,
     default=10,
+    help='maximum number of servers queried at the same time'
+)
+parser.add_argument(
+    '--timeout',
+    type=float,
+    default=10,
     help='maximum time (in seconds) to wait for server response'
 )
+parser.add_argument(
+    '--warning-latency',
+    type=float,
+    default=None,
+    help='response time (in seconds) above which a WARNING status is triggered'
+)
+parser.add_argument(
+    '--critical-latency',
+    type=float,
+    default=None,
+    help='response time (in seconds) above which a CRITICAL status is triggered'
+)
 parser.add_argument(
     '--debug',
     action='store_true',
     default=False,
     help='display debug messages, DO NOT enable in actual Nagios use'
 )
+parser.add_argument(
+    '--players',
+    action='store_true',
+    default=False,
+    help='query the players list too, reported as perfdata'
+)
+parser.add_argument(
+    '--rules',
+    action='store_true',
+    default=False,
+    help='query the server rules too, reported as perfdata'
+)
+parser.add_argument(
+    '--challenge-cache',
+    default=None,
+    metavar='FILE',
+    help='JSON file persisting the challenge numbers of the servers across executions'
+)
+net.add_resolver_arguments(parser)
 
+# A2S response type of a challenge number, sent instead of the players or rules
+CHALLENGE_RESPONSE = 0x41
+# Bounds (in seconds) of the pause of the players and rules queries of a rate limiting server
+MIN_BACKOFF = 30
+MAX_BACKOFF = 600
 
-def main(host, port, timeout=5, debug=False):
-    """Actual monitoring execution"""
+logger = logging.getLogger(__name__)
 
-    logging.basicConfig(level=logging.WARNING)
-    logger = logging.getLogger(__name__)
+_challenges_lock = threading.Lock()
+_challenges = None
+
+
+class RateLimited(Exception):
+    """The server did not answer a challenged query or kept sending new challenge numbers"""
+
+
+class ChallengeCache():
+    """Challenge numbers of the servers, keyed by address, reused by the players and rules
+    queries so that they do not pay the challenge round trip again, along with the back off of
+    the servers which rate limit them. With a `path` the cache is persisted as a JSON file,
+    shared by the plugin executions of every process."""
+
+    def __init__(self, path=None):
+        self.path = path
+        self.entries = {}
+
+        self._dirty = set()
+        self._lock = threading.Lock()
+
+    def load(self):
+        """Merge the challenge numbers and back offs of the cache file, return False if it could
+        not be loaded"""
+
+        entries = persist.load_json(self.path, 'challenge cache')
+        if entries is None:
+            return False
+        with self._lock:
+            self.entries.update(entries)
+        return True
+
+    def save(self):
+        """Write the entries changed since the last save, if persisted, merged with the entries
+        currently on disk"""
+
+        with self._lock:
+            if not self.path or not self._dirty:
+                return
+            entries = persist.load_json(self.path) or {}
+            entries.update((key, self.entries[key]) for key in self._dirty)
+            persist.save_json(self.path, entries)
+            self._dirty.clear()
+
+    def _update(self, key, **values):
+        with self._lock:
+            self.entries.setdefault(key, {}).update(values)
+            self._dirty.add(key)
+
+    def challenge(self, key):
+        """Return the last challenge number of a server, -1 (asking for one) if unknown"""
+
+        with self._lock:
+            return self.entries.get(key, {}).get('challenge', -1)
+
+    def store(self, key, challenge):
+        """Remember the challenge number sent by a server"""
+
+        self._update(key, challenge=challenge)
+
+    def backing_off(self, key, now=None):
+        """Return the remaining time (in seconds) the server must not be queried for its players
+        and rules, 0 if it can be"""
+
+        now = time.time() if now is None else now
+        with self._lock:
+            entry = self.entries.get(key, {})
+        return max(entry.get('until', 0) - now, 0)
+
+    def back_off(self, key, now=None):
+        """Pause the challenged queries of a rate limiting server, twice as long as the previous
+        pause within MIN_BACKOFF and MAX_BACKOFF, and forget its challenge number. Return the
+        pause duration in seconds."""
+
+        now = time.time() if now is None else now
+        with self._lock:
+            backoff = self.entries.get(key, {}).get('backoff', 0)
+        backoff = min(max(backoff * 2, MIN_BACKOFF), MAX_BACKOFF)
+        self._update(key, challenge=-1, backoff=backoff, until=now + backoff)
+        return backoff
+
+    def reset_back_off(self, key):
+        """Forget the back off of a server which answered its challenged queries"""
+
+        with self._lock:
+            if not self.entries.get(key, {}).get('backoff'):
+                return
+        self._update(key, backoff=0, until=0)
 
-    if debug:  # pragma: no cover
-        logger.setLevel(logging.DEBUG)
-        logger.info('debug logging enabled')
 
-    server_addr = (host, port)
+def configure_challenges(path=None):
+    """Return the `ChallengeCache` of the queries, kept across calls with the same `path` so that
+    plugins executed in-process share it"""
+
+    global _challenges  # pylint: disable=W0603
+    with _challenges_lock:
+        if _challenges is None or _challenges.path != path:
+            _challenges = ChallengeCache(path)
+            if path:
+                _challenges.load()
+        return _challenges
+
+
+def _receive(server):
+    """Return the payload of the next response of `server`, reassembling split responses, which
+    python-valve 0.2.1 fails to do and rules responses of modded servers usually are"""
+
+    import valve.source
+    from valve.source import messages
+
+    response = messages.Header.decode(valve.source.BaseQuerier.get_response(server))
+    if response['split'] != messages.SPLIT:
+        return response.payload
+    fragments = {}
+    while True:
+        fragment = messages.Fragment.decode(response.payload)
+        fragments[fragment['fragment_id']] = fragment.payload
+        if len(fragments) >= fragment['fragment_count']:
+            return b''.join(fragments[index] for index in sorted(fragments))
+        response = messages.Header.decode(valve.source.BaseQuerier.get_response(server))
+
+
+def _challenged_query(server, key, challenges, request, response):
+    """Send a players or rules `request` with the cached challenge number of the server and
+    decode its `response`. A new challenge number is requested only when the server rejects the
+    cached one, RateLimited is raised if it rejects the new one too or does not answer."""
+
+    import valve.source
+    from valve.source import messages
+
+    challenge = challenges.challenge(key)
+    for _ in range(2):
+        server.request(request(challenge=challenge))
+        try:
+            payload = _receive(server)
+        except valve.source.NoResponseError:
+            raise RateLimited('no response to %s' % request.__name__)
+        if payload[:1] != bytes([CHALLENGE_RESPONSE]):
+            return response.decode(payload)
+        challenge = messages.GetChallengeResponse.decode(payload)['challenge']
+        logger.debug('new challenge number %d from %s', challenge, key)
+        challenges.store(key, challenge)
+    raise RateLimited('challenge number rejected by %s' % key)
+
+
+def _query_details(server, key, challenges, players, rules):
+    """Query the players and rules of a server which answered its info query, return their
+    perfdata along with a note for the status message, empty unless the queries are paused
+    because the server rate limits them"""
+
+    from valve.source import messages
+
+    remaining = challenges.backing_off(key)
+    if remaining:
+        logger.info('players and rules queries of %s paused for %.0fs', key, remaining)
+        return [], ', players and rules queries paused for %.0fs' % remaining
+
+    perfdata = []
+    try:
+        if players:
+            sent = time.perf_counter()
+            response = _challenged_query(server, key, challenges, messages.PlayersRequest,
+                                         messages.PlayersResponse)
+            perfdata.extend([
+                nagios.PerfData('players_rtt', time.perf_counter() - sent, 's', minimum=0),
+                nagios.PerfData('players_listed', sum(
+                    1 for player in response['players'] if player['name']), minimum=0),
+            ])
+        if rules:
+            sent = time.perf_counter()
+            response = _challenged_query(server, key, challenges, messages.RulesRequest,
+                                         messages.RulesResponse)
+            perfdata.extend([
+                nagios.PerfData('rules_rtt', time.perf_counter() - sent, 's', minimum=0),
+                nagios.PerfData('rules', response['rule_count'], minimum=0),
+            ])
+    except RateLimited as error:
+        logger.warning('%s, backing off', error)
+        return perfdata, ', players and rules queries paused for %ds' % challenges.back_off(key)
+    except messages.BrokenMessageError as error:
+        logger.info('invalid players or rules response: %s', error)
+        return perfdata, ', invalid players or rules response'
+    challenges.reset_back_off(key)
+    return perfdata, ''
+
+
+def query_server(host, port, timeout=10, thresholds=None,  # pylint: disable=R0913,R0914
+                 players=False, rules=False, challenges=None):
+    """Query a single server and return its status as a (nagios.Codes, message, perfdata) tuple,
+    perfdata reports DNS resolution, query round trip and total time along with players count.
+    The round trip time is checked against `thresholds`, a nagios.Thresholds, if provided.
+
+    If `players` or `rules` is set the players list or the server rules are queried too, over
+    the same socket, with the challenge numbers kept in `challenges`, a ChallengeCache (the
+    in-process one by default). Failures of these queries do not change the status."""
+
+    thresholds = thresholds or nagios.Thresholds()
+    start = time.perf_counter()
+
+    try:
+        server_addr, dns_time = net.resolve(host, port)
+    except gaierror:
+        logger.info('invalid hostname or port')
+        return nagios.Codes.UNKNOWN, 'invalid hostname/address or port', []
+    perfdata = [nagios.PerfData('dns', dns_time, 's', minimum=0)]
+    import valve.source.a2s
+    from valve.source import messages
     server = valve.source.a2s.ServerQuerier(server_addr, timeout=timeout)
 
     try:
-        logger.info('trying to query the server')
-        if server.info():
+        logger.info('trying to query the server %s:%d', host, port)
+        sent = time.perf_counter()
+        info = server.info()
+        received = time.perf_counter()
+        if info:
             logger.info('query successful, server good')
-            nagios.plugin_exit(nagios.Codes.OK, 'connection successful')
-        else:
-            logger.info('invalid response')
-            nagios.plugin_exit(nagios.Codes.CRITICAL, 'invalid response')
+            details, note = [], ''
+            if players or rules:
+                challenges = challenges or configure_challenges()
+                details, note = _query_details(server, '%s:%d' % server_addr[:2], challenges,
+                                               players, rules)
+                challenges.save()
+            perfdata.extend([
+                thresholds.perfdata('rtt', received - sent),
+                nagios.PerfData('total', received - start, 's', minimum=0),
+                nagios.PerfData('players', info['player_count'], minimum=0,
+                                maximum=info['max_players']),
+                nagios.PerfData('max_players', info['max_players'], minimum=0),
+            ] + details)
+            return thresholds.check(nagios.Codes.OK, 'connection successful' + note,
+                                    received - sent) + (perfdata,)
+        logger.info('invalid response')
+        return nagios.Codes.CRITICAL, 'invalid response', perfdata
     except gaierror:
         logger.info('invalid hostname or port')
-        nagios.plugin_exit(nagios.Codes.UNKNOWN, 'invalid hostname/address or '
-                                                 'port')
+        return nagios.Codes.UNKNOWN, 'invalid hostname/address or port', perfdata
     except valve.source.NoResponseError:
         logger.info('no response received from server')
-        nagios.plugin_exit(nagios.Codes.CRITICAL, 'no response received from '
-                                                  'server')
+        return nagios.Codes.CRITICAL, 'no response received from server', perfdata
+    except (messages.BrokenMessageError, OSError, ValueError) as error:
+        logger.info('invalid response: %s', error)
+        return nagios.Codes.CRITICAL, 'invalid response', perfdata
+    finally:
+        server.close()
+
 
+def query_servers(targets, timeout=10, workers=10,  # pylint: disable=R0913
+                  thresholds=None, players=False, rules=False, challenges=None):
+    """Query many (host, port) targets concurrently, at most `workers` at a time, each one with
+    its own `timeout`. Returns a list of (target, nagios.Codes, message, perfdata) tuples in the
+    same order as `targets`."""
 
-def arma3_entry_point():  # pragma: no cover
-    """Console entry point"""
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(query_server, host, port, timeout, thresholds, players, rules,
+                                   challenges)
+                   for host, port in targets]
+        return [(target,) + future.result() for target, future in zip(targets, futures)]
 
-    args = parser.parse_args()
 
-    main(**args.__dict__)
+def main(host, port, timeout=5,  # pylint: disable=R0913
+         warning_latency=None, critical_latency=None, players=False, rules=False,
+         challenge_cache=None, debug=False):
+    """Actual monitoring execution"""
+
+    logging.basicConfig(level=logging.WARNING)
+
+    if debug:  # pragma: no cover
+        logger.setLevel(logging.DEBUG)
+        logger.info('debug logging enabled')
+
+    thresholds = nagios.Thresholds(warning_latency, critical_latency)
+    nagios.plugin_exit(*query_server(host, port, timeout, thresholds, players, rules,
+                                     configure_challenges(challenge_cache)))
+
+
+def fleet_main(targets, timeout=5, workers=10,  # pylint: disable=R0913
+               warning_latency=None, critical_latency=None, players=False, rules=False,
+               challenge_cache=None, debug=False):
+    """Multi-server monitoring execution, the worst status among all servers is returned"""
+
+    logging.basicConfig(level=logging.WARNING)
+
+    if debug:  # pragma: no cover
+        logger.setLevel(logging.DEBUG)
+        logger.info('debug logging enabled')
+
+    results = query_servers(targets, timeout, workers,
+                            nagios.Thresholds(warning_latency, critical_latency), players, rules,
+                            configure_challenges(challenge_cache))
+    nagios.aggregate_exit([('%s:%d' % result[0],) + result[1:] for result in results], 'servers')
+
+
+def arma3_entry_point(argv=None):  # pragma: no cover
+    """Console entry point, `argv` defaults to the command line arguments"""
+
+    args = parser.parse_args(argv)
+    net.configure_resolver(args.dns_ttl, args.dns_serve_stale, args.dns_cache)
+
+    if not args.targets:
+        if args.host is None or args.port is None:
+            parser.error('either host and port or --targets are required')
+        main(args.host, args.port, timeout=args.timeout, warning_latency=args.warning_latency,
+             critical_latency=args.critical_latency, players=args.players, rules=args.rules,
+             challenge_cache=args.challenge_cache, debug=args.debug)
+
+    try:
+        targets = [net.parse_target(target, None) for target in args.targets]
+    except ValueError:
+        parser.error('targets must be given as HOST:PORT')
+    if args.host is not None and args.port is not None:
+        targets.insert(0, (args.host, args.port))
+    fleet_main(targets, timeout=args.timeout, workers=args.workers,
+               warning_latency=args.warning_latency, critical_latency=args.critical_latency,
+               players=args.players, rules=args.rules, challenge_cache=args.challenge_cache,
+               debug=args.debug)
 
 
 if __name__ == '__main__':  # pragma: no cover
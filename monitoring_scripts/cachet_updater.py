@@ -0,0 +1,181 @@
+"""Cachet component updates sent through a single pooled HTTP session, coalescing updates issued
+within a short window and sending them with bounded concurrency, and metric points published in
+batches"""
+
+import collections
+import concurrent.futures
+import logging
+import threading
+import time
+
+from . import metrics
+
+DEFAULT_WINDOW = 0.05
+DEFAULT_CONCURRENCY = 8
+# Interval (in seconds) between two batches of metric points
+DEFAULT_METRICS_WINDOW = 60.0
+# Metrics buffered at most between two batches, samples of other metrics are dropped
+DEFAULT_MAX_PENDING_METRICS = 1000
+
+logger = logging.getLogger(__name__)
+
+
+class CachetUpdater():
+    """Sends component status updates through a `cachet.Components` client.
+
+    Updates submitted within `window` seconds of each other are sent together, at most
+    `concurrency` at a time, over the client keep-alive session. If the same component is updated
+    more than once within a window only the latest status is sent, and every caller receives the
+    result of that request."""
+
+    def __init__(self, components, window=DEFAULT_WINDOW, concurrency=DEFAULT_CONCURRENCY):
+        self.components = components
+        self.window = window
+
+        import requests
+        session = getattr(components, 'http', None)
+        if isinstance(session, requests.Session):
+            adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=concurrency)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+
+        self._pending = collections.OrderedDict()
+        self._condition = threading.Condition()
+        self._closed = False
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=concurrency)
+        self._flusher = threading.Thread(target=self._flush_loop, name='cachet-updater',
+                                         daemon=True)
+        self._flusher.start()
+
+    def submit(self, component_id, status):
+        """Queue a component update, return a `concurrent.futures.Future` of its result"""
+
+        future = concurrent.futures.Future()
+        with self._condition:
+            if self._closed:
+                raise RuntimeError('updater is closed')
+            _, futures = self._pending.pop(component_id, (None, []))
+            futures.append(future)
+            self._pending[component_id] = (status, futures)
+            self._condition.notify()
+        return future
+
+    def put(self, id, status, timeout=None):  # pylint: disable=C0103,W0622
+        """Same as `cachet.Components.put`: queue a component update and wait until it is sent,
+        exceptions raised by the request are propagated"""
+
+        return self.submit(id, status).result(timeout)
+
+    def _flush_loop(self):
+        while True:
+            with self._condition:
+                while not self._pending and not self._closed:
+                    self._condition.wait()
+                if not self._pending:
+                    return
+                closing = self._closed
+            if self.window > 0 and not closing:
+                # Gather updates issued shortly after the first one
+                time.sleep(self.window)
+            with self._condition:
+                batch, self._pending = self._pending, collections.OrderedDict()
+            logger.debug('sending %d component updates', len(batch))
+            for component_id, (status, futures) in batch.items():
+                self._executor.submit(self._send, component_id, status, futures)
+
+    def _send(self, component_id, status, futures):
+        start = time.perf_counter()
+        try:
+            result = self.components.put(id=component_id, status=status)
+        except Exception as error:  # pylint: disable=W0703
+            metrics.CACHET_UPDATE_ERRORS.labels().inc()
+            logger.warning('update of component %s failed: %s', component_id, error)
+            for future in futures:
+                future.set_exception(error)
+        else:
+            for future in futures:
+                future.set_result(result)
+        finally:
+            metrics.CACHET_UPDATE_DURATION.labels().observe(time.perf_counter() - start)
+
+    def close(self):
+        """Send the pending updates and wait for their completion"""
+
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+        self._flusher.join()
+        self._executor.shutdown(wait=True)
+
+
+class MetricPublisher():
+    """Publishes metric points through a `cachet.Points` client without blocking the callers.
+
+    Samples are buffered and sent every `window` seconds, at most `concurrency` requests at a
+    time. Cachet creates points one request at a time: the samples of a metric buffered within a
+    window are sent as a single point, their mean timestamped at the latest sample."""
+
+    def __init__(self, points, window=DEFAULT_METRICS_WINDOW,  # pylint: disable=R0913
+                 concurrency=DEFAULT_CONCURRENCY, max_pending=DEFAULT_MAX_PENDING_METRICS):
+        self.points = points
+        self.window = window
+        self.max_pending = max_pending
+
+        self._pending = collections.OrderedDict()
+        self._condition = threading.Condition()
+        self._closed = False
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=concurrency)
+        self._flusher = threading.Thread(target=self._flush_loop, name='cachet-metrics',
+                                         daemon=True)
+        self._flusher.start()
+
+    def add(self, metric_id, value, timestamp=None):
+        """Buffer a sample of a metric, return False if it was dropped because the buffer is
+        full"""
+
+        timestamp = int(time.time() if timestamp is None else timestamp)
+        with self._condition:
+            if self._closed:
+                raise RuntimeError('publisher is closed')
+            samples = self._pending.get(metric_id)
+            if samples is None:
+                if len(self._pending) >= self.max_pending:
+                    metrics.CACHET_POINTS_DROPPED.labels().inc()
+                    return False
+                samples = self._pending[metric_id] = [0, 0.0, timestamp]
+            samples[0] += 1
+            samples[1] += value
+            samples[2] = max(samples[2], timestamp)
+            self._condition.notify()
+        return True
+
+    def _flush_loop(self):
+        while True:
+            with self._condition:
+                while not self._pending and not self._closed:
+                    self._condition.wait()
+                if not self._closed:
+                    # Gather the samples of a whole window, unless closed in the meantime
+                    self._condition.wait_for(lambda: self._closed, self.window)
+                if not self._pending:
+                    return
+                batch, self._pending = self._pending, collections.OrderedDict()
+            logger.debug('publishing %d metric points', len(batch))
+            for metric_id, (count, total, timestamp) in batch.items():
+                self._executor.submit(self._send, metric_id, total / count, timestamp)
+
+    def _send(self, metric_id, value, timestamp):
+        try:
+            self.points.post(id=metric_id, value=value, timestamp=timestamp)
+        except Exception as error:  # pylint: disable=W0703
+            metrics.CACHET_POINT_ERRORS.labels().inc()
+            logger.warning('point of metric %s not published: %s', metric_id, error)
+
+    def close(self):
+        """Publish the buffered samples and wait for their completion"""
+
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        self._flusher.join()
+        self._executor.shutdown(wait=True)
@@ -1,13 +1,21 @@
 """This script executes a Nagios plugin and updates a Cachet component accordingly to its result"""
 
 import argparse
+import concurrent.futures
+import importlib
 import logging
-import subprocess
-
+import os
+import threading
 import time
-import cachetclient.cachet as cachet
 
+from . import cachet_updater
+from . import flapping
+from . import journal as update_journal
+from . import metrics
+from . import plugin_pool
+from . import retry
 from . import settings
+from . import status_cache as cache
 from monitoring_scripts import nagios_common
 
 parser = argparse.ArgumentParser(
@@ -42,12 +50,85 @@ parser.add_argument(
     type=float,
     default=0.5
 )
+parser.add_argument(
+    '--backoff',
+    help='multiplier applied to the interval after each attempt',
+    type=float,
+    default=1.0
+)
+parser.add_argument(
+    '--max-interval',
+    help='maximum time (in seconds) between two attempts',
+    type=float,
+    default=None
+)
+parser.add_argument(
+    '--jitter',
+    help='maximum fraction (between 0 and 1) by which each interval is randomly shortened',
+    type=float,
+    default=0.0
+)
+parser.add_argument(
+    '--deadline',
+    help='maximum time (in seconds) for all the attempts, each one is given a share of it as '
+         'timeout: subprocess attempts are killed if they exceed it, in-process bundled plugins '
+         'only receive it as --timeout',
+    type=float,
+    default=None
+)
+parser.add_argument(
+    '--quorum',
+    help='run this many attempts concurrently and decide the status by quorum instead of '
+         'retrying, --deadline is used as timeout of each attempt',
+    type=int,
+    default=None
+)
+parser.add_argument(
+    '--quorum-decision',
+    help='how the status is decided in quorum mode: status reported by the majority of the '
+         'attempts or OK as soon as one attempt reports it',
+    choices=retry.QUORUM_DECISIONS,
+    default='majority'
+)
+parser.add_argument(
+    '--stagger',
+    help='time (in seconds) between the start of two attempts in quorum mode',
+    type=float,
+    default=0.005
+)
+parser.add_argument(
+    '--pass-timeout',
+    help='pass each attempt time budget to the monitoring script with --timeout, always done for '
+         'bundled scripts when a deadline is set',
+    default=False,
+    action='store_true'
+)
 parser.add_argument(
     '--script-args',
     help='arguments passed to the monitoring script',
     nargs=argparse.REMAINDER,
     default=[]
 )
+parser.add_argument(
+    '--force-subprocess',
+    help='run bundled plugins in a separate process instead of calling them in-process',
+    default=False,
+    action='store_true'
+)
+parser.add_argument(
+    '--metrics',
+    help='comma-separated LABEL=ID pairs: the perfdata LABEL of the plugin output is published '
+         'to the Cachet metric ID',
+    type=settings.parse_metrics,
+    dest='metric_ids',
+    default={}
+)
+parser.add_argument(
+    '--metrics-file',
+    help='write the run metrics to this file in Prometheus text format, for the node exporter '
+         'textfile collector',
+    default=None
+)
 parser.add_argument(
     '--debug',
     help='display debug messages',
@@ -62,21 +143,31 @@ codes_mapping = {
     nagios_common.Codes.UNKNOWN: None
 }
 
+# Plugins shipped with this package, they are executed in-process unless explicitly requested
+BUNDLED_PLUGINS = {
+    'cnto-http-monitor': ('monitoring_scripts.http_monitor', 'http_entry_point'),
+    'cnto-ts3-monitor': ('monitoring_scripts.ts3_monitor', 'ts3_entry_point'),
+    'cnto-arma3-monitor': ('monitoring_scripts.arma3_monitor', 'arma3_entry_point'),
+}
 
-def main(script, component_id, config_file, script_args=None, retries=5, interval=0.5, debug=False):
-    """Script execution"""
+PluginResult = plugin_pool.PluginResult
 
-    if script_args is None:
-        script_args = []
+# Fraction of an attempt time budget given to the plugin as --timeout, the rest is left for its
+# startup and shutdown before it gets killed
+PLUGIN_TIMEOUT_RATIO = 0.9
 
-    logging.basicConfig(level=logging.INFO)
-    logger = logging.getLogger(__name__)
+logger = logging.getLogger(__name__)
 
-    if debug: # pragma: no cover
-        logger.setLevel(logging.DEBUG)
-        logger.info('debug logging enabled')
 
-    # Read Cachet API parameters from config file
+class IncompatiblePluginError(ValueError):
+    """Raised when a plugin exit code does not follow Nagios standards"""
+
+
+def load_config(config_file):
+    """Read the configuration file and validate the mandatory Cachet API parameters.
+
+    Returns the loaded `settings.RunnerConfigParser` along with Cachet base URL and API key."""
+
     config_parser = settings.RunnerConfigParser()
     config_parser.read(config_file)
     base_url = config_parser.get('Cachet', 'base-url', fallback=None)
@@ -86,48 +177,411 @@ def main(script, component_id, config_file, script_args=None, retries=5, interva
         raise ValueError('invalid configuration, use config.ini.dist file as reference')
     logger.info('configuration parameters loaded')
 
-    # Run monitoring script
-    script_args.insert(0, script)
-    logger.debug('invocation arguments %s', script_args)
-    for retry_num in range(retries + 1, 0, -1):
-        if retry_num < retries + 1:
-            # Not first run, script is in soft failure status, wait before retrying
-            time.sleep(interval)
-        logger.info('attempt n. %d', retries - retry_num + 1)
-
-        completed_execution = subprocess.run(script_args)
-        logger.debug('execution completed, plugin exit code is %d', completed_execution.returncode)
-        logger.debug('type of plugin exit code is %s', completed_execution.returncode)
-        try:
-            script_return_code = nagios_common.Codes(completed_execution.returncode)
-            if script_return_code == nagios_common.Codes.OK:
-                break
-        except ValueError:
-            logger.critical('script plugin exit code is not compatible with Nagios standards, '
-                            'return code is %d', completed_execution.returncode)
-            nagios_common.plugin_exit(code=nagios_common.Codes.CRITICAL)
+    return config_parser, base_url, api_key
+
+
+def _run_in_process(plugin, arguments):
+    """Call a bundled plugin entry point in the current thread and capture its result"""
+
+    module_name, entry_point = plugin
+    module = importlib.import_module(module_name)
+    try:
+        with nagios_common.captured_output():
+            getattr(module, entry_point)(arguments)
+    except nagios_common.PluginExit as plugin_exit:
+        return PluginResult(plugin_exit.code, plugin_exit.output)
+    except SystemExit as system_exit:
+        # Raised by argparse on invalid arguments, mirror the interpreter exit status
+        if system_exit.code is None or isinstance(system_exit.code, int):
+            return PluginResult(system_exit.code or 0, None)
+        return PluginResult(1, None)
+    except Exception:  # pylint: disable=W0703
+        # An uncaught exception makes the interpreter exit with status 1 in a subprocess
+        logger.exception('in-process plugin %s failed', module_name)
+        return PluginResult(1, None)
+
+    logger.error('in-process plugin %s returned without exit status', module_name)
+    return PluginResult(nagios_common.Codes.UNKNOWN.value, None)
+
+
+def is_bundled(script):
+    """Tell if a script is one of the plugins shipped with this package"""
+
+    return os.path.basename(str(script)) in BUNDLED_PLUGINS
+
+
+def run_plugin(invocation, in_process=True, timeout=None, cancel=None):
+    """Run a plugin once and return its `PluginResult`.
+
+    Bundled plugins are called in-process when `in_process` is set, any other plugin is
+    executed as a subprocess of the `plugin_pool` and killed if it runs for more than `timeout`
+    seconds, which results in a CRITICAL status, or once `cancel`, a `threading.Event`, is set.
+    In-process plugins cannot be interrupted."""
+
+    plugin = BUNDLED_PLUGINS.get(os.path.basename(str(invocation[0])))
+    if in_process and plugin:
+        logger.debug('running bundled plugin %s in-process', invocation[0])
+        result = _run_in_process(plugin, invocation[1:])
+    else:
+        result = plugin_pool.pool().run(invocation, timeout=timeout, cancel=cancel)
+    if result.output:
+        logger.info('plugin output: %s', result.output)
+    return result
+
+
+def _attempt(invocation, budget, in_process,  # pylint: disable=R0913
+             pass_timeout, probe=None, outputs=None, cancel=None):
+    """Run a single plugin attempt within `budget` seconds and validate its exit code, recording
+    it in `probe`, a `metrics.ProbeMetrics`, if given. If `outputs` is a list the status and
+    the parsed output of the attempt are appended to it. A subprocess attempt is killed once
+    `cancel`, a `threading.Event`, is set, its status is then None."""
+
+    if budget is not None and (pass_timeout or is_bundled(invocation[0])):
+        invocation = invocation + ['--timeout', '%.3f' % (budget * PLUGIN_TIMEOUT_RATIO)]
+
+    start = time.perf_counter()
+    completed_execution = run_plugin(invocation, in_process, budget, cancel)
+    if cancel is not None and cancel.is_set():
+        return None
+    if probe:
+        probe.attempts.inc()
+        probe.duration.observe(time.perf_counter() - start)
+    logger.debug('execution completed, plugin exit code is %d', completed_execution.returncode)
+    try:
+        status = nagios_common.Codes(completed_execution.returncode)
+    except ValueError:
+        logger.critical('script plugin exit code is not compatible with Nagios standards, '
+                        'return code is %d', completed_execution.returncode)
+        raise IncompatiblePluginError(completed_execution.returncode)
+    if outputs is not None:
+        outputs.append((status, nagios_common.parse_output(completed_execution.output)))
+    return status
+
+
+def execute_plugin(script, script_args=None, policy=None,  # pylint: disable=R0913
+                   in_process=True, pass_timeout=False, component_id=None, outputs=None):
+    """Run a plugin until it reports OK or the attempts allowed by `policy`, a
+    `retry.RetryPolicy`, are exhausted and return its last status as `nagios_common.Codes`.
+
+    If the policy has a deadline each attempt time budget is passed to the plugin with
+    `--timeout` (always for bundled plugins, only if `pass_timeout` is set for other ones).
+    Attempts are recorded in the probe metrics of `component_id`, if given, and their parsed
+    output in `outputs`, see `_attempt`.
+
+    Raises IncompatiblePluginError if the plugin exit code is not Nagios-compatible."""
+
+    policy = policy or retry.RetryPolicy()
+    invocation = [script] + list(script_args or [])
+    probe = metrics.ProbeMetrics.of(component_id) if component_id is not None else None
+    logger.debug('invocation arguments %s', invocation)
+    for attempt, budget in policy.attempts():
+        logger.info('attempt n. %d', attempt)
+        if attempt and probe:
+            probe.retries.inc()
+        script_return_code = _attempt(invocation, budget, in_process, pass_timeout, probe,
+                                      outputs)
+        if script_return_code == nagios_common.Codes.OK:
+            break
 
         logger.info('script return code is: %s, %d', script_return_code.name,
                     script_return_code.value)
-        retry_num -= 1
 
-    # Update Cachet
-    cachet_status_code = codes_mapping[script_return_code]
+    return script_return_code
+
+
+def execute_quorum(script, script_args, policy,  # pylint: disable=R0913
+                   in_process=True, pass_timeout=False, component_id=None, outputs=None):
+    """Run concurrent plugin attempts according to `policy`, a `retry.QuorumPolicy`, and return
+    the decided status as `nagios_common.Codes`. As soon as the status is decided attempts not
+    started yet are cancelled and the process groups of running subprocess attempts are killed,
+    running in-process attempts are left to complete within their `--timeout`.
+    Attempts are recorded in the probe metrics of `component_id`, if given, and their parsed
+    output in `outputs`, see `_attempt`.
+
+    Raises IncompatiblePluginError if a plugin exit code is not Nagios-compatible."""
+
+    invocation = [script] + list(script_args or [])
+    probe = metrics.ProbeMetrics.of(component_id) if component_id is not None else None
+    logger.debug('quorum of %d attempts, invocation arguments %s', policy.attempts, invocation)
+    decided = threading.Event()
+
+    def attempt(number):
+        # Stagger attempts, giving up if the status is decided in the meantime
+        if decided.wait(number * policy.stagger):
+            return None
+        logger.info('attempt n. %d', number)
+        return _attempt(invocation, policy.timeout, in_process, pass_timeout, probe, outputs,
+                        decided)
+
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=policy.attempts)
+    futures = [executor.submit(attempt, number) for number in range(policy.attempts)]
+    statuses = []
+    try:
+        for future in concurrent.futures.as_completed(futures):
+            statuses.append(future.result())
+            status = policy.decide(statuses)
+            if status is not None:
+                logger.info('status %s decided after %d attempts', status.name, len(statuses))
+                return status
+        return policy.decide(statuses, final=True)
+    finally:
+        decided.set()
+        for future in futures:
+            future.cancel()
+        executor.shutdown(wait=False)
+
+
+def execute(script, script_args, policy,  # pylint: disable=R0913
+            in_process=True, pass_timeout=False, component_id=None, outputs=None):
+    """Run a plugin with either a `retry.RetryPolicy` or a `retry.QuorumPolicy` and return its
+    final status as `nagios_common.Codes`"""
+
+    if isinstance(policy, retry.QuorumPolicy):
+        return execute_quorum(script, script_args, policy, in_process, pass_timeout,
+                              component_id, outputs)
+    return execute_plugin(script, script_args, policy, in_process, pass_timeout, component_id,
+                          outputs)
+
+
+def publish_perfdata(publisher, metric_ids, status, outputs):
+    """Publish the perfdata of the last attempt which reported `status` through `publisher`, a
+    `cachet_updater.MetricPublisher`. `outputs` is the list filled by `execute`, `metric_ids`
+    maps perfdata labels to Cachet metric ids. Returns the number of points published."""
+
+    for attempt_status, output in reversed(outputs):
+        if attempt_status == status:
+            break
+    else:
+        return 0
+    published = 0
+    for point in output.perfdata:
+        metric_id = metric_ids.get(point.label)
+        if metric_id is not None and publisher.add(metric_id, point.value):
+            published += 1
+    logger.debug('%d perfdata points published', published)
+    return published
+
+
+def configure_plugin_pool(config_parser):
+    """Configure the `plugin_pool.PluginPool` running external plugins from the `[Plugins]`
+    section and return it"""
+
+    return plugin_pool.configure(
+        concurrency=config_parser.getint('Plugins', 'concurrency',
+                                         fallback=plugin_pool.DEFAULT_CONCURRENCY),
+        output_limit=config_parser.getint('Plugins', 'output-limit',
+                                          fallback=plugin_pool.DEFAULT_OUTPUT_LIMIT),
+        kill_grace=config_parser.getfloat('Plugins', 'kill-grace',
+                                          fallback=plugin_pool.DEFAULT_KILL_GRACE),
+    )
+
+
+def load_status_cache(config_parser, components):
+    """Return the `status_cache.StatusCache` configured in the `[Cachet]` section, None if not
+    configured. The cache is seeded from Cachet through `components` if its file does not exist."""
+
+    path = config_parser.get('Cachet', 'status-cache', fallback=None)
+    if not path:
+        return None
+    status_cache = cache.StatusCache(
+        path, config_parser.getfloat('Cachet', 'status-cache-ttl', fallback=cache.DEFAULT_TTL))
+    if not status_cache.load():
+        import requests
+        try:
+            status_cache.seed(components)
+        except (requests.RequestException, ValueError, KeyError) as error:
+            logger.warning('cannot seed status cache from Cachet: %s', error)
+    return status_cache
+
+
+def load_flap_detector(config_parser):
+    """Return the `flapping.FlapDetector` configured in the `[Flapping]` section, None if the
+    section is missing. Its histories are loaded from the `history` file if set."""
+
+    if not config_parser.has_section('Flapping'):
+        return None
+    detector = flapping.FlapDetector(
+        size=config_parser.getint('Flapping', 'size', fallback=flapping.DEFAULT_SIZE),
+        confirmations=config_parser.getint('Flapping', 'confirmations',
+                                           fallback=flapping.DEFAULT_CONFIRMATIONS),
+        low_threshold=config_parser.getfloat('Flapping', 'low-threshold',
+                                             fallback=flapping.DEFAULT_LOW_THRESHOLD),
+        high_threshold=config_parser.getfloat('Flapping', 'high-threshold',
+                                              fallback=flapping.DEFAULT_HIGH_THRESHOLD),
+        path=config_parser.get('Flapping', 'history', fallback=None) or None
+    )
+    if detector.path:
+        detector.load()
+    return detector
+
+
+def load_journal(config_parser):
+    """Return the `journal.UpdateJournal` configured in the `[Cachet]` section along with the
+    `journal.CircuitBreaker` guarding its drains, (None, None) if not configured"""
+
+    path = config_parser.get('Cachet', 'journal', fallback=None)
+    if not path:
+        return None, None
+    breaker = update_journal.CircuitBreaker(
+        failure_threshold=config_parser.getint(
+            'Cachet', 'breaker-failures', fallback=update_journal.DEFAULT_FAILURE_THRESHOLD),
+        reset_timeout=config_parser.getfloat(
+            'Cachet', 'breaker-reset', fallback=update_journal.DEFAULT_RESET_TIMEOUT),
+        path=path + '.breaker'
+    )
+    return update_journal.UpdateJournal(path), breaker
+
+
+def drain_journal(journal, components, breaker=None, timeout=None):
+    """Drain a `journal.UpdateJournal` through a `cachet.Components` client from a daemon thread,
+    waiting for it at most `timeout` seconds. A drain still running afterwards is abandoned with
+    the process: its updates stay journaled and are delivered by the next drain.
+
+    Returns True if the drain completed in time."""
+
+    def drain():
+        try:
+            journal.drain(components, breaker)
+        except OSError as error:
+            logger.warning('cannot drain journal: %s', error)
+
+    thread = threading.Thread(target=drain, name='journal-drain', daemon=True)
+    thread.start()
+    thread.join(timeout)
+    if thread.is_alive():
+        logger.warning('journal not drained within %.1f seconds, left to the next drain',
+                       timeout)
+        return False
+    return True
+
+
+def update_component(components, component_id, status, status_mapping=None, status_cache=None):
+    """Forward a plugin status to a Cachet component using the given `cachet.Components` client,
+    `cachet_updater.CachetUpdater` or `journal.UpdateJournal`, `status_mapping` overrides the
+    default `codes_mapping`. If a `status_cache.StatusCache` is given the update is skipped when
+    Cachet is known to already have that status. The status is recorded in the
+    `metrics.CHECK_STATUS` gauge.
+
+    Returns the Cachet status code of the component, None if the status has no Cachet
+    equivalent."""
+
+    metrics.CHECK_STATUS.labels(component_id).set(status.value)
+    cachet_status_code = (status_mapping or codes_mapping)[status]
     if cachet_status_code:
-        components = cachet.Components(endpoint=base_url, api_token=api_key)
+        if status_cache and not status_cache.needs_update(component_id, cachet_status_code):
+            logger.info('component %d already has status %d, update skipped', component_id,
+                        cachet_status_code)
+            return cachet_status_code
         components.put(id=component_id, status=cachet_status_code)
-
+        if status_cache:
+            status_cache.record(component_id, cachet_status_code)
         logger.info('updated component %d with status %d', component_id, cachet_status_code)
+    else:
+        logger.warning('no updates were sent to Cachet for component %d', component_id)
+
+    return cachet_status_code
+
+
+def main(script, component_id, config_file, script_args=None,  # pylint: disable=R0913,R0914
+         retries=5, interval=0.5, backoff=1.0, max_interval=None, jitter=0.0, deadline=None,
+         quorum=None, quorum_decision='majority', stagger=0.005, pass_timeout=False,
+         force_subprocess=False, metric_ids=None, metrics_file=None, debug=False):
+    """Script execution"""
+
+    logging.basicConfig(level=logging.INFO)
+
+    if debug: # pragma: no cover
+        logger.setLevel(logging.DEBUG)
+        logger.info('debug logging enabled')
+
+    # Read Cachet API parameters from config file
+    config_parser, base_url, api_key = load_config(config_file)
+    status_mapping = config_parser.status_mapping(codes_mapping)
+    configure_plugin_pool(config_parser)
+
+    # Run monitoring script
+    if quorum:
+        policy = retry.QuorumPolicy(quorum, quorum_decision, stagger, deadline)
+    else:
+        policy = retry.RetryPolicy(retries, interval, backoff, max_interval, jitter, deadline)
+    flap_detector = load_flap_detector(config_parser)
+    if flap_detector and not flap_detector.path:
+        logger.warning('no history file in the [Flapping] section, results are not remembered '
+                       'between runs: flap detection and confirmations are disabled')
+    if flap_detector and flap_detector.is_flapping(component_id):
+        logger.info('component %d is flapping, retries skipped', component_id)
+        policy = retry.single_attempt(policy)
+    # Plugin output is parsed only if some of its perfdata is published
+    outputs = [] if metric_ids else None
+    try:
+        script_return_code = execute(script, script_args, policy, in_process=not force_subprocess,
+                                     pass_timeout=pass_timeout, component_id=component_id,
+                                     outputs=outputs)
+    except IncompatiblePluginError:
+        nagios_common.plugin_exit(code=nagios_common.Codes.CRITICAL)
+    reported_code = script_return_code
+    if flap_detector:
+        reported_code = flap_detector.record(component_id, script_return_code)
+        if flap_detector.path:
+            try:
+                flap_detector.save()
+            except OSError as error:
+                logger.warning('cannot save flap history: %s', error)
+
+    # Update Cachet
+    import cachetclient.cachet as cachet
+    journal, breaker = load_journal(config_parser)
+    # With a journal requests are always bounded, so that a hung Cachet opens the circuit
+    timeout = config_parser.getfloat(
+        'Cachet', 'timeout', fallback=update_journal.DEFAULT_DRAIN_TIMEOUT if journal else None)
+    components = cachet.Components(endpoint=base_url, api_token=api_key, timeout=timeout)
+    status_cache = load_status_cache(config_parser, components)
+    # The journal is drained without the updater, whose requests would be waited for on exit
+    updater = None if journal else cachet_updater.CachetUpdater(components, window=0,
+                                                                concurrency=1)
+    publisher = None
+    if metric_ids:
+        publisher = cachet_updater.MetricPublisher(
+            cachet.Points(endpoint=base_url, api_token=api_key, timeout=timeout), window=0,
+            concurrency=config_parser.getint('Cachet', 'update-concurrency',
+                                             fallback=cachet_updater.DEFAULT_CONCURRENCY))
+        publish_perfdata(publisher, metric_ids, script_return_code, outputs)
+    try:
+        if journal:
+            # The update is acknowledged once journaled, then delivered on a best effort basis:
+            # what Cachet does not take now is sent by the next runner or daemon draining it
+            updated = update_component(journal, component_id, reported_code, status_mapping,
+                                       status_cache)
+            drain_journal(journal, components, breaker, config_parser.getfloat(
+                'Cachet', 'journal-timeout', fallback=update_journal.DEFAULT_DRAIN_TIMEOUT))
+        else:
+            updated = update_component(updater, component_id, reported_code,
+                                       status_mapping, status_cache)
+    finally:
+        if updater:
+            updater.close()
+        if publisher:
+            publisher.close()
+    if status_cache:
+        try:
+            status_cache.save()
+        except OSError as error:
+            logger.warning('cannot save status cache: %s', error)
+    if metrics_file:
+        try:
+            metrics.REGISTRY.write_textfile(metrics_file)
+        except OSError as error:
+            logger.warning('cannot write metrics: %s', error)
+    if updated:
         nagios_common.plugin_exit(code=nagios_common.Codes.OK)
     else:
-        logger.warning('no updates were sent to Cachet')
         nagios_common.plugin_exit(code=nagios_common.Codes.UNKNOWN)
 
 
-def runner_entry_point(): # pragma: no cover
+def runner_entry_point(argv=None): # pragma: no cover
     """Console entry point"""
 
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
 
     main(**args.__dict__)
 
@@ -0,0 +1,56 @@
+"""
+Single entry point for every monitoring script: `cnto-monitor <command> [arguments]`.
+Only the module of the selected command is imported, and heavy dependencies
+(requests, python-valve, cachetclient) are imported by that module only once
+its arguments are validated, keeping the start of plugins forked by Nagios fast.
+The modules of the package therefore import these dependencies inside the
+functions using them, never at module level.
+"""
+
+import argparse
+import collections
+import importlib
+
+# Command name: (module, entry point), entry points accept the list of arguments
+COMMANDS = collections.OrderedDict([
+    ('http', ('monitoring_scripts.http_monitor', 'http_entry_point')),
+    ('ts3', ('monitoring_scripts.ts3_monitor', 'ts3_entry_point')),
+    ('arma3', ('monitoring_scripts.arma3_monitor', 'arma3_entry_point')),
+    ('runner', ('monitoring_scripts.check_runner', 'runner_entry_point')),
+    ('daemon', ('monitoring_scripts.daemon', 'daemon_entry_point')),
+])
+
+parser = argparse.ArgumentParser(
+    prog='cnto-monitor',
+    description=__doc__,
+    formatter_class=argparse.RawDescriptionHelpFormatter
+)
+parser.add_argument(
+    'command',
+    help='command to run, `cnto-monitor <command> --help` describes its arguments',
+    choices=COMMANDS
+)
+parser.add_argument(
+    'arguments',
+    help='arguments of the command',
+    nargs=argparse.REMAINDER
+)
+
+
+def load_command(command):
+    """Import the module of a command and return its entry point"""
+
+    module, entry_point = COMMANDS[command]
+    return getattr(importlib.import_module(module), entry_point)
+
+
+def cli_entry_point(argv=None):
+    """Console entry point"""
+
+    args = parser.parse_args(argv)
+
+    load_command(args.command)(args.arguments)
+
+
+if __name__ == '__main__':  # pragma: no cover
+    cli_entry_point()
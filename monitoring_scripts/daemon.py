@@ -0,0 +1,446 @@
+"""
+Long-running check runner. Every check declared in the configuration file
+with a `[Check:<name>]` section is scheduled from a single process and its
+result is forwarded to Cachet through a shared client, avoiding a new
+interpreter, configuration load and Cachet client for every check run. The
+configuration file is watched for changes, or reloaded on SIGHUP: only the
+added, removed and modified checks are rescheduled.
+"""
+
+import argparse
+import concurrent.futures
+import configparser
+import functools
+import hashlib
+import heapq
+import logging
+import os
+import signal
+import threading
+import time
+
+from . import cachet_updater
+from . import check_runner
+from . import journal as update_journal
+from . import metrics
+from . import net
+from . import retry
+from . import settings
+
+parser = argparse.ArgumentParser(
+    prog='cnto-check-daemon',
+    description=__doc__,
+    formatter_class=argparse.ArgumentDefaultsHelpFormatter
+)
+parser.add_argument(
+    'config_file',
+    help='path to configuration file, see config.ini.dist file for example'
+)
+parser.add_argument(
+    '--workers',
+    help='maximum number of checks running at the same time, overrides the configuration file',
+    type=int,
+    default=None
+)
+parser.add_argument(
+    '--no-spread',
+    help='run every check right away on start instead of spreading them within their interval',
+    dest='spread',
+    default=None,
+    action='store_false'
+)
+parser.add_argument(
+    '--debug',
+    help='display debug messages',
+    default=False,
+    action='store_true'
+)
+
+DEFAULT_WORKERS = 8
+# Interval (in seconds) between two checks of the configuration file modification time
+DEFAULT_RELOAD_INTERVAL = 5.0
+# Interval (in seconds) between two saves of the status cache, flap histories and metrics file
+DEFAULT_SAVE_INTERVAL = 5.0
+
+logger = logging.getLogger(__name__)
+
+
+class CheckDaemon():
+    """Schedules a set of `settings.Check` on a thread pool, each one every `interval` seconds.
+    Results are forwarded to Cachet through `components`, either a `cachet.Components` client, a
+    `cachet_updater.CachetUpdater` or a `journal.UpdateJournal`, and the perfdata mapped to
+    metrics by the checks is published through `publisher`, a `cachet_updater.MetricPublisher`,
+    if given.
+
+    A check is never run concurrently with itself: if an execution lasts longer than its
+    interval the next one starts as soon as the previous completes.
+
+    With `spread` set every check runs at a fixed phase of its interval, see `phase_delay`, so
+    that checks sharing an interval do not all start at once. Otherwise checks run as soon as
+    they are scheduled. The queue is a heap: dispatching a check costs O(log n).
+
+    The checks can be replaced with `reload` while running. Every check has a generation,
+    increased when it is added, modified or removed and never reset, and the queued executions
+    of a past generation are dropped when they are due.
+
+    With a `flapping.FlapDetector` the reported status is the one it decides, and the checks of
+    flapping components run a single attempt instead of their retries.
+
+    The status cache, the flap histories and the `metrics_file` are saved every `save_interval`
+    seconds from a background thread and once the daemon stops, not after every check."""
+
+    def __init__(self, checks, components, workers=DEFAULT_WORKERS,  # pylint: disable=R0913
+                 status_mapping=None, status_cache=None, metrics_file=None, spread=True,
+                 publisher=None, flap_detector=None, save_interval=DEFAULT_SAVE_INTERVAL):
+        self.checks = {check.name: check for check in checks}
+        self.components = components
+        self.workers = workers
+        self.spread = spread
+        self.publisher = publisher
+        self.flap_detector = flap_detector
+        self.status_mapping = status_mapping
+        self.status_cache = status_cache
+        self.metrics_file = metrics_file
+        self.save_interval = save_interval
+
+        self._lag = metrics.SCHEDULER_LAG.labels()
+        self._queue = []
+        self._generations = {name: 0 for name in self.checks}
+        self._running = set()
+        self._deferred = set()
+        self._condition = threading.Condition()
+        self._stopping = False
+        self._stopped = threading.Event()
+
+    def run_check(self, check):
+        """Execute a check and forward its result to Cachet, errors are logged and swallowed"""
+
+        try:
+            policy = check.retry_policy
+            flap_detector = self.flap_detector
+            if flap_detector and flap_detector.is_flapping(check.component_id):
+                logger.debug('check %s: component is flapping, retries skipped', check.name)
+                policy = retry.single_attempt(policy)
+            outputs = [] if self.publisher and check.metrics else None
+            status = check_runner.execute(check.script, check.args, policy,
+                                          pass_timeout=check.pass_timeout,
+                                          component_id=check.component_id, outputs=outputs)
+            if outputs is not None:
+                check_runner.publish_perfdata(self.publisher, check.metrics, status, outputs)
+            if flap_detector:
+                status = flap_detector.record(check.component_id, status)
+            check_runner.update_component(self.components, check.component_id, status,
+                                          self.status_mapping, self.status_cache)
+        except check_runner.IncompatiblePluginError:
+            logger.error('check %s: plugin exit code is not Nagios-compatible', check.name)
+        except Exception:  # pylint: disable=W0703
+            logger.exception('check %s: execution failed', check.name)
+
+    def save(self):
+        """Save the status cache and the flap histories if they changed, and the metrics file.
+        Errors are logged and swallowed."""
+
+        flap_detector = self.flap_detector
+        saves = []
+        if self.status_cache and self.status_cache.dirty:
+            saves.append(('status cache', self.status_cache.save))
+        if flap_detector and flap_detector.path and flap_detector.dirty:
+            saves.append(('flap history', flap_detector.save))
+        if self.metrics_file:
+            saves.append(('metrics file',
+                          functools.partial(metrics.REGISTRY.write_textfile, self.metrics_file)))
+        for name, save in saves:
+            try:
+                save()
+            except OSError as error:
+                logger.warning('cannot save %s: %s', name, error)
+
+    def _save_loop(self):
+        while not self._stopped.wait(self.save_interval):
+            self.save()
+
+    def _start(self, due, check):
+        """Run a check from a worker, recording its lag from the due time to its start, which
+        includes the wait for a free worker"""
+
+        self._lag.observe(time.monotonic() - due)
+        self.run_check(check)
+
+    def _schedule(self, due, check_name, generation):
+        with self._condition:
+            heapq.heappush(self._queue, (due, check_name, generation))
+            self._condition.notify()
+
+    def _first_due(self, check, now):
+        if not self.spread:
+            return now
+        return now + phase_delay(check.name, check.interval)
+
+    def _on_completion(self, due, check_name, generation):
+        with self._condition:
+            self._running.discard(check_name)
+            if check_name in self._deferred:
+                # Modified while running, the new version is scheduled as on start
+                self._deferred.discard(check_name)
+                self._schedule(self._first_due(self.checks[check_name], time.monotonic()),
+                               check_name, self._generations[check_name])
+            elif self._generations.get(check_name) == generation:
+                self._schedule(max(due + self.checks[check_name].interval, time.monotonic()),
+                               check_name, generation)
+
+    def reload(self, checks):
+        """Replace the scheduled checks by `checks`, a list of `settings.Check`. Added and
+        modified checks are scheduled as on start, removed ones are not run anymore and the other
+        ones keep their schedule. Running executions complete, a modified check being run is
+        scheduled again on completion. Returns the `settings.ChecksDiff` of the checks."""
+
+        checks = {check.name: check for check in checks}
+        with self._condition:
+            diff = settings.diff_checks(list(self.checks.values()), list(checks.values()))
+            now = time.monotonic()
+            for check_name in diff.removed:
+                del self.checks[check_name]
+                # Kept so that the executions already queued stay stale if it is added again
+                self._generations[check_name] += 1
+                self._deferred.discard(check_name)
+            for check_name in diff.added + diff.modified:
+                self.checks[check_name] = checks[check_name]
+                self._generations[check_name] = self._generations.get(check_name, 0) + 1
+                if check_name in self._running:
+                    self._deferred.add(check_name)
+                else:
+                    self._schedule(self._first_due(checks[check_name], now), check_name,
+                                   self._generations[check_name])
+        logger.info('configuration reloaded: %d added, %d removed, %d modified checks',
+                    len(diff.added), len(diff.removed), len(diff.modified))
+        return diff
+
+    def run(self):
+        """Run the scheduling loop until `stop` is called"""
+
+        now = time.monotonic()
+        for check_name, check in self.checks.items():
+            self._schedule(self._first_due(check, now), check_name,
+                           self._generations[check_name])
+
+        saver = threading.Thread(target=self._save_loop, name='daemon-saver', daemon=True)
+        saver.start()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as executor:
+            with self._condition:
+                while not self._stopping:
+                    now = time.monotonic()
+                    while self._queue and self._queue[0][0] <= now:
+                        due, check_name, generation = heapq.heappop(self._queue)
+                        if self._generations.get(check_name) != generation:
+                            continue
+                        logger.debug('dispatching check %s', check_name)
+                        self._running.add(check_name)
+                        future = executor.submit(self._start, due, self.checks[check_name])
+                        future.add_done_callback(
+                            lambda _, due=due, name=check_name, generation=generation:
+                            self._on_completion(due, name, generation)
+                        )
+                    timeout = self._queue[0][0] - now if self._queue else None
+                    self._condition.wait(timeout)
+        self._stopped.set()
+        saver.join()
+        self.save()
+        logger.info('daemon stopped')
+
+    def stop(self):
+        """Ask the scheduling loop to terminate, running checks are allowed to complete"""
+
+        with self._condition:
+            self._stopping = True
+            self._condition.notify()
+
+
+def phase_delay(check_name, interval, now=None):
+    """Return the delay (in seconds) until the next run of a check spread within its interval.
+
+    Every check runs at a fixed offset of its interval on the wall clock, derived from a hash of
+    its name: checks sharing an interval are evenly spread and keep their slots across restarts
+    and reloads."""
+
+    now = time.time() if now is None else now
+    digest = hashlib.sha256(check_name.encode('utf-8')).digest()
+    offset = int.from_bytes(digest[:8], 'big') / 2 ** 64 * interval
+    return (offset - now) % interval
+
+
+def load_checks(config_file):
+    """Read the configuration file and validate its checks and status mapping.
+
+    Returns the loaded `settings.RunnerConfigParser` along with its checks, raises ValueError or
+    configparser.Error if the configuration is invalid or declares no check."""
+
+    config_parser, _, _ = check_runner.load_config(config_file)
+    checks = config_parser.checks()
+    if not checks:
+        raise ValueError('no checks declared in configuration file')
+    config_parser.status_mapping(check_runner.codes_mapping)
+    return config_parser, checks
+
+
+class ConfigWatcher():
+    """Polls the configuration file every `interval` seconds from a background thread and passes
+    its checks to `callback` whenever its modification time or size changes. A configuration
+    failing validation is logged and ignored, keeping the checks previously loaded."""
+
+    def __init__(self, path, callback, interval=DEFAULT_RELOAD_INTERVAL):
+        self.path = path
+        self.callback = callback
+        self.interval = interval
+
+        self._signature = self._stat()
+        self._forced = False
+        self._stopping = False
+        self._wakeup = threading.Event()
+        self._thread = None
+
+    def _stat(self):
+        try:
+            status = os.stat(self.path)
+        except OSError:
+            return None
+        return status.st_mtime_ns, status.st_size
+
+    def poll(self, force=False):
+        """Reload the configuration if the file changed since the last poll, or if `force` is
+        set. Return True if the new checks were passed to the callback."""
+
+        signature = self._stat()
+        if signature == self._signature and not force:
+            return False
+        self._signature = signature
+        try:
+            _, checks = load_checks(self.path)
+        except (ValueError, configparser.Error) as error:
+            logger.error('configuration %s rejected, keeping the current one: %s', self.path,
+                         error)
+            return False
+        self.callback(checks)
+        return True
+
+    def request(self):
+        """Ask for a reload as soon as possible, safe to call from a signal handler"""
+
+        self._forced = True
+        self._wakeup.set()
+
+    def _watch(self):
+        while True:
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            if self._stopping:
+                return
+            forced, self._forced = self._forced, False
+            try:
+                self.poll(forced)
+            except Exception:  # pylint: disable=W0703
+                logger.exception('configuration reload failed')
+
+    def start(self):
+        """Start polling"""
+
+        self._thread = threading.Thread(target=self._watch, name='config-watcher', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop polling"""
+
+        self._stopping = True
+        self._wakeup.set()
+        if self._thread:
+            self._thread.join()
+
+
+def main(config_file, workers=None, spread=None, debug=False):
+    """Daemon execution"""
+
+    logging.basicConfig(level=logging.INFO)
+
+    if debug:  # pragma: no cover
+        logger.setLevel(logging.DEBUG)
+        logger.info('debug logging enabled')
+
+    config_parser, checks = load_checks(config_file)
+    base_url = config_parser.get('Cachet', 'base-url')
+    api_key = config_parser.get('Cachet', 'api-key')
+    if workers is None:
+        workers = config_parser.getint('Daemon', 'workers', fallback=DEFAULT_WORKERS)
+    if spread is None:
+        spread = config_parser.getboolean('Daemon', 'spread', fallback=True)
+    logger.info('loaded %d checks, running with %d workers', len(checks), workers)
+    check_runner.configure_plugin_pool(config_parser)
+
+    import cachetclient.cachet as cachet
+    journal, breaker = check_runner.load_journal(config_parser)
+    # With a journal requests are always bounded, so that a hung Cachet opens the circuit
+    timeout = config_parser.getfloat(
+        'Cachet', 'timeout', fallback=update_journal.DEFAULT_DRAIN_TIMEOUT if journal else None)
+    components = cachet.Components(endpoint=base_url, api_token=api_key, timeout=timeout)
+    updater = cachet_updater.CachetUpdater(
+        components,
+        window=config_parser.getfloat('Cachet', 'update-window',
+                                      fallback=cachet_updater.DEFAULT_WINDOW),
+        concurrency=config_parser.getint('Cachet', 'update-concurrency',
+                                         fallback=cachet_updater.DEFAULT_CONCURRENCY)
+    )
+    publisher = cachet_updater.MetricPublisher(
+        cachet.Points(endpoint=base_url, api_token=api_key, timeout=timeout),
+        window=config_parser.getfloat('Cachet', 'metrics-window',
+                                      fallback=cachet_updater.DEFAULT_METRICS_WINDOW),
+        concurrency=config_parser.getint('Cachet', 'update-concurrency',
+                                         fallback=cachet_updater.DEFAULT_CONCURRENCY)
+    )
+    # With a journal the checks only append to it, the flusher delivers the updates to Cachet
+    flusher = None
+    if journal:
+        flusher = update_journal.JournalFlusher(
+            journal, updater, breaker,
+            interval=config_parser.getfloat('Cachet', 'journal-interval',
+                                            fallback=update_journal.DEFAULT_FLUSH_INTERVAL),
+            timeout=timeout
+        )
+    daemon = CheckDaemon(checks, journal or updater, workers=workers,
+                         status_mapping=config_parser.status_mapping(check_runner.codes_mapping),
+                         status_cache=check_runner.load_status_cache(config_parser, components),
+                         metrics_file=config_parser.get('Metrics', 'textfile', fallback=None),
+                         spread=spread, publisher=publisher,
+                         flap_detector=check_runner.load_flap_detector(config_parser),
+                         save_interval=config_parser.getfloat('Daemon', 'save-interval',
+                                                              fallback=DEFAULT_SAVE_INTERVAL))
+    listen = config_parser.get('Metrics', 'listen', fallback=None)
+    metrics_server = metrics.REGISTRY.serve(*net.parse_target(listen, None)) if listen else None
+    reload_interval = config_parser.getfloat('Daemon', 'reload-interval',
+                                             fallback=DEFAULT_RELOAD_INTERVAL)
+    watcher = ConfigWatcher(config_file, daemon.reload, reload_interval or None)
+    signal.signal(signal.SIGTERM, lambda *_: daemon.stop())
+    signal.signal(signal.SIGINT, lambda *_: daemon.stop())
+    signal.signal(signal.SIGHUP, lambda *_: watcher.request())
+    watcher.start()
+    if flusher:
+        flusher.start()
+    try:
+        daemon.run()
+    finally:
+        watcher.stop()
+        if flusher:
+            flusher.stop()
+        updater.close()
+        publisher.close()
+        if metrics_server:
+            metrics_server.shutdown()
+
+
+def daemon_entry_point(argv=None):  # pragma: no cover
+    """Console entry point"""
+
+    args = parser.parse_args(argv)
+
+    main(**args.__dict__)
+
+
+if __name__ == '__main__':  # pragma: no cover
+    daemon_entry_point()
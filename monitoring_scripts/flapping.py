@@ -0,0 +1,203 @@
+"""Per-component history of check results, used to detect flapping services and to require
+several consecutive results before reporting a status change"""
+
+import array
+import logging
+import threading
+
+from . import metrics
+from . import persist
+from .nagios_common import Codes
+
+# Nagios keeps the last 21 states of each service
+DEFAULT_SIZE = 21
+DEFAULT_CONFIRMATIONS = 1
+DEFAULT_LOW_THRESHOLD = 25.0
+DEFAULT_HIGH_THRESHOLD = 50.0
+# Weights of the oldest and newest state changes in the flap percentage
+LOW_WEIGHT = 0.8
+HIGH_WEIGHT = 1.2
+# Status reported while a component is flapping
+FLAPPING_STATUS = Codes.WARNING
+
+logger = logging.getLogger(__name__)
+
+
+class History():
+    """Last `size` statuses of a component in a ring buffer of bytes, along with the reported
+    status and the candidate status waiting for confirmation. Memory does not depend on the
+    number of recorded results."""
+
+    __slots__ = ('states', 'index', 'reported', 'candidate', 'streak', 'flapping')
+
+    def __init__(self, size=DEFAULT_SIZE):
+        if size < 3:
+            raise ValueError('history size must be at least 3')
+        self.states = array.array('b', bytes(size))
+        self.index = 0
+        self.reported = None
+        self.candidate = None
+        self.streak = 0
+        self.flapping = False
+
+    def append(self, status):
+        """Record a `nagios_common.Codes`, the first one fills the whole history so that a new
+        component is not seen as flapping"""
+
+        if self.reported is None:
+            self.states = array.array('b', [status.value]) * len(self.states)
+            self.index = 0
+            return
+        self.states[self.index] = status.value
+        self.index = (self.index + 1) % len(self.states)
+
+    def chronological(self):
+        """Return the recorded status values, oldest first"""
+
+        return self.states[self.index:] + self.states[:self.index]
+
+    def flap_percentage(self):
+        """Return the Nagios flap percentage: the state changes in the history, weighted from
+        `LOW_WEIGHT` for the oldest to `HIGH_WEIGHT` for the newest, out of the possible
+        changes"""
+
+        states = self.chronological()
+        changes = len(states) - 1
+        total = 0.0
+        for position in range(changes):
+            if states[position] != states[position + 1]:
+                total += LOW_WEIGHT + (HIGH_WEIGHT - LOW_WEIGHT) * position / (changes - 1)
+        return total * 100 / changes
+
+    def to_dict(self):
+        """Return the history as a JSON-compatible dict"""
+
+        return {
+            'states': ''.join(str(value) for value in self.chronological()),
+            'reported': None if self.reported is None else self.reported.value,
+            'candidate': None if self.candidate is None else self.candidate.value,
+            'streak': self.streak,
+            'flapping': self.flapping,
+        }
+
+    @classmethod
+    def from_dict(cls, content, size=DEFAULT_SIZE):
+        """Build a history from `to_dict` output, keeping its newest `size` states"""
+
+        history = cls(size)
+        states = [int(value) for value in content['states']][-size:]
+        if states:
+            # Pad a shorter history with its oldest state
+            states = [states[0]] * (size - len(states)) + states
+            history.states = array.array('b', states)
+        if content['reported'] is not None:
+            history.reported = Codes(content['reported'])
+        if content['candidate'] is not None:
+            history.candidate = Codes(content['candidate'])
+        history.streak = int(content['streak'])
+        history.flapping = bool(content['flapping'])
+        return history
+
+
+class FlapDetector():
+    """Histories of the components, persisted as a JSON file at `path` if given.
+
+    A component starts flapping when its flap percentage exceeds `high_threshold` and stops when
+    it drops below `low_threshold`; it is reported with `FLAPPING_STATUS` meanwhile. Otherwise a
+    status change is reported once seen `confirmations` times in a row."""
+
+    def __init__(self, size=DEFAULT_SIZE,  # pylint: disable=R0913
+                 confirmations=DEFAULT_CONFIRMATIONS, low_threshold=DEFAULT_LOW_THRESHOLD,
+                 high_threshold=DEFAULT_HIGH_THRESHOLD, path=None):
+        if size < 3 or confirmations < 1:
+            raise ValueError('size must be at least 3 and confirmations positive')
+        if not 0 <= low_threshold <= high_threshold <= 100:
+            raise ValueError('thresholds must be percentages, the low one not above the high one')
+        self.size = size
+        self.confirmations = confirmations
+        self.low_threshold = low_threshold
+        self.high_threshold = high_threshold
+        self.path = path
+        self.histories = {}
+
+        self._dirty = set()
+        self._lock = threading.Lock()
+
+    @property
+    def dirty(self):
+        """True if some histories changed since the last save"""
+
+        return bool(self._dirty)
+
+    def load(self):
+        """Load the history file, return False if it could not be loaded or holds invalid
+        histories"""
+
+        content = persist.load_json(self.path, 'flap history')
+        if content is None:
+            return False
+        try:
+            histories = {key: History.from_dict(entry, self.size)
+                         for key, entry in content.get('components', {}).items()}
+        except (ValueError, KeyError, TypeError) as error:
+            logger.info('flap history %s not loaded: %s', self.path, error)
+            return False
+        with self._lock:
+            self.histories = histories
+        return True
+
+    def is_flapping(self, component_id):
+        """Tell if a component is known to be flapping"""
+
+        with self._lock:
+            history = self.histories.get(str(component_id))
+            return bool(history and history.flapping)
+
+    def record(self, component_id, status):
+        """Record the `nagios_common.Codes` of a check and return the one to report"""
+
+        key = str(component_id)
+        with self._lock:
+            history = self.histories.get(key)
+            if history is None:
+                history = self.histories[key] = History(self.size)
+            history.append(status)
+            self._dirty.add(key)
+
+            percentage = history.flap_percentage()
+            if not history.flapping and percentage > self.high_threshold:
+                history.flapping = True
+                logger.warning('component %s started flapping (%.1f%% state change)',
+                               component_id, percentage)
+            elif history.flapping and percentage < self.low_threshold:
+                history.flapping = False
+                logger.info('component %s stopped flapping (%.1f%% state change)',
+                            component_id, percentage)
+
+            if history.reported is None or status == history.reported:
+                history.reported, history.candidate, history.streak = status, None, 0
+            else:
+                if status == history.candidate:
+                    history.streak += 1
+                else:
+                    history.candidate, history.streak = status, 1
+                if history.streak >= self.confirmations:
+                    history.reported, history.candidate, history.streak = status, None, 0
+                else:
+                    logger.info('component %s status %s not confirmed yet (%d/%d)',
+                                component_id, status.name, history.streak,
+                                self.confirmations)
+            flapping, reported = history.flapping, history.reported
+        metrics.CHECK_FLAPPING.labels(component_id).set(int(flapping))
+        return FLAPPING_STATUS if flapping else reported
+
+    def save(self):
+        """Write the history file atomically. Histories changed by this process are merged with
+        the ones currently on disk, so that concurrent runners do not drop each other's
+        results."""
+
+        with self._lock:
+            content = (persist.load_json(self.path) or {}).get('components', {})
+            content.update((key, self.histories[key].to_dict()) for key in self._dirty)
+            persist.save_json(self.path, {'components': content})
+            self._dirty.clear()
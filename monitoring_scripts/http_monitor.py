@@ -2,15 +2,21 @@
 Nagios-compatible plugin to check a resource availability over HTTP/HTTPS.
 By default it is considered to be in an OK status if the HTTP status code is
 200 and in a CRITICAL status otherwise, different behaviours may be specified
-using optional arguments.
+using optional arguments. When more than one URL is given (as arguments or
+from a file) they are checked concurrently and the worst status is returned,
+followed by one result line per URL.
 """
 
 import argparse
+import concurrent.futures
 import logging
+import re
+import socket
+import time
 from urllib.parse import urlparse
-import requests
 
 from . import nagios_common as nagios
+from . import net
 
 parser = argparse.ArgumentParser(
     prog='cnto-http-monitor',
@@ -19,14 +25,26 @@ parser = argparse.ArgumentParser(
 )
 parser.add_argument(
     'url',
+    nargs='*',
     help='address of resource to monitor (http/https), must be '
          'properlyformatted (i.e. http://sld.tld[:port] or http://127.0.0.1'
          '[:port])'
 )
+parser.add_argument(
+    '--url-file',
+    help='path to a file containing one URL to monitor per line, empty lines and lines starting '
+         'with # are ignored'
+)
+parser.add_argument(
+    '--workers',
+    default=10,
+    type=int,
+    help='maximum number of URLs checked at the same time'
+)
 parser.add_argument(
     '--timeout',
     default=30,
-    type=int,
+    type=float,
     help='maximum time (in seconds) to wait for a response, after which the'
          'resource is considered in CRITICAL status '
 )
@@ -36,12 +54,97 @@ parser.add_argument(
     help='if enabled a 302 status code will result in UNKNOWN status. If'
          'disabled a 302 status code will result in CRITICAL status'
 )
+parser.add_argument(
+    '--expect',
+    default=None,
+    help='send a GET request instead of HEAD and require this text in the response body, which '
+         'is read in chunks only until the text is found'
+)
+parser.add_argument(
+    '--expect-regex',
+    action='store_true',
+    help='interpret --expect as a regular expression, a match must fit in --chunk-size bytes'
+)
+parser.add_argument(
+    '--max-bytes',
+    default=1024 * 1024,
+    type=int,
+    help='maximum number of body bytes read looking for --expect, the resource is in CRITICAL '
+         'status if it is not found within them'
+)
+parser.add_argument(
+    '--chunk-size',
+    default=8192,
+    type=int,
+    help='size (in bytes) of the body chunks read looking for --expect'
+)
+parser.add_argument(
+    '--fresh-connection-every',
+    default=0,
+    type=int,
+    help='when checks run repeatedly from the same process (i.e. cnto-check-daemon) connections '
+         'are kept alive between them, every N-th check of an origin opens a new connection '
+         'anyway so that connection and TLS handshake times are still measured, 0 to never force '
+         'it'
+)
+parser.add_argument(
+    '--warning-latency',
+    type=float,
+    default=None,
+    help='response time (in seconds) above which a WARNING status is triggered'
+)
+parser.add_argument(
+    '--critical-latency',
+    type=float,
+    default=None,
+    help='response time (in seconds) above which a CRITICAL status is triggered'
+)
 parser.add_argument(
     '--debug',
     action='store_true',
     default=False,
     help='display debug messages, DO NOT enable in actual Nagios use'
 )
+net.add_resolver_arguments(parser)
+
+
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+
+class BodyExpectation():
+    """Text, or regular expression if `regex` is set, searched in the first `max_bytes` of a
+    response body streamed in chunks of `chunk_size` bytes. Only the end of the previous chunk is
+    kept to find matches across chunk boundaries, regular expression matches must fit in a
+    chunk."""
+
+    def __init__(self, pattern, regex=False, max_bytes=1024 * 1024, chunk_size=8192):
+        self.pattern = pattern
+        self.max_bytes = max_bytes
+        self.chunk_size = chunk_size
+        if regex:
+            self._search = re.compile(pattern.encode('utf-8')).search
+            self._overlap = chunk_size
+        else:
+            needle = pattern.encode('utf-8')
+            self._search = lambda window: needle in window
+            self._overlap = len(needle) - 1
+
+    def scan(self, response):
+        """Read the body of a streamed `requests.Response` until the pattern is found or
+        `max_bytes` are read, return whether it was found along with the number of bytes read"""
+
+        tail = b''
+        read = 0
+        for chunk in response.iter_content(self.chunk_size):
+            chunk = chunk[:self.max_bytes - read]
+            read += len(chunk)
+            window = tail + chunk
+            if self._search(window):
+                return True, read
+            tail = window[-self._overlap:] if self._overlap > 0 else b''
+            if read >= self.max_bytes:
+                break
+        return False, read
 
 
 def valid_http_url(url):
@@ -53,55 +156,203 @@ def valid_http_url(url):
     return False
 
 
-def main(url, timeout=30, redirect_unknown=True, debug=False):
-    """Actual monitoring execution"""
+def check_url(url, timeout=30, redirect_unknown=True,  # pylint: disable=R0913,R0914
+              session=None, thresholds=None, fresh_every=0, expectation=None):
+    """Check a single resource and return its status as a (nagios.Codes, message, perfdata)
+    tuple, perfdata reports DNS resolution, TCP connect, TLS handshake (HTTPS only), time to
+    first byte and total time. Connect and handshake times are zero when a kept-alive connection
+    is reused. The total time is checked against `thresholds`, a nagios.Thresholds, if provided.
 
-    logging.basicConfig(level=logging.WARNING)
-    logger = logging.getLogger(__name__)
+    The HEAD request is sent through `session` if provided, through the session of the URL
+    origin shared by the process otherwise (see `http_pool.OriginSessions.get` for
+    `fresh_every`). With an `expectation`, a `BodyExpectation`, a streamed GET request is sent
+    instead and a 200 response is OK only if its body matches: the body is read only until it
+    does and the connection is then closed, bytes read and time until the match are reported."""
 
-    if debug:  # pragma: no cover
-        logger.setLevel(logging.DEBUG)
-        logger.info('debug logging enabled')
+    logger = logging.getLogger(__name__)
+    start = time.perf_counter()
 
     # Check if URL is valid
     logger.debug('perform URL validation check')
     if not valid_http_url(url):
-        nagios.plugin_exit(nagios.Codes.UNKNOWN, 'provided URL is not valid')
+        return nagios.Codes.UNKNOWN, 'provided URL is not valid', []
+
+    parsed_url = urlparse(url)
+    port = parsed_url.port or DEFAULT_PORTS.get(parsed_url.scheme, 80)
+    try:
+        address, dns_time = net.resolve(parsed_url.hostname, port, socket.AF_UNSPEC,
+                                        socket.SOCK_STREAM)
+    except socket.gaierror:
+        return nagios.Codes.UNKNOWN, 'cannot resolve host', []
+    perfdata = [nagios.PerfData('dns', dns_time, 's', minimum=0)]
 
     # Send a HEAD request
-    logger.debug('send HEAD request')
+    import requests
+    from . import http_pool
+    session = session or http_pool.SESSIONS.get(url, fresh_every)
+    http_pool.reset_phases()
+    # The connection uses the address resolved above, resolved once and served from the cache
+    http_pool.pin_address(parsed_url.hostname, port, address[0])
     try:
-        response = requests.head(url, timeout=timeout)
+        if expectation:
+            logger.debug('send GET request')
+            response = session.get(url, timeout=timeout, stream=True)
+        else:
+            logger.debug('send HEAD request')
+            response = session.head(url, timeout=timeout)
     except requests.ConnectTimeout:
-        nagios.plugin_exit(nagios.Codes.CRITICAL, 'connection timeout')
+        return nagios.Codes.CRITICAL, 'connection timeout', perfdata
     except requests.ReadTimeout:
-        nagios.plugin_exit(nagios.Codes.CRITICAL, 'no response received before'
-                                                  'timeout')
+        return nagios.Codes.CRITICAL, 'no response received before timeout', perfdata
     except requests.ConnectionError:
-        nagios.plugin_exit(nagios.Codes.UNKNOWN, 'connection error')
+        return nagios.Codes.UNKNOWN, 'connection error', perfdata
+    finally:
+        http_pool.unpin_addresses()
+
+    logger.debug('response received')
+    thresholds = thresholds or nagios.Thresholds()
+    connect_time, tls_time = http_pool.phases()
+    perfdata.append(nagios.PerfData('connect', connect_time, 's', minimum=0))
+    if parsed_url.scheme == 'https':
+        perfdata.append(nagios.PerfData('tls', tls_time, 's', minimum=0))
+    # The request elapsed time includes opening the connection
+    ttfb = max(response.elapsed.total_seconds() - connect_time - tls_time, 0)
+    perfdata.append(nagios.PerfData('ttfb', ttfb, 's', minimum=0))
+    if response.status_code == requests.codes.ok and expectation:
+        # Response is OK only if the body matches
+        code, message = _check_body(response, expectation, perfdata)
+    elif response.status_code == requests.codes.ok:
+        # Response is OK
+        code, message = nagios.Codes.OK, 'status code is %d' % response.status_code
+    elif redirect_unknown and response.status_code == requests.codes.found:
+        # Redirect considered as UNKNOWN
+        code, message = nagios.Codes.UNKNOWN, 'redirection with code %d' % response.status_code
     else:
-        logger.debug('response received')
-        if response.status_code == requests.codes.ok:
-            # Response is OK
-            nagios.plugin_exit(nagios.Codes.OK,
-                               'status code is %d' % response.status_code)
-        elif redirect_unknown and response.status_code == requests.codes.found:
-            # Redirect considered as UNKNOWN
-            nagios.plugin_exit(nagios.Codes.UNKNOWN,
-                               'redirection with code %d' %
-                               response.status_code)
-        else:
-            # Other code, considered not working
-            nagios.plugin_exit(nagios.Codes.CRITICAL,
-                               'status code is %d' % response.status_code)
+        # Other code, considered not working
+        code, message = nagios.Codes.CRITICAL, 'status code is %d' % response.status_code
+    if expectation:
+        response.close()
+    total_time = time.perf_counter() - start
+    perfdata.append(thresholds.perfdata('total', total_time))
+    return thresholds.check(code, message, total_time) + (perfdata,)
 
 
-def http_entry_point():  # pragma: no cover
-    """Console entry point"""
+def _check_body(response, expectation, perfdata):
+    """Scan a streamed response body, add bytes read and time until the match to `perfdata` and
+    return the resulting (nagios.Codes, message)"""
+
+    import requests
+
+    start = time.perf_counter()
+    try:
+        found, read = expectation.scan(response)
+    except requests.RequestException:
+        return nagios.Codes.CRITICAL, 'response body could not be read'
+    perfdata.append(nagios.PerfData('bytes', read, 'B', minimum=0))
+    if not found:
+        return nagios.Codes.CRITICAL, 'expected content not found in %d bytes' % read
+    perfdata.append(nagios.PerfData('match', time.perf_counter() - start, 's', minimum=0))
+    return nagios.Codes.OK, 'expected content found'
+
+
+def check_urls(urls, timeout=30, redirect_unknown=True,  # pylint: disable=R0913
+               workers=10, thresholds=None, fresh_every=0, expectation=None):
+    """Check many resources concurrently, at most `workers` at a time.
+
+    Requests to the same origin share a pooled keep-alive session. Returns a list of
+    (url, nagios.Codes, message, perfdata) tuples in the same order as `urls`, a URL which
+    cannot be requested is UNKNOWN without affecting the others."""
+
+    import requests
+    logger = logging.getLogger(__name__)
 
-    args = parser.parse_args()
+    def check(url):
+        try:
+            return (url,) + check_url(url, timeout, redirect_unknown, thresholds=thresholds,
+                                      fresh_every=fresh_every, expectation=expectation)
+        except (ValueError, requests.RequestException) as error:
+            logger.info('%s cannot be checked: %s', url, error)
+            return url, nagios.Codes.UNKNOWN, str(error), []
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(check, urls))
+
+
+def read_url_file(url_file):
+    """Read URLs from a file, one per line, skipping empty lines and comments"""
+
+    with open(url_file, 'r') as url_lines:
+        return [line.strip() for line in url_lines
+                if line.strip() and not line.strip().startswith('#')]
+
+
+def main(url, timeout=30, redirect_unknown=True,  # pylint: disable=R0913
+         warning_latency=None, critical_latency=None, fresh_every=0, expectation=None,
+         debug=False):
+    """Actual monitoring execution"""
+
+    logging.basicConfig(level=logging.WARNING)
+    logger = logging.getLogger(__name__)
 
-    main(**args.__dict__)
+    if debug:  # pragma: no cover
+        logger.setLevel(logging.DEBUG)
+        logger.info('debug logging enabled')
+
+    thresholds = nagios.Thresholds(warning_latency, critical_latency)
+    nagios.plugin_exit(*check_url(url, timeout, redirect_unknown, thresholds=thresholds,
+                                  fresh_every=fresh_every, expectation=expectation))
+
+
+def batch_main(urls, url_file=None, timeout=30,  # pylint: disable=R0913
+               redirect_unknown=True, workers=10, warning_latency=None, critical_latency=None,
+               fresh_every=0, expectation=None, debug=False):
+    """Batch monitoring execution, the worst status among all URLs is returned"""
+
+    logging.basicConfig(level=logging.WARNING)
+    logger = logging.getLogger(__name__)
+
+    if debug:  # pragma: no cover
+        logger.setLevel(logging.DEBUG)
+        logger.info('debug logging enabled')
+
+    urls = list(urls)
+    if url_file:
+        try:
+            urls.extend(read_url_file(url_file))
+        except OSError as error:
+            nagios.plugin_exit(nagios.Codes.UNKNOWN, 'cannot read URL file: %s' % error)
+    if not urls:
+        nagios.plugin_exit(nagios.Codes.UNKNOWN, 'no URL provided')
+
+    thresholds = nagios.Thresholds(warning_latency, critical_latency)
+    nagios.aggregate_exit(check_urls(urls, timeout, redirect_unknown, workers, thresholds,
+                                     fresh_every, expectation), 'URLs')
+
+
+def http_entry_point(argv=None):  # pragma: no cover
+    """Console entry point, `argv` defaults to the command line arguments"""
+
+    args = parser.parse_args(argv)
+    net.configure_resolver(args.dns_ttl, args.dns_serve_stale, args.dns_cache)
+    expectation = None
+    if args.expect:
+        try:
+            expectation = BodyExpectation(args.expect, args.expect_regex, args.max_bytes,
+                                          args.chunk_size)
+        except re.error as error:
+            parser.error('invalid --expect regular expression: %s' % error)
+
+    if len(args.url) == 1 and not args.url_file:
+        main(args.url[0], timeout=args.timeout, redirect_unknown=args.redirect_unknown,
+             warning_latency=args.warning_latency, critical_latency=args.critical_latency,
+             fresh_every=args.fresh_connection_every, expectation=expectation,
+             debug=args.debug)
+    else:
+        batch_main(args.url, url_file=args.url_file, timeout=args.timeout,
+                   redirect_unknown=args.redirect_unknown, workers=args.workers,
+                   warning_latency=args.warning_latency, critical_latency=args.critical_latency,
+                   fresh_every=args.fresh_connection_every, expectation=expectation,
+                   debug=args.debug)
 
 
 if __name__ == '__main__':  # pragma: no cover
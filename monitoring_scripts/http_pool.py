@@ -0,0 +1,158 @@
+"""Keep-alive HTTP sessions shared by the checks run in a process, one per origin, timing the
+connection phases of every request and connecting to addresses resolved beforehand"""
+
+import socket
+import threading
+import time
+from urllib.parse import urlparse
+
+import requests
+from urllib3 import connection, connectionpool, exceptions
+
+DEFAULT_POOL_SIZE = 10
+
+_phases = threading.local()
+_pinned = threading.local()
+
+
+def reset_phases():
+    """Forget the connection phases timed by the current thread"""
+
+    _phases.connect = 0.0
+    _phases.tls = 0.0
+
+
+def phases():
+    """Return the TCP connect and TLS handshake times (in seconds) of the last connection opened
+    by the current thread since `reset_phases`, both zero if a pooled connection was reused"""
+
+    return getattr(_phases, 'connect', 0.0), getattr(_phases, 'tls', 0.0)
+
+
+def pin_address(host, port, address):
+    """Make the connections opened by the current thread to `host` and `port` use the IP
+    `address` instead of resolving `host` again, until `unpin_addresses`. The TLS server name and
+    the Host header are still `host`."""
+
+    if not hasattr(_pinned, 'addresses'):
+        _pinned.addresses = {}
+    _pinned.addresses[(host, port)] = address
+
+
+def unpin_addresses():
+    """Forget the addresses pinned by the current thread"""
+
+    _pinned.addresses = {}
+
+
+class _TimedConnectionMixin():  # pylint: disable=R0903
+    def _new_conn(self):
+        start = time.perf_counter()
+        try:
+            address = getattr(_pinned, 'addresses', {}).get((self.host, self.port))
+            if address is None:
+                return super()._new_conn()
+            return self._connect_to(address)
+        finally:
+            _phases.connect = time.perf_counter() - start
+
+    def _connect_to(self, address):
+        """Open the socket to a pinned address, raising the errors of `_new_conn`"""
+
+        family = socket.AF_INET6 if ':' in address else socket.AF_INET
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        try:
+            # The address is an IP literal, connect without calling getaddrinfo again
+            for option in self.socket_options or ():
+                sock.setsockopt(*option)
+            if self.timeout is not socket._GLOBAL_DEFAULT_TIMEOUT:  # pylint: disable=W0212
+                sock.settimeout(self.timeout)
+            if self.source_address:
+                sock.bind(self.source_address)
+            sock.connect((address, self.port))
+            return sock
+        except socket.timeout as error:
+            sock.close()
+            raise exceptions.ConnectTimeoutError(
+                self, 'Connection to %s timed out. (connect timeout=%s)' % (self.host,
+                                                                            self.timeout)
+            ) from error
+        except OSError as error:
+            sock.close()
+            raise exceptions.NewConnectionError(
+                self, 'Failed to establish a new connection: %s' % error) from error
+
+
+class _TimedHTTPConnection(_TimedConnectionMixin, connection.HTTPConnection):
+    pass
+
+
+class _TimedHTTPSConnection(_TimedConnectionMixin, connection.HTTPSConnection):
+    def connect(self):
+        start = time.perf_counter()
+        super().connect()
+        # The socket is opened by `_new_conn`, the remaining time is spent in the TLS handshake
+        _phases.tls = max(time.perf_counter() - start - _phases.connect, 0.0)
+
+
+class _TimedHTTPConnectionPool(connectionpool.HTTPConnectionPool):
+    ConnectionCls = _TimedHTTPConnection
+
+
+class _TimedHTTPSConnectionPool(connectionpool.HTTPSConnectionPool):
+    ConnectionCls = _TimedHTTPSConnection
+
+
+class TimedAdapter(requests.adapters.HTTPAdapter):
+    """HTTP adapter whose connections record their connect and TLS handshake times, read back
+    with `phases`"""
+
+    def init_poolmanager(self, *args, **kwargs):  # pylint: disable=W0221
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': _TimedHTTPConnectionPool,
+            'https': _TimedHTTPSConnectionPool,
+        }
+
+
+class OriginSessions():
+    """One keep-alive `requests.Session` per origin, keeping at most `pool_size` idle connections
+    each, so that repeated checks of an origin reuse established connections and only measure
+    the backend latency"""
+
+    def __init__(self, pool_size=DEFAULT_POOL_SIZE):
+        self.pool_size = pool_size
+
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def get(self, url, fresh_every=0):
+        """Return the session of the `url` origin. If `fresh_every` is positive, every
+        `fresh_every`-th call for an origin closes its idle connections first, so that the
+        request opens a new connection and handshake regressions are still measured."""
+
+        parsed_url = urlparse(url)
+        origin = (parsed_url.scheme, parsed_url.netloc)
+        with self._lock:
+            if origin not in self._sessions:
+                session = requests.Session()
+                adapter = TimedAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+                session.mount(parsed_url.scheme + '://', adapter)
+                self._sessions[origin] = [session, adapter, 0]
+            entry = self._sessions[origin]
+            entry[2] += 1
+            if fresh_every > 0 and entry[2] % fresh_every == 0:
+                entry[1].poolmanager.clear()
+            return entry[0]
+
+    def close(self):
+        """Close every session"""
+
+        with self._lock:
+            for session, _, _ in self._sessions.values():
+                session.close()
+            self._sessions.clear()
+
+
+# Sessions shared by every check run in this process
+SESSIONS = OriginSessions()
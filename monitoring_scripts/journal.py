@@ -0,0 +1,288 @@
+"""Write-behind journal of Cachet component updates, drained in batches behind a circuit breaker
+so that an unresponsive Cachet neither loses status changes nor blocks the checks"""
+
+import collections
+import fcntl
+import json
+import logging
+import os
+import threading
+import time
+
+from . import cachet_updater
+from . import metrics
+from . import persist
+
+DEFAULT_FAILURE_THRESHOLD = 3
+DEFAULT_RESET_TIMEOUT = 60.0
+DEFAULT_FLUSH_INTERVAL = 1.0
+# Time (in seconds) a runner waits for the delivery of the journal, and timeout of its requests
+DEFAULT_DRAIN_TIMEOUT = 5.0
+
+logger = logging.getLogger(__name__)
+
+
+class CircuitBreaker():
+    """Stops calling Cachet after `failure_threshold` consecutive failed drains: the circuit is
+    open for `reset_timeout` seconds, then a single update is tried (half-open) and the circuit
+    closes again if it succeeds. With a `path` the state is persisted as a JSON file, shared by
+    the runners of every process."""
+
+    def __init__(self, failure_threshold=DEFAULT_FAILURE_THRESHOLD,
+                 reset_timeout=DEFAULT_RESET_TIMEOUT, path=None):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.path = path
+        self.failures = 0
+        self.opened_at = None
+
+        self._lock = threading.Lock()
+        state = persist.load_json(path, 'circuit breaker state') if path else None
+        if state is not None:
+            try:
+                self.failures, self.opened_at = state['failures'], state['opened_at']
+            except (KeyError, TypeError) as error:
+                logger.info('circuit breaker state %s not loaded: %s', path, error)
+        metrics.CACHET_CIRCUIT_OPEN.labels().set(int(self.opened_at is not None))
+
+    def _save(self):
+        if not self.path:
+            return
+        try:
+            persist.save_json(self.path, {'failures': self.failures, 'opened_at': self.opened_at})
+        except OSError as error:
+            logger.warning('cannot save circuit breaker state %s: %s', self.path, error)
+
+    def state(self, now=None):
+        """Return 'closed', 'open' or 'half-open'"""
+
+        now = time.time() if now is None else now
+        with self._lock:
+            if self.opened_at is None:
+                return 'closed'
+            return 'half-open' if now - self.opened_at >= self.reset_timeout else 'open'
+
+    def record_success(self):
+        """Close the circuit"""
+
+        with self._lock:
+            if self.opened_at is not None:
+                logger.info('Cachet is responsive again, circuit closed')
+            changed = (self.failures, self.opened_at) != (0, None)
+            self.failures, self.opened_at = 0, None
+            if changed:
+                self._save()
+        metrics.CACHET_CIRCUIT_OPEN.labels().set(0)
+
+    def record_failure(self, now=None):
+        """Count a failure, opening the circuit (again) once the threshold is reached"""
+
+        now = time.time() if now is None else now
+        with self._lock:
+            self.failures += 1
+            if self.failures >= self.failure_threshold:
+                if self.opened_at is None:
+                    logger.warning('Cachet is unresponsive, circuit opened for %.0fs',
+                                   self.reset_timeout)
+                self.opened_at = now
+            self._save()
+            opened = self.opened_at is not None
+        metrics.CACHET_CIRCUIT_OPEN.labels().set(int(opened))
+
+
+class UpdateJournal():
+    """Append-only journal of component updates, one JSON line per update, at `path`.
+
+    `put` has the signature of `cachet.Components.put`: the update is written to the journal,
+    synced to disk and acknowledged at once. `drain` sends the journaled updates to Cachet, only
+    the latest status of each component, and removes the ones delivered. Appends and compaction
+    hold an exclusive lock on `<path>.lock`, and a drain holds `<path>.drain` from its read to
+    the rewrite of the journal, so journals may be shared by several processes: a drain started
+    while another one is running is skipped, and appends are never blocked by a slow Cachet.
+
+    Replay is safe after a crash: updates are idempotent, a line truncated by a crash during an
+    append is skipped, and the journal is only rewritten atomically, after delivery."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def _locked(self, suffix='.lock', blocking=True):
+        """Return the open lock file `<path><suffix>` once locked, None if `blocking` is not set
+        and the lock is held by another file description, in this process or another one"""
+
+        lock_file = open(self.path + suffix, 'a')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock_file.close()
+            return None
+        return lock_file
+
+    def put(self, id, status):  # pylint: disable=C0103,W0622
+        """Journal a component update"""
+
+        line = json.dumps({'component': id, 'status': status, 'timestamp': time.time()})
+        with self._locked():
+            with open(self.path, 'ab') as journal_file:
+                if journal_file.tell():
+                    # Terminate a line left truncated by a crash
+                    with open(self.path, 'rb') as reader:
+                        reader.seek(-1, os.SEEK_END)
+                        if reader.read(1) != b'\n':
+                            journal_file.write(b'\n')
+                journal_file.write(line.encode('utf-8') + b'\n')
+                journal_file.flush()
+                os.fsync(journal_file.fileno())
+        metrics.CACHET_JOURNAL_APPENDS.labels().inc()
+
+    def _read(self, offset=0):
+        """Return the updates journaled after `offset` as an OrderedDict of the latest status of
+        each component, along with the end offset"""
+
+        updates = collections.OrderedDict()
+        try:
+            with open(self.path, 'rb') as journal_file:
+                journal_file.seek(offset)
+                content = journal_file.read()
+        except FileNotFoundError:
+            return updates, offset
+        for line in content.splitlines():
+            try:
+                entry = json.loads(line.decode('utf-8'))
+                component_id, status = entry['component'], entry['status']
+            except (ValueError, KeyError, TypeError):
+                logger.warning('skipping malformed journal entry %r', line)
+                continue
+            updates.pop(component_id, None)
+            updates[component_id] = status
+        return updates, offset + len(content)
+
+    def pending(self):
+        """Return the latest journaled status of each component as an OrderedDict"""
+
+        with self._locked():
+            return self._read()[0]
+
+    def drain(self, updater, breaker=None, timeout=None):
+        """Send the latest journaled status of each component through `updater` and remove the
+        delivered ones from the journal. `updater` is either a `cachet_updater.CachetUpdater`,
+        sending the updates concurrently and waited for at most `timeout` seconds per update, or a
+        `cachet.Components` client, sending them one at a time until one fails. Nothing is sent
+        while `breaker`, a `CircuitBreaker`, is open, only the first update is tried while it is
+        half-open.
+
+        Returns the number of updates delivered, 0 if another drain is running."""
+
+        state = breaker.state() if breaker else 'closed'
+        if state == 'open':
+            logger.info('circuit open, Cachet updates kept in the journal')
+            return 0
+        drain_lock = self._locked('.drain', blocking=False)
+        if drain_lock is None:
+            logger.debug('journal already being drained')
+            return 0
+        with drain_lock:
+            # Only the holder of the drain lock rewrites the journal, until it is released the
+            # journal only grows and `offset` stays valid
+            with self._locked():
+                updates, offset = self._read()
+            if not updates:
+                return 0
+            logger.debug('draining %d journaled updates', len(updates))
+            delivered, failed = self._send(updates, updater, state == 'half-open', timeout)
+            if breaker:
+                if failed:
+                    breaker.record_failure()
+                elif delivered:
+                    breaker.record_success()
+            with self._locked():
+                remaining = collections.OrderedDict(
+                    (component_id, status) for component_id, status in updates.items()
+                    if component_id not in delivered)
+                appended, _ = self._read(offset)
+                for component_id, status in appended.items():
+                    remaining.pop(component_id, None)
+                    remaining[component_id] = status
+                self._rewrite(remaining)
+        metrics.CACHET_JOURNAL_PENDING.labels().set(len(remaining))
+        return len(delivered)
+
+    @staticmethod
+    def _send(updates, updater, probe, timeout):
+        """Send `updates`, only the first one if `probe` is set, return the set of delivered
+        component ids and whether any update failed"""
+
+        if not isinstance(updater, cachet_updater.CachetUpdater):
+            delivered = set()
+            for component_id, status in updates.items():
+                try:
+                    updater.put(id=component_id, status=status)
+                except Exception as error:  # pylint: disable=W0703
+                    logger.warning('journaled update of component %s not delivered: %s',
+                                   component_id, error)
+                    return delivered, True
+                delivered.add(component_id)
+            return delivered, False
+        items = list(updates.items())
+        if probe:
+            items = items[:1]
+        futures = [(component_id, updater.submit(component_id, status))
+                   for component_id, status in items]
+        delivered, failed = set(), False
+        for component_id, future in futures:
+            try:
+                future.result(timeout)
+            except Exception as error:  # pylint: disable=W0703
+                logger.warning('journaled update of component %s not delivered: %s',
+                               component_id, error)
+                failed = True
+            else:
+                delivered.add(component_id)
+        if probe and not failed and len(updates) > 1:
+            more, more_failed = UpdateJournal._send(
+                collections.OrderedDict(list(updates.items())[1:]), updater, False, timeout)
+            return delivered | more, more_failed
+        return delivered, failed
+
+    def _rewrite(self, updates):
+        """Replace the journal atomically by `updates`, called with the journal lock held"""
+
+        lines = ''.join(json.dumps({'component': component_id, 'status': status,
+                                    'timestamp': time.time()}) + '\n'
+                        for component_id, status in updates.items())
+        persist.write_atomic(self.path, lambda journal_file: journal_file.write(lines), sync=True)
+
+
+class JournalFlusher():
+    """Drains a journal every `interval` seconds from a background thread"""
+
+    def __init__(self, journal, updater, breaker=None, interval=DEFAULT_FLUSH_INTERVAL,
+                 timeout=None):  # pylint: disable=R0913
+        self.journal = journal
+        self.updater = updater
+        self.breaker = breaker
+        self.interval = interval
+        self.timeout = timeout
+
+        self._stopping = threading.Event()
+        self._thread = threading.Thread(target=self._flush_loop, name='journal-flusher',
+                                        daemon=True)
+
+    def _flush_loop(self):
+        while not self._stopping.wait(self.interval):
+            try:
+                self.journal.drain(self.updater, self.breaker, self.timeout)
+            except Exception:  # pylint: disable=W0703
+                logger.exception('journal drain failed')
+
+    def start(self):
+        """Start draining"""
+
+        self._thread.start()
+
+    def stop(self):
+        """Stop draining, after a last attempt to deliver the journaled updates"""
+
+        self._stopping.set()
+        self._thread.join()
+        self.journal.drain(self.updater, self.breaker, self.timeout)
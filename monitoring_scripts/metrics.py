@@ -0,0 +1,267 @@
+"""Runner metrics in Prometheus text format, exposed through a `/metrics` HTTP listener or
+written for the node exporter textfile collector"""
+
+import bisect
+import collections
+import logging
+import threading
+
+from . import persist
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Upper bounds (in seconds) of the latency histograms buckets
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+logger = logging.getLogger(__name__)
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _format_labels(names, values, extra=''):
+    labels = ['%s="%s"' % (name, str(value).replace('\\', r'\\').replace('"', r'\"'))
+              for name, value in zip(names, values)]
+    if extra:
+        labels.append(extra)
+    return '{%s}' % ','.join(labels) if labels else ''
+
+
+class _Metric():
+    """Base of the metric families: one child per combination of label values, created on first
+    use. Hot paths should keep the child returned by `labels` instead of looking it up again."""
+
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+
+        self._children = {}
+        self._lock = threading.Lock()
+        if not self.labelnames:
+            self.labels()
+
+    def labels(self, *values):
+        """Return the child of the given label values"""
+
+        values = tuple(str(value) for value in values)
+        child = self._children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError('%s expects labels %s' % (self.name, ', '.join(self.labelnames)))
+            with self._lock:
+                child = self._children.setdefault(values, self._new_child())
+        return child
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def _samples(self, values, child):
+        raise NotImplementedError
+
+    def render(self):
+        """Return the metric family in Prometheus text format"""
+
+        lines = ['# HELP %s %s' % (self.name, self.documentation),
+                 '# TYPE %s %s' % (self.name, self.kind)]
+        with self._lock:
+            children = sorted(self._children.items(), key=lambda item: item[0])
+        for values, child in children:
+            lines.extend(self._samples(values, child))
+        return '\n'.join(lines) + '\n'
+
+
+class _Value():
+    __slots__ = ('value', 'lock')
+
+    def __init__(self):
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        """Increase the value"""
+
+        with self.lock:
+            self.value += amount
+
+    def set(self, value):
+        """Replace the value"""
+
+        self.value = value
+
+
+class Counter(_Metric):
+    """Monotonically increasing count, children have an `inc(amount=1)` method"""
+
+    kind = 'counter'
+
+    def _new_child(self):
+        return _Value()
+
+    def _samples(self, values, child):
+        return ['%s%s %s' % (self.name, _format_labels(self.labelnames, values),
+                             _format_value(child.value))]
+
+
+class Gauge(Counter):
+    """Value which can go up and down, children have `set(value)` and `inc(amount=1)` methods"""
+
+    kind = 'gauge'
+
+
+class _Buckets():
+    __slots__ = ('bounds', 'counts', 'sum', 'lock')
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        """Count an observation in its bucket"""
+
+        index = bisect.bisect_left(self.bounds, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+
+
+class Histogram(_Metric):
+    """Distribution of observations in preallocated buckets, children have an `observe(value)`
+    method which only increments the matching bucket"""
+
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames)
+
+    def _new_child(self):
+        return _Buckets(self.buckets)
+
+    def _samples(self, values, child):
+        with child.lock:
+            counts, total = list(child.counts), child.sum
+        samples = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += count
+            samples.append('%s_bucket%s %d' % (
+                self.name, _format_labels(self.labelnames, values, 'le="%s"' % _format_value(
+                    bound)), cumulative))
+        labels = _format_labels(self.labelnames, values)
+        samples.append('%s_sum%s %s' % (self.name, labels, _format_value(total)))
+        samples.append('%s_count%s %d' % (self.name, labels, cumulative))
+        return samples
+
+
+class Registry():
+    """Collection of metric families rendered together"""
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        """Add a metric family and return it"""
+
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        """Return every metric family in Prometheus text format"""
+
+        return ''.join(metric.render() for metric in self.metrics)
+
+    def write_textfile(self, path):
+        """Write the metrics atomically to `path`, for the node exporter textfile collector"""
+
+        content = self.render()
+        persist.write_atomic(path, lambda metrics_file: metrics_file.write(content), mode=0o644)
+
+    def serve(self, host, port):
+        """Expose the metrics on `http://host:port/metrics` from a background thread, return the
+        server, stopped with its `shutdown` method"""
+
+        import http.server
+        import socketserver
+
+        registry = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            """Serve the rendered metrics"""
+
+            def do_GET(self):  # pylint: disable=C0103
+                """Answer GET requests"""
+
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                payload = registry.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', CONTENT_TYPE)
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, *args):  # pylint: disable=W0221
+                logger.debug(*args)
+
+        class Server(socketserver.ThreadingMixIn, http.server.HTTPServer):
+            """Serve each request from a daemon thread"""
+
+            daemon_threads = True
+
+        server = Server((host, port), Handler)
+        threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+        logger.info('metrics exposed on http://%s:%d/metrics', *server.server_address[:2])
+        return server
+
+
+REGISTRY = Registry()
+
+PROBE_DURATION = REGISTRY.register(Histogram(
+    'cnto_probe_duration_seconds', 'Duration of plugin attempts', ['component']))
+PROBE_ATTEMPTS = REGISTRY.register(Counter(
+    'cnto_probe_attempts_total', 'Plugin attempts', ['component']))
+PROBE_RETRIES = REGISTRY.register(Counter(
+    'cnto_probe_retries_total', 'Plugin attempts following a not OK status', ['component']))
+CHECK_STATUS = REGISTRY.register(Gauge(
+    'cnto_check_status', 'Last Nagios status of checks: 0 OK, 1 WARNING, 2 CRITICAL, 3 UNKNOWN',
+    ['component']))
+CHECK_FLAPPING = REGISTRY.register(Gauge(
+    'cnto_check_flapping', 'Whether checks are flapping between statuses', ['component']))
+CACHET_UPDATE_DURATION = REGISTRY.register(Histogram(
+    'cnto_cachet_update_duration_seconds', 'Duration of Cachet component updates'))
+CACHET_UPDATE_ERRORS = REGISTRY.register(Counter(
+    'cnto_cachet_update_errors_total', 'Failed Cachet component updates'))
+CACHET_POINT_ERRORS = REGISTRY.register(Counter(
+    'cnto_cachet_point_errors_total', 'Metric points which Cachet failed to store'))
+CACHET_POINTS_DROPPED = REGISTRY.register(Counter(
+    'cnto_cachet_points_dropped_total', 'Metric samples dropped because the buffer was full'))
+CACHET_JOURNAL_APPENDS = REGISTRY.register(Counter(
+    'cnto_cachet_journal_appends_total', 'Cachet component updates written to the journal'))
+CACHET_JOURNAL_PENDING = REGISTRY.register(Gauge(
+    'cnto_cachet_journal_pending', 'Journaled Cachet component updates left after the last drain'))
+CACHET_CIRCUIT_OPEN = REGISTRY.register(Gauge(
+    'cnto_cachet_circuit_open', 'Whether Cachet updates are suspended by the circuit breaker'))
+SCHEDULER_LAG = REGISTRY.register(Histogram(
+    'cnto_scheduler_lag_seconds', 'Delay between the due time of checks and their start'))
+
+
+class ProbeMetrics(collections.namedtuple('ProbeMetrics', ['attempts', 'retries', 'duration'])):
+    """Children of the probe metrics of a component, looked up once per check execution"""
+
+    __slots__ = ()
+
+    @classmethod
+    def of(cls, component_id):
+        """Return the probe metrics of a component"""
+
+        return cls(PROBE_ATTEMPTS.labels(component_id), PROBE_RETRIES.labels(component_id),
+                   PROBE_DURATION.labels(component_id))
@@ -1,5 +1,9 @@
 """Provide common reference to Nagios standards to every plugin"""
 
+import collections
+import contextlib
+import re
+import threading
 from enum import Enum
 
 
@@ -12,13 +16,192 @@ class Codes(Enum):
     UNKNOWN = 3
 
 
-def plugin_exit(code, message=None):
+def _format_number(number):
+    """Format a perfdata number without exponent notation and trailing zeros, ranges parsed
+    from plugin output are kept as is"""
+
+    if isinstance(number, (int, str)):
+        return str(number)
+    return ('%.6f' % number).rstrip('0').rstrip('.')
+
+
+class PerfData(collections.namedtuple('PerfData', ['label', 'value', 'uom', 'warn', 'crit',
+                                                   'minimum', 'maximum'])):
+    """Performance data point, formatted as 'label'=value[UOM];warn;crit;min;max according to
+    Nagios plugins guidelines. Thresholds and boundaries are optional."""
+
+    __slots__ = ()
+
+    def __new__(cls, label, value, uom='', warn=None, crit=None,  # pylint: disable=R0913
+                minimum=None, maximum=None):
+        return super().__new__(cls, label, value, uom, warn, crit, minimum, maximum)
+
+    def __str__(self):
+        label = self.label
+        if any(character in label for character in " '="):
+            label = "'" + label.replace("'", "''") + "'"
+        fields = [_format_number(self.value) + self.uom]
+        fields.extend('' if field is None else _format_number(field)
+                      for field in (self.warn, self.crit, self.minimum, self.maximum))
+        return label + '=' + ';'.join(fields).rstrip(';')
+
+
+class Thresholds(collections.namedtuple('Thresholds', ['warning', 'critical'])):
+    """Latency thresholds (in seconds) above which an alive service is in WARNING or CRITICAL
+    status, either one may be None to disable it. Other measures, such as packet loss, may be
+    checked giving their name and unit to `check`."""
+
+    __slots__ = ()
+
+    def __new__(cls, warning=None, critical=None):
+        return super().__new__(cls, warning, critical)
+
+    def check(self, code, message, latency, measure='response time', uom='s'):
+        """Return a (Codes, message) tuple, an OK `code` is turned into WARNING or CRITICAL if
+        `latency` exceeds the thresholds"""
+
+        if code != Codes.OK:
+            return code, message
+        if self.critical is not None and latency >= self.critical:
+            return Codes.CRITICAL, '%s, %s %.3f%s above critical threshold' % (
+                message, measure, latency, uom)
+        if self.warning is not None and latency >= self.warning:
+            return Codes.WARNING, '%s, %s %.3f%s above warning threshold' % (
+                message, measure, latency, uom)
+        return code, message
+
+    def perfdata(self, label, value, uom='s'):
+        """Build a PerfData for a latency measure, including thresholds"""
+
+        return PerfData(label, value, uom, warn=self.warning, crit=self.critical, minimum=0)
+
+
+class PluginExit(SystemExit):
+    """Raised by plugin_exit to end a plugin, carries the plugin status and its output line"""
+
+    def __init__(self, status, output=None):
+        super().__init__(status.value)
+        self.status = status
+        self.output = output
+
+
+_capture = threading.local()
+
+
+@contextlib.contextmanager
+def captured_output():
+    """Within this context plugin_exit does not print anything in the current thread, the plugin
+    output is only available through the raised PluginExit. Used to run plugins in-process."""
+
+    previous = getattr(_capture, 'active', False)
+    _capture.active = True
+    try:
+        yield
+    finally:
+        _capture.active = previous
+
+
+def plugin_exit(code, message=None, perfdata=None):
     """Common method to end a Nagios plugin. If no message is specified the
-    service status will not be printed."""
+    service status will not be printed. Performance data, a list of PerfData,
+    is appended to the first line of the message."""
 
     if not isinstance(code, Codes):
         raise ValueError('code must be an instance of'
                          'monitoring_scripts.nagios_common.Codes')
+    output = None
     if message:
-        print(code.name + ': ' + message)
-    exit(code.value)
+        first_line, _, long_output = message.partition('\n')
+        output = code.name + ': ' + first_line
+        if perfdata:
+            output += ' | ' + ' '.join(str(point) for point in perfdata)
+        if long_output:
+            output += '\n' + long_output
+        if not getattr(_capture, 'active', False):
+            print(output)
+    raise PluginExit(code, output)
+
+
+class PluginOutput(collections.namedtuple('PluginOutput', ['text', 'long_output',
+                                                           'perfdata'])):
+    """Parsed output of a Nagios plugin: the first line status text, the following lines of long
+    output and the performance data found on the first line and after the long output, as a list
+    of PerfData"""
+
+    __slots__ = ()
+
+
+_PERFDATA_POINT = re.compile(r"\s*(?:'((?:[^']|'')+)'|([^'=\s]+))=(\S*)")
+_PERFDATA_VALUE = re.compile(r'^([-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?)(\D*)$')
+
+
+def _parse_number(field):
+    """Parse a perfdata threshold or boundary, ranges such as '10:20' are kept as text"""
+
+    if not field:
+        return None
+    try:
+        number = float(field)
+    except ValueError:
+        return field
+    return int(number) if number.is_integer() and '.' not in field else number
+
+
+def parse_perfdata(text):
+    """Parse space-separated perfdata points into a list of PerfData, points without a numeric
+    value (such as 'U', undetermined) are skipped"""
+
+    points = []
+    position = 0
+    while position < len(text.rstrip()):
+        match = _PERFDATA_POINT.match(text, position)
+        if not match:
+            break
+        position = match.end()
+        label = match.group(2) or match.group(1).replace("''", "'")
+        fields = match.group(3).split(';')
+        value = _PERFDATA_VALUE.match(fields[0])
+        if not value:
+            continue
+        fields = [_parse_number(field) for field in fields[1:5]]
+        points.append(PerfData(label, _parse_number(value.group(1)), value.group(2),
+                               *fields))
+    return points
+
+
+def parse_output(output):
+    """Parse the output of a Nagios plugin into a PluginOutput. The first line holds the status
+    text and its perfdata after a '|', the long output lines follow and may end with more
+    perfdata after a '|'."""
+
+    first_line, _, long_output = (output or '').partition('\n')
+    text, _, perfdata = first_line.partition('|')
+    long_output, _, more_perfdata = long_output.partition('|')
+    return PluginOutput(text.strip(), long_output.strip(),
+                        parse_perfdata(perfdata) + parse_perfdata(more_perfdata))
+
+
+# Statuses ordered from the least to the most severe, used to aggregate multiple results
+SEVERITY_ORDER = (Codes.OK, Codes.UNKNOWN, Codes.WARNING, Codes.CRITICAL)
+
+
+def worst_status(codes):
+    """Return the most severe of the given codes, OK if none is given"""
+
+    return max(codes, key=SEVERITY_ORDER.index, default=Codes.OK)
+
+
+def aggregate_exit(results, subject='targets'):
+    """End a plugin which checked many targets. The worst status is returned, the first output
+    line counts the `subject` not in OK status and one line per target follows.
+
+    `results` is a list of (target name, Codes, message, perfdata) tuples, perfdata labels are
+    prefixed with the target name."""
+
+    failing = sum(1 for result in results if result[1] != Codes.OK)
+    lines = ['%d of %d %s not OK' % (failing, len(results), subject)]
+    perfdata = []
+    for name, code, message, points in results:
+        lines.append('%s: %s %s' % (code.name, name, message))
+        perfdata.extend(point._replace(label=name + ' ' + point.label) for point in points or [])
+    plugin_exit(worst_status(result[1] for result in results), '\n'.join(lines), perfdata)
@@ -0,0 +1,152 @@
+"""Networking helpers shared by the monitoring plugins"""
+
+import logging
+import socket
+import threading
+import time
+
+from . import persist
+
+DEFAULT_DNS_TTL = 300
+
+logger = logging.getLogger(__name__)
+
+_resolver_lock = threading.Lock()
+_resolver_cache = None
+
+
+def parse_target(target, default_port):
+    """Split a `host[:port]` string into a (host, port) tuple, using `default_port` if no port is
+    given (the port is mandatory if `default_port` is None). IPv6 addresses must be enclosed in
+    brackets when a port is given, i.e. `[::1]:9987`.
+
+    Raises ValueError if the port is not a valid number."""
+
+    host, port = target, default_port
+    if target.startswith('['):
+        host, _, remainder = target[1:].partition(']')
+        if remainder.startswith(':'):
+            port = remainder[1:]
+    elif target.count(':') == 1:
+        host, port = target.split(':')
+    if port is None:
+        raise ValueError('missing port in target %s' % target)
+    port = int(port)
+    if not host or not 0 < port < 65536:
+        raise ValueError('invalid target %s' % target)
+    return host, port
+
+
+class ResolverCache():
+    """Resolved socket addresses kept for `ttl` seconds. If `serve_stale` is positive an expired
+    address is still returned, with a warning, when resolving it again fails within that many
+    seconds after its expiration. With a `path` the cache is persisted as a JSON file, shared by
+    the plugin executions of every process."""
+
+    def __init__(self, ttl=DEFAULT_DNS_TTL, serve_stale=0, path=None):
+        self.ttl = ttl
+        self.serve_stale = serve_stale
+        self.path = path
+        self.entries = {}
+
+        self._lock = threading.Lock()
+
+    def load(self):
+        """Merge the addresses of the cache file, return False if it could not be loaded"""
+
+        entries = persist.load_json(self.path, 'DNS cache')
+        if entries is None:
+            return False
+        with self._lock:
+            self.entries.update(entries)
+        return True
+
+    def save(self):
+        """Write the cache file atomically, merged with the entries currently on disk"""
+
+        with self._lock:
+            entries = persist.load_json(self.path) or {}
+            entries.update(self.entries)
+            persist.save_json(self.path, entries)
+
+    def resolve(self, host, port, family, socktype, now=None):
+        """Return the cached address of `host`, resolving it again if expired. Raises
+        socket.gaierror if the resolution fails and no address can be served."""
+
+        now = time.time() if now is None else now
+        key = '%s|%d|%d|%d' % (host, port, family, socktype)
+        with self._lock:
+            entry = self.entries.get(key)
+        if entry and now - entry['timestamp'] < self.ttl:
+            return tuple(entry['address'])
+
+        try:
+            address = socket.getaddrinfo(host, port, family, socktype)[0][4]
+        except socket.gaierror as error:
+            if entry and now - entry['timestamp'] < self.ttl + self.serve_stale:
+                logger.warning('cannot resolve %s (%s), using stale address %s', host, error,
+                               entry['address'][0])
+                return tuple(entry['address'])
+            raise
+        with self._lock:
+            self.entries[key] = {'address': list(address), 'timestamp': now}
+        if self.path:
+            try:
+                self.save()
+            except OSError as error:
+                logger.warning('cannot save DNS cache %s: %s', self.path, error)
+        return address
+
+
+def configure_resolver(ttl=DEFAULT_DNS_TTL, serve_stale=0, path=None):
+    """Cache the resolutions made through `resolve` in a `ResolverCache`, kept across calls with
+    the same settings so that plugins executed in-process share it. A zero `ttl` disables it."""
+
+    global _resolver_cache  # pylint: disable=W0603
+    with _resolver_lock:
+        if not ttl:
+            _resolver_cache = None
+        elif _resolver_cache is None or (_resolver_cache.ttl, _resolver_cache.serve_stale,
+                                         _resolver_cache.path) != (ttl, serve_stale, path):
+            _resolver_cache = ResolverCache(ttl, serve_stale, path)
+            if path:
+                _resolver_cache.load()
+        return _resolver_cache
+
+
+def add_resolver_arguments(parser):
+    """Add the options of `configure_resolver` to a plugin argument parser"""
+
+    parser.add_argument(
+        '--dns-ttl',
+        type=float,
+        default=DEFAULT_DNS_TTL,
+        help='time (in seconds) a resolved address is reused, 0 disables caching'
+    )
+    parser.add_argument(
+        '--dns-serve-stale',
+        type=float,
+        default=0,
+        help='time (in seconds) after expiration during which a cached address is still used, '
+             'with a warning, if resolving it again fails'
+    )
+    parser.add_argument(
+        '--dns-cache',
+        default=None,
+        help='JSON file persisting resolved addresses across executions'
+    )
+
+
+def resolve(host, port, family=socket.AF_INET, socktype=socket.SOCK_DGRAM):
+    """Resolve `host` to the first matching socket address, timing the resolution. The address
+    is served from the cache set up by `configure_resolver`, if any.
+
+    Returns an (address, elapsed seconds) tuple, raises socket.gaierror on failure."""
+
+    start = time.perf_counter()
+    cache = _resolver_cache
+    if cache is None:
+        address = socket.getaddrinfo(host, port, family, socktype)[0][4]
+    else:
+        address = cache.resolve(host, port, family, socktype)
+    return address, time.perf_counter() - start
@@ -0,0 +1,49 @@
+"""State files kept across plugin and runner executions, replaced atomically so that concurrent
+processes never read a partially written file"""
+
+import json
+import logging
+import os
+import tempfile
+
+logger = logging.getLogger(__name__)
+
+
+def write_atomic(path, write, mode=None, sync=False):
+    """Replace the file at `path` by the text written by `write(file)` to a temporary file of the
+    same directory, with permissions `mode` if given (0600 otherwise). With `sync` set the
+    content is on disk before the replacement."""
+
+    directory = os.path.dirname(os.path.abspath(path))
+    file_descriptor, temporary_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with os.fdopen(file_descriptor, 'w') as temporary_file:
+            write(temporary_file)
+            if sync:
+                temporary_file.flush()
+                os.fsync(temporary_file.fileno())
+        if mode is not None:
+            os.chmod(temporary_path, mode)
+        os.replace(temporary_path, path)
+    except Exception:
+        os.unlink(temporary_path)
+        raise
+
+
+def save_json(path, content):
+    """Replace the file at `path` by `content` serialized as JSON"""
+
+    write_atomic(path, lambda json_file: json.dump(content, json_file))
+
+
+def load_json(path, description=None):
+    """Return the content of the JSON file at `path`, None if it does not exist or is not valid
+    JSON. The failure is logged if a `description` of the file is given."""
+
+    try:
+        with open(path, 'r') as json_file:
+            return json.load(json_file)
+    except (OSError, ValueError) as error:
+        if description:
+            logger.info('%s %s not loaded: %s', description, path, error)
+        return None
@@ -0,0 +1,156 @@
+"""Bounded pool running external Nagios plugins as subprocesses"""
+
+import collections
+import logging
+import os
+import selectors
+import signal
+import subprocess
+import threading
+import time
+
+from . import nagios_common
+
+# Nagios truncates plugin output at 8 KiB
+DEFAULT_OUTPUT_LIMIT = 8192
+DEFAULT_CONCURRENCY = 16
+# Time (in seconds) left to a plugin between SIGTERM and SIGKILL
+DEFAULT_KILL_GRACE = 2.0
+# Interval (in seconds) between two checks of the cancellation of a plugin
+CANCEL_POLL_INTERVAL = 0.05
+
+PluginResult = collections.namedtuple('PluginResult', ['returncode', 'output'])
+
+logger = logging.getLogger(__name__)
+
+
+class PluginPool():
+    """Runs external plugins as subprocesses, at most `concurrency` at a time, other callers wait
+    for a slot. Each plugin runs in its own session and process group: once its timeout is
+    exceeded the group receives SIGTERM then, if the plugin did not exit within `kill_grace`
+    seconds, SIGKILL. Standard output is captured up to `output_limit` bytes, the rest is read
+    and dropped so that plugins never block on a full pipe.
+
+    Every process is waited for before its slot is released, a pool holds at most
+    `concurrency` children and pipes."""
+
+    def __init__(self, concurrency=DEFAULT_CONCURRENCY, output_limit=DEFAULT_OUTPUT_LIMIT,
+                 kill_grace=DEFAULT_KILL_GRACE):
+        self.concurrency = concurrency
+        self.output_limit = output_limit
+        self.kill_grace = kill_grace
+
+        self._slots = threading.BoundedSemaphore(concurrency)
+
+    def run(self, invocation, timeout=None, cancel=None):
+        """Run a plugin and return its `PluginResult`, a plugin which runs for more than `timeout`
+        seconds is killed and reported CRITICAL. If `cancel`, a `threading.Event`, is set
+        before the plugin completes it is killed, or not started if waiting for a slot, and
+        reported UNKNOWN. Raises OSError if the plugin cannot be executed."""
+
+        if not self._acquire(cancel):
+            return PluginResult(nagios_common.Codes.UNKNOWN.value, 'UNKNOWN: plugin cancelled')
+        try:
+            with subprocess.Popen(invocation, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                                  start_new_session=True) as process:
+                deadline = None if timeout is None else time.monotonic() + timeout
+                output, completed = self._read(process, deadline, cancel)
+                if completed:
+                    try:
+                        process.wait(None if deadline is None else
+                                     max(deadline - time.monotonic(), 0))
+                    except subprocess.TimeoutExpired:
+                        completed = False
+                if not completed:
+                    self._kill(process)
+                    if cancel is not None and cancel.is_set():
+                        logger.info('plugin %s cancelled', invocation[0])
+                        return PluginResult(nagios_common.Codes.UNKNOWN.value,
+                                            'UNKNOWN: plugin cancelled')
+                    logger.warning('plugin %s killed after %.3f seconds', invocation[0], timeout)
+                    return PluginResult(nagios_common.Codes.CRITICAL.value,
+                                        'CRITICAL: plugin timed out')
+        finally:
+            self._slots.release()
+        return PluginResult(process.returncode, output.decode('utf-8', 'replace').strip())
+
+    def _acquire(self, cancel):
+        """Wait for a slot, return False if `cancel` is set meanwhile"""
+
+        if cancel is None:
+            return self._slots.acquire()
+        while not cancel.is_set():
+            if self._slots.acquire(timeout=CANCEL_POLL_INTERVAL):
+                return True
+        return False
+
+    def _read(self, process, deadline, cancel=None):
+        """Read the plugin output until it is closed, `deadline` is reached or `cancel` is set,
+        return the captured output and whether it was closed in time"""
+
+        chunks, size = [], 0
+        file_descriptor = process.stdout.fileno()
+        with selectors.DefaultSelector() as selector:
+            selector.register(file_descriptor, selectors.EVENT_READ)
+            while True:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if (remaining is not None and remaining <= 0) or \
+                        (cancel is not None and cancel.is_set()):
+                    return b''.join(chunks), False
+                if cancel is not None:
+                    remaining = CANCEL_POLL_INTERVAL if remaining is None else \
+                        min(remaining, CANCEL_POLL_INTERVAL)
+                if not selector.select(remaining):
+                    continue
+                data = os.read(file_descriptor, 65536)
+                if not data:
+                    return b''.join(chunks), True
+                if size < self.output_limit:
+                    chunks.append(data[:self.output_limit - size])
+                    if size + len(data) > self.output_limit:
+                        logger.info('plugin output truncated to %d bytes', self.output_limit)
+                size += len(data)
+
+    def _kill(self, process):
+        """Terminate the process group of a plugin, escalating to SIGKILL after the grace time"""
+
+        try:
+            os.killpg(process.pid, signal.SIGTERM)
+            process.wait(self.kill_grace)
+        except ProcessLookupError:
+            pass
+        except subprocess.TimeoutExpired:
+            logger.info('plugin %d ignored SIGTERM', process.pid)
+        # Children left behind by the plugin are in the same group
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        process.wait()
+
+
+_pool_lock = threading.Lock()
+_pool = None
+
+
+def configure(concurrency=DEFAULT_CONCURRENCY, output_limit=DEFAULT_OUTPUT_LIMIT,
+              kill_grace=DEFAULT_KILL_GRACE):
+    """Return the `PluginPool` of the process, replaced if the settings differ from the ones of
+    the current pool"""
+
+    global _pool  # pylint: disable=W0603
+    with _pool_lock:
+        if _pool is None or (_pool.concurrency, _pool.output_limit, _pool.kill_grace) != (
+                concurrency, output_limit, kill_grace):
+            _pool = PluginPool(concurrency, output_limit, kill_grace)
+        return _pool
+
+
+def pool():
+    """Return the `PluginPool` of the process, created with the default settings if it has not
+    been configured"""
+
+    with _pool_lock:
+        if _pool is not None:
+            return _pool
+    return configure()
@@ -0,0 +1,110 @@
+"""Retry policies for plugin executions: sequential attempts with exponential backoff and jitter
+bounded by an overall deadline, or concurrent attempts deciding the status by quorum"""
+
+import collections
+import random
+import time
+
+from .nagios_common import Codes, SEVERITY_ORDER
+
+# Time budget (in seconds) below which an attempt is not worth starting
+MIN_ATTEMPT_TIMEOUT = 0.1
+
+QUORUM_DECISIONS = ('majority', 'first-ok')
+
+
+class RetryPolicy(collections.namedtuple('RetryPolicy', ['retries', 'interval', 'backoff',
+                                                         'max_interval', 'jitter', 'deadline'])):
+    """Up to `retries` attempts after the first one. The n-th retry waits
+    `interval * backoff ** (n - 1)` seconds, capped to `max_interval` and shortened by a random
+    fraction up to `jitter` (between 0 and 1). If `deadline` is set every attempt, waits included,
+    must complete within that many seconds from the first one."""
+
+    __slots__ = ()
+
+    def __new__(cls, retries=5, interval=0.5, backoff=1.0,  # pylint: disable=R0913
+                max_interval=None, jitter=0.0, deadline=None):
+        if retries < 0 or interval < 0 or backoff < 1:
+            raise ValueError('retries and interval must not be negative, backoff must be >= 1')
+        if not 0 <= jitter <= 1:
+            raise ValueError('jitter must be between 0 and 1')
+        if deadline is not None and deadline <= 0:
+            raise ValueError('deadline must be positive')
+        return super().__new__(cls, retries, interval, backoff, max_interval, jitter, deadline)
+
+    def delay(self, retry):
+        """Wait before the given retry (starting from 1), without jitter"""
+
+        delay = self.interval * self.backoff ** (retry - 1)
+        if self.max_interval is not None:
+            delay = min(delay, self.max_interval)
+        return delay
+
+    def attempts(self):
+        """Generate one item per attempt, waiting between them: the attempt number (starting from
+        0) and the time budget for that attempt, None without deadline.
+
+        The remaining time is split evenly between the remaining attempts, after setting aside
+        the waits between them. Attempts stop early when the deadline leaves no usable budget."""
+
+        start = time.monotonic()
+        for attempt in range(self.retries + 1):
+            if attempt:
+                delay = self.delay(attempt) * (1 - self.jitter * random.random())
+                if self.deadline is not None:
+                    delay = min(delay, max(start + self.deadline - time.monotonic(), 0))
+                time.sleep(delay)
+            if self.deadline is None:
+                yield attempt, None
+                continue
+
+            remaining = start + self.deadline - time.monotonic()
+            if remaining < MIN_ATTEMPT_TIMEOUT and attempt:
+                return
+            waits = sum(self.delay(retry) for retry in range(attempt + 1, self.retries + 1))
+            budget = max(remaining - waits, 0) / (self.retries + 1 - attempt)
+            yield attempt, min(max(budget, MIN_ATTEMPT_TIMEOUT), max(remaining, 0))
+
+
+class QuorumPolicy(collections.namedtuple('QuorumPolicy', ['attempts', 'decision', 'stagger',
+                                                           'timeout'])):
+    """`attempts` concurrent attempts, started `stagger` seconds apart, each one limited to
+    `timeout` seconds if set. With the `majority` decision a status is final as soon as more than
+    half of the attempts report it, with `first-ok` as soon as one attempt reports OK."""
+
+    __slots__ = ()
+
+    def __new__(cls, attempts=3, decision='majority', stagger=0.005, timeout=None):
+        if attempts < 1 or stagger < 0:
+            raise ValueError('attempts must be positive and stagger not negative')
+        if decision not in QUORUM_DECISIONS:
+            raise ValueError('decision must be one of ' + ', '.join(QUORUM_DECISIONS))
+        if timeout is not None and timeout <= 0:
+            raise ValueError('timeout must be positive')
+        return super().__new__(cls, attempts, decision, stagger, timeout)
+
+    def decide(self, statuses, final=False):
+        """Return the status decided by the `nagios_common.Codes` collected so far, None if it is
+        not decided yet. If `final` is set every attempt is done and a status is always returned:
+        without quorum the most reported status wins, ties going to the least severe one so that
+        an outage is not reported unless confirmed."""
+
+        counts = collections.Counter(statuses)
+        if self.decision == 'first-ok' and counts[Codes.OK]:
+            return Codes.OK
+        if self.decision == 'majority':
+            for status, count in counts.items():
+                if count * 2 > self.attempts:
+                    return status
+        if not final or not counts:
+            return None
+        return max(counts, key=lambda status: (counts[status], -SEVERITY_ORDER.index(status)))
+
+
+def single_attempt(policy):
+    """Return a `RetryPolicy` running a single attempt within the time budget of `policy`, either
+    a `RetryPolicy` or a `QuorumPolicy`"""
+
+    if isinstance(policy, QuorumPolicy):
+        return RetryPolicy(retries=0, deadline=policy.timeout)
+    return policy._replace(retries=0)
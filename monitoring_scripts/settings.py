@@ -1,6 +1,59 @@
 """Wrapper for ConfigParser"""
 
+import collections
 import configparser
+import shlex
+
+from .nagios_common import Codes
+from .retry import QuorumPolicy, RetryPolicy
+
+CHECK_SECTION_PREFIX = 'Check:'
+STATUS_MAPPING_SECTION = 'StatusMapping'
+# Operational, Performance Issues, Partial Outage, Major Outage
+CACHET_STATUSES = (1, 2, 3, 4)
+
+
+class Check(collections.namedtuple('Check', ['name', 'script', 'args', 'component_id', 'interval',
+                                             'retry_policy', 'pass_timeout', 'metrics'])):
+    """Check declared in a `[Check:<name>]` section, `metrics` maps perfdata labels of the plugin
+    output to Cachet metric ids"""
+
+    __slots__ = ()
+
+    def __new__(cls, name, script, args, component_id, interval,  # pylint: disable=R0913
+                retry_policy, pass_timeout, metrics=None):
+        return super().__new__(cls, name, script, args, component_id, interval, retry_policy,
+                               pass_timeout, metrics or {})
+
+
+def parse_metrics(mapping):
+    """Parse comma-separated `label=metric id` pairs into a dict, raise ValueError if malformed"""
+
+    metrics = {}
+    for pair in mapping.split(','):
+        if not pair.strip():
+            continue
+        label, separator, metric_id = pair.rpartition('=')
+        if not separator or not label.strip():
+            raise ValueError('invalid metric mapping %s' % pair.strip())
+        metrics[label.strip()] = int(metric_id)
+    return metrics
+
+
+ChecksDiff = collections.namedtuple('ChecksDiff', ['added', 'removed', 'modified'])
+
+
+def diff_checks(old, new):
+    """Compare two lists of `Check` by name, return the sorted names of the added, removed and
+    modified checks as a `ChecksDiff`"""
+
+    old = {check.name: (check, type(check.retry_policy)) for check in old}
+    new = {check.name: (check, type(check.retry_policy)) for check in new}
+    return ChecksDiff(
+        added=sorted(set(new) - set(old)),
+        removed=sorted(set(old) - set(new)),
+        modified=sorted(name for name in set(old) & set(new) if old[name] != new[name]),
+    )
 
 
 class RunnerConfigParser(configparser.ConfigParser):  # pylint: disable=R0901
@@ -15,3 +68,73 @@ class RunnerConfigParser(configparser.ConfigParser):  # pylint: disable=R0901
     def _read(self, *args, **kwargs):
         self._loaded = True
         return super()._read(*args, **kwargs)
+
+    def checks(self):
+        """Return the checks declared in `[Check:<name>]` sections as a list of `Check`.
+
+        Raises ValueError if a check misses a mandatory option or has a malformed value."""
+
+        checks = []
+        for section in self.sections():
+            if not section.startswith(CHECK_SECTION_PREFIX):
+                continue
+            name = section[len(CHECK_SECTION_PREFIX):].strip()
+            try:
+                check = Check(
+                    name=name,
+                    script=self.get(section, 'script'),
+                    args=shlex.split(self.get(section, 'args', fallback='')),
+                    component_id=self.getint(section, 'component-id'),
+                    interval=self.getfloat(section, 'interval', fallback=60.0),
+                    retry_policy=self._retry_policy(section),
+                    pass_timeout=self.getboolean(section, 'pass-timeout', fallback=False),
+                    metrics=parse_metrics(self.get(section, 'metrics', fallback='')),
+                )
+            except (configparser.NoOptionError, ValueError) as error:
+                raise ValueError('invalid check %s: %s' % (name, error))
+            if check.interval <= 0:
+                raise ValueError('invalid check %s: interval must be positive' % name)
+            checks.append(check)
+        return checks
+
+    def _retry_policy(self, section):
+        """Build the `retry.QuorumPolicy` of a check section if `quorum` is set, its
+        `retry.RetryPolicy` otherwise"""
+
+        deadline = self.getfloat(section, 'deadline', fallback=None)
+        if self.has_option(section, 'quorum'):
+            return QuorumPolicy(
+                attempts=self.getint(section, 'quorum'),
+                decision=self.get(section, 'quorum-decision', fallback='majority'),
+                stagger=self.getfloat(section, 'stagger', fallback=0.005),
+                timeout=deadline,
+            )
+        return RetryPolicy(
+            retries=self.getint(section, 'retries', fallback=5),
+            interval=self.getfloat(section, 'retry-interval', fallback=0.5),
+            backoff=self.getfloat(section, 'backoff', fallback=1.0),
+            max_interval=self.getfloat(section, 'max-interval', fallback=None),
+            jitter=self.getfloat(section, 'jitter', fallback=0.0),
+            deadline=deadline,
+        )
+
+    def status_mapping(self, defaults):
+        """Return the mapping between Nagios codes and Cachet component statuses: `defaults`, a
+        dict keyed by `nagios_common.Codes`, overridden by the `[StatusMapping]` section options.
+        An empty value means no update is sent to Cachet for that code.
+
+        Raises ValueError on unknown Nagios codes or Cachet statuses."""
+
+        mapping = dict(defaults)
+        if not self.has_section(STATUS_MAPPING_SECTION):
+            return mapping
+        for option in self.options(STATUS_MAPPING_SECTION):
+            value = self.get(STATUS_MAPPING_SECTION, option).strip()
+            try:
+                code = Codes[option.upper()]
+                mapping[code] = int(value) if value else None
+            except (KeyError, ValueError):
+                raise ValueError('invalid status mapping %s: %s' % (option, value))
+            if value and mapping[code] not in CACHET_STATUSES:
+                raise ValueError('invalid status mapping %s: %s' % (option, value))
+        return mapping
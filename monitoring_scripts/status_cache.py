@@ -0,0 +1,99 @@
+"""Persistent record of the last status sent to Cachet for each component, used to skip
+updates which would not change anything"""
+
+import json
+import logging
+import threading
+import time
+
+from . import persist
+
+DEFAULT_TTL = 3600
+
+logger = logging.getLogger(__name__)
+
+
+class StatusCache():
+    """Last status sent to Cachet for each component, stored as a JSON file at `path`.
+
+    An update is needed only if the status changed or if the last one was sent more than `ttl`
+    seconds ago. Counters of sent and avoided writes are persisted along with the statuses."""
+
+    def __init__(self, path, ttl=DEFAULT_TTL):
+        self.path = path
+        self.ttl = ttl
+        self.entries = {}
+        self.writes_sent = 0
+        self.writes_avoided = 0
+
+        self._dirty = set()
+        self._lock = threading.Lock()
+
+    @property
+    def dirty(self):
+        """True if some entries changed since the last save"""
+
+        return bool(self._dirty)
+
+    def load(self):
+        """Load the statuses and counters of the cache file, return False if it could not be
+        loaded"""
+
+        content = persist.load_json(self.path, 'status cache')
+        if content is None:
+            return False
+        counters = content.get('counters', {})
+        with self._lock:
+            self.entries = content.get('components', {})
+            self.writes_sent = counters.get('sent', 0)
+            self.writes_avoided = counters.get('avoided', 0)
+        return True
+
+    def seed(self, components):
+        """Fill the cache with the current status of every component, read with a single bulk
+        request through a `cachet.Components` client"""
+
+        now = time.time()
+        response = json.loads(components.get())
+        with self._lock:
+            for component in response.get('data', []):
+                key = str(component['id'])
+                self.entries[key] = {'status': int(component['status']), 'timestamp': now}
+                self._dirty.add(key)
+        logger.info('status cache seeded with %d components', len(response.get('data', [])))
+
+    def needs_update(self, component_id, status, now=None):
+        """Tell if `status` must be sent to Cachet for a component, counting avoided writes"""
+
+        now = time.time() if now is None else now
+        with self._lock:
+            entry = self.entries.get(str(component_id))
+            if entry and entry['status'] == status and now - entry['timestamp'] < self.ttl:
+                self.writes_avoided += 1
+                return False
+        return True
+
+    def record(self, component_id, status, now=None):
+        """Remember that `status` has been sent to Cachet for a component"""
+
+        key = str(component_id)
+        with self._lock:
+            self.entries[key] = {'status': status,
+                                 'timestamp': time.time() if now is None else now}
+            self.writes_sent += 1
+            self._dirty.add(key)
+
+    def save(self):
+        """Write the cache file atomically. Entries changed by this process are merged with the
+        ones currently on disk, so that concurrent runners do not drop each other's updates."""
+
+        with self._lock:
+            entries = (persist.load_json(self.path) or {}).get('components', {})
+            entries.update((key, self.entries[key]) for key in self._dirty)
+            persist.save_json(self.path, {
+                'components': entries,
+                'counters': {'sent': self.writes_sent, 'avoided': self.writes_avoided},
+            })
+            self._dirty.clear()
+        logger.info('status cache saved, %d writes sent, %d writes avoided', self.writes_sent,
+                    self.writes_avoided)
@@ -3,14 +3,21 @@ Nagios-compatible plugin to check a TeamSpeak 3 Server availability. If the
 server responds to a connection requests on the client port a OK status is
 triggered, if the response exceeds the timeout a CRITICAL status is
 triggered, if the provided hostname/address is invalid a UNKNOWN status is
-triggered.
+triggered. When more than one server is given they are all probed at once
+from a single socket and the worst status is returned, followed by one result
+line per server. In burst mode many handshakes are sent to a single server to
+measure packet loss and jitter.
 """
 
 import argparse
 import logging
+import os
+import selectors
 import socket
+import time
 
 from . import nagios_common as nagios
+from . import net
 
 parser = argparse.ArgumentParser(
     prog='cnto-ts3-monitor',
@@ -19,8 +26,9 @@ parser = argparse.ArgumentParser(
 )
 parser.add_argument(
     'host',
+    nargs='+',
     help='TeamSpeak3 Server hostname in Internet domain notation or IPv4 '
-         'address'
+         'address, optionally followed by :port to override --port'
 )
 parser.add_argument(
     '--port',
@@ -30,24 +38,81 @@ parser.add_argument(
 )
 parser.add_argument(
     '--timeout',
-    type=int,
+    type=float,
     default=10,
     help='maximum time to wait for server response'
 )
+parser.add_argument(
+    '--warning-latency',
+    type=float,
+    default=None,
+    help='response time (in seconds) above which a WARNING status is triggered'
+)
+parser.add_argument(
+    '--critical-latency',
+    type=float,
+    default=None,
+    help='response time (in seconds) above which a CRITICAL status is triggered'
+)
+parser.add_argument(
+    '--burst',
+    type=int,
+    default=1,
+    help='number of handshakes sent to a single server to measure packet loss and jitter, the '
+         'whole burst completes within --timeout'
+)
+parser.add_argument(
+    '--burst-interval',
+    type=float,
+    default=0.02,
+    help='time (in seconds) between two handshakes of a burst, shortened if needed to send the '
+         'whole burst within half of --timeout'
+)
+parser.add_argument(
+    '--warning-loss',
+    type=float,
+    default=None,
+    help='packet loss (in percent) of a burst above which a WARNING status is triggered'
+)
+parser.add_argument(
+    '--critical-loss',
+    type=float,
+    default=None,
+    help='packet loss (in percent) of a burst above which a CRITICAL status is triggered'
+)
+parser.add_argument(
+    '--warning-jitter',
+    type=float,
+    default=None,
+    help='jitter (in seconds) of a burst above which a WARNING status is triggered'
+)
+parser.add_argument(
+    '--critical-jitter',
+    type=float,
+    default=None,
+    help='jitter (in seconds) of a burst above which a CRITICAL status is triggered'
+)
 parser.add_argument(
     '--debug',
     action='store_true',
     default=False,
     help='display debug messages, DO NOT enable in actual Nagios use'
 )
+net.add_resolver_arguments(parser)
 
 CONNECTION_DGRAM = '545333494e495431006500008808b1e27f0059d686723b2afa6a' \
                    '0000000000000000'
 VALID_CONNECTION_STRING = 'TS3'
 ENCODING_FORMAT = 'cp1252'
+VALID_CONNECTION_MARKER = VALID_CONNECTION_STRING.encode(ENCODING_FORMAT)
+RESPONSE_BUFFER_SIZE = 1024
+# Position of the random bytes of the handshake, the server echoes them reversed in its reply
+HANDSHAKE_RANDOM = slice(22, 26)
+REPLY_RANDOM = slice(28, 32)
 
 
-def main(host, port=9987, timeout=10, debug=False):
+def main(host, port=9987, timeout=10,  # pylint: disable=R0913
+         warning_latency=None, critical_latency=None, debug=False):
     """Actual monitoring execution"""
 
     logging.basicConfig(level=logging.WARNING)
@@ -60,31 +125,274 @@ def main(host, port=9987, timeout=10, debug=False):
     s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
     s.settimeout(timeout)
 
-    ts3_server = (host, port)
     message = bytes.fromhex(CONNECTION_DGRAM)
+    start = time.perf_counter()
 
     try:
+        ts3_server, dns_time = net.resolve(host, port)
+        sent = time.perf_counter()
         s.sendto(message, ts3_server)
-        response_bytes = s.recv(1024)
+        response_bytes = s.recv(RESPONSE_BUFFER_SIZE)
+        received = time.perf_counter()
 
-        response_string = response_bytes.decode(ENCODING_FORMAT,
-                                                errors='ignore')
-        if VALID_CONNECTION_STRING in response_string:
-            nagios.plugin_exit(nagios.Codes.OK, 'connection successful')
+        thresholds = nagios.Thresholds(warning_latency, critical_latency)
+        perfdata = [
+            nagios.PerfData('dns', dns_time, 's', minimum=0),
+            thresholds.perfdata('rtt', received - sent),
+            nagios.PerfData('total', received - start, 's', minimum=0),
+        ]
+        if VALID_CONNECTION_MARKER in response_bytes:
+            code, status_message = thresholds.check(nagios.Codes.OK, 'connection successful',
+                                                    received - sent)
+            nagios.plugin_exit(code, status_message, perfdata)
         else:
-            nagios.plugin_exit(nagios.Codes.CRITICAL, 'invalid server response')
+            nagios.plugin_exit(nagios.Codes.CRITICAL, 'invalid server response', perfdata)
     except socket.gaierror:
         nagios.plugin_exit(nagios.Codes.UNKNOWN, 'invalid host or address')
     except socket.timeout:
         nagios.plugin_exit(nagios.Codes.CRITICAL, 'response timed out')
+    finally:
+        # Plugins executed in-process share the file descriptors of the runner or daemon
+        s.close()
+
+
+def probe_servers(targets, timeout=10, thresholds=None):
+    """Probe many servers at once from a single non-blocking socket.
+
+    The handshake is sent to every (host, port) target, then replies are matched back to their
+    target by source address until all of them answered or `timeout` expires. Round trip times
+    are checked against `thresholds`, a nagios.Thresholds, if provided. Returns a list of
+    (target, nagios.Codes, message, perfdata) tuples in the same order as `targets`."""
+
+    logger = logging.getLogger(__name__)
+    thresholds = thresholds or nagios.Thresholds()
+
+    message = bytes.fromhex(CONNECTION_DGRAM)
+    response_buffer = bytearray(RESPONSE_BUFFER_SIZE)
+    results = {}
+    dns_times = {}
+    pending = {}
+    sent = {}
 
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s, \
+            selectors.DefaultSelector() as selector:
+        s.setblocking(False)
+        for target in targets:
+            try:
+                address, dns_times[target] = net.resolve(*target)
+                sent.setdefault(address, time.perf_counter())
+                s.sendto(message, address)
+            except socket.gaierror:
+                results[target] = (nagios.Codes.UNKNOWN, 'invalid host or address', [])
+            except OSError as error:
+                results[target] = (nagios.Codes.UNKNOWN, 'cannot send request: %s' % error, [])
+            else:
+                logger.debug('handshake sent to %s:%d', *address)
+                pending.setdefault(address, []).append(target)
+
+        selector.register(s, selectors.EVENT_READ)
+        deadline = time.monotonic() + timeout
+        while pending:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            if not selector.select(remaining):
+                continue
+            try:
+                size, address = s.recvfrom_into(response_buffer)
+            except OSError:
+                continue
+            received = time.perf_counter()
+            if address not in pending:
+                logger.debug('ignoring datagram from unexpected source %s:%d', *address)
+                continue
+            rtt = received - sent[address]
+            if response_buffer.find(VALID_CONNECTION_MARKER, 0, size) != -1:
+                code, status_message = thresholds.check(nagios.Codes.OK, 'connection successful',
+                                                        rtt)
+            else:
+                code, status_message = nagios.Codes.CRITICAL, 'invalid server response'
+            for target in pending.pop(address):
+                results[target] = (code, status_message, [
+                    nagios.PerfData('dns', dns_times[target], 's', minimum=0),
+                    thresholds.perfdata('rtt', rtt),
+                ])
+
+    for address_targets in pending.values():
+        for target in address_targets:
+            results[target] = (nagios.Codes.CRITICAL, 'response timed out',
+                               [nagios.PerfData('dns', dns_times[target], 's', minimum=0)])
+
+    return [(target,) + results[target] for target in targets]
+
+
+def burst_probe(address, count, interval, timeout):
+    """Send `count` handshakes `interval` seconds apart to a server from a single socket and
+    collect the replies until all of them arrived or `timeout` expires.
+
+    Every handshake carries its own random bytes, which the server echoes, so that replies are
+    matched to the handshake they answer; replies without them are matched to the oldest
+    unanswered handshake. Returns the list of round trip times of the answered handshakes, None
+    for lost ones, in sending order, along with the number of invalid replies."""
+
+    logger = logging.getLogger(__name__)
+    template = bytearray.fromhex(CONNECTION_DGRAM)
+    response_buffer = bytearray(RESPONSE_BUFFER_SIZE)
+    if count > 1:
+        interval = min(interval, timeout / 2 / (count - 1))
+    rtts = [None] * count
+    pending = {}
+    invalid = 0
 
-def ts3_entry_point():  # pragma: no cover
-    """Console entry point"""
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s, \
+            selectors.DefaultSelector() as selector:
+        s.setblocking(False)
+        selector.register(s, selectors.EVENT_READ)
+        start = time.monotonic()
+        deadline = start + timeout
+        sent = 0
+        while sent < count or pending:
+            now = time.monotonic()
+            if sent < count and now >= start + sent * interval:
+                tag = os.urandom(4)
+                while tag in pending:
+                    tag = os.urandom(4)
+                template[HANDSHAKE_RANDOM] = tag
+                pending[tag] = (sent, time.perf_counter())
+                s.sendto(template, address)
+                sent += 1
+                continue
+            wake = deadline if sent == count else min(start + sent * interval, deadline)
+            if now >= deadline:
+                break
+            if not selector.select(wake - now):
+                continue
+            try:
+                size, _ = s.recvfrom_into(response_buffer)
+            except OSError:
+                continue
+            received = time.perf_counter()
+            if response_buffer.find(VALID_CONNECTION_MARKER, 0, size) == -1:
+                invalid += 1
+                continue
+            tag = bytes(response_buffer[REPLY_RANDOM][::-1]) if size >= REPLY_RANDOM.stop else None
+            if tag not in pending:
+                # Reply without echo, match it to the oldest unanswered handshake
+                tag = min(pending, key=lambda key: pending[key][0], default=None)
+                if tag is None:
+                    continue
+            index, sent_at = pending.pop(tag)
+            rtts[index] = received - sent_at
 
-    args = parser.parse_args()
+    logger.debug('burst completed, %d of %d handshakes answered', count - rtts.count(None),
+                 count)
+    return rtts, invalid
 
-    main(**args.__dict__)
+
+def burst_statistics(rtts):
+    """Return loss (in percent), minimum, average and maximum round trip time and jitter (mean
+    difference between consecutive round trip times) of a burst, times are None if all
+    handshakes were lost"""
+
+    answered = [rtt for rtt in rtts if rtt is not None]
+    loss = 100.0 * (len(rtts) - len(answered)) / len(rtts)
+    if not answered:
+        return loss, None, None, None, None
+    differences = [abs(current - previous) for previous, current in zip(answered, answered[1:])]
+    jitter = sum(differences) / len(differences) if differences else 0.0
+    return loss, min(answered), sum(answered) / len(answered), max(answered), jitter
+
+
+def burst_main(host, port=9987, timeout=10, count=10,  # pylint: disable=R0913,R0914
+               interval=0.02, latency=None, loss=None, jitter=None, debug=False):
+    """Burst monitoring execution, `latency`, `loss` and `jitter` are the nagios.Thresholds of
+    the average round trip time, packet loss and jitter"""
+
+    logging.basicConfig(level=logging.WARNING)
+    logger = logging.getLogger(__name__)
+
+    if debug:  # pragma: no cover
+        logger.setLevel(logging.DEBUG)
+        logger.info('debug logging enabled')
+
+    latency = latency or nagios.Thresholds()
+    loss = loss or nagios.Thresholds()
+    jitter = jitter or nagios.Thresholds()
+    start = time.perf_counter()
+    try:
+        address, dns_time = net.resolve(host, port)
+        rtts, invalid = burst_probe(address, count, interval, timeout)
+    except socket.gaierror:
+        nagios.plugin_exit(nagios.Codes.UNKNOWN, 'invalid host or address')
+    except OSError as error:
+        nagios.plugin_exit(nagios.Codes.UNKNOWN, 'cannot send request: %s' % error)
+
+    lost, rtt_min, rtt_avg, rtt_max, rtt_jitter = burst_statistics(rtts)
+    perfdata = [
+        nagios.PerfData('dns', dns_time, 's', minimum=0),
+        loss.perfdata('loss', lost, '%')._replace(maximum=100),
+    ]
+    if rtt_avg is None:
+        message = 'invalid server response' if invalid else 'no response to %d handshakes' % count
+        nagios.plugin_exit(nagios.Codes.CRITICAL, message, perfdata)
+
+    perfdata.extend([
+        latency.perfdata('rtt', rtt_avg),
+        nagios.PerfData('rtt_min', rtt_min, 's', minimum=0),
+        nagios.PerfData('rtt_max', rtt_max, 's', minimum=0),
+        jitter.perfdata('jitter', rtt_jitter),
+        nagios.PerfData('total', time.perf_counter() - start, 's', minimum=0),
+    ])
+    message = '%d of %d handshakes answered' % (count - rtts.count(None), count)
+    checks = [
+        latency.check(nagios.Codes.OK, message, rtt_avg, 'average response time'),
+        loss.check(nagios.Codes.OK, message, lost, 'packet loss', '%'),
+        jitter.check(nagios.Codes.OK, message, rtt_jitter, 'jitter'),
+    ]
+    worst = nagios.worst_status(code for code, _ in checks)
+    nagios.plugin_exit(*next(check for check in checks if check[0] == worst), perfdata=perfdata)
+
+
+def fleet_main(targets, timeout=10, warning_latency=None, critical_latency=None, debug=False):
+    """Multi-server monitoring execution, the worst status among all servers is returned"""
+
+    logging.basicConfig(level=logging.WARNING)
+    logger = logging.getLogger(__name__)
+
+    if debug:  # pragma: no cover
+        logger.setLevel(logging.DEBUG)
+        logger.info('debug logging enabled')
+
+    results = probe_servers(targets, timeout,
+                            nagios.Thresholds(warning_latency, critical_latency))
+    nagios.aggregate_exit([('%s:%d' % result[0],) + result[1:] for result in results], 'servers')
+
+
+def ts3_entry_point(argv=None):  # pragma: no cover
+    """Console entry point, `argv` defaults to the command line arguments"""
+
+    args = parser.parse_args(argv)
+    net.configure_resolver(args.dns_ttl, args.dns_serve_stale, args.dns_cache)
+
+    try:
+        targets = [net.parse_target(host, args.port) for host in args.host]
+    except ValueError as error:
+        nagios.plugin_exit(nagios.Codes.UNKNOWN, str(error))
+    if len(targets) > 1 and args.burst > 1:
+        parser.error('burst mode checks a single server')
+    if len(targets) == 1 and args.burst > 1:
+        burst_main(*targets[0], timeout=args.timeout, count=args.burst,
+                   interval=args.burst_interval,
+                   latency=nagios.Thresholds(args.warning_latency, args.critical_latency),
+                   loss=nagios.Thresholds(args.warning_loss, args.critical_loss),
+                   jitter=nagios.Thresholds(args.warning_jitter, args.critical_jitter),
+                   debug=args.debug)
+    elif len(targets) == 1:
+        main(*targets[0], timeout=args.timeout, warning_latency=args.warning_latency,
+             critical_latency=args.critical_latency, debug=args.debug)
+    else:
+        fleet_main(targets, timeout=args.timeout, warning_latency=args.warning_latency,
+                   critical_latency=args.critical_latency, debug=args.debug)
 
 
 if __name__ == '__main__':  # pragma: no cover
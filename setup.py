@@ -43,6 +43,8 @@ setup(
             'cnto-ts3-monitor=monitoring_scripts.ts3_monitor:ts3_entry_point',
             'cnto-arma3-monitor=monitoring_scripts.arma3_monitor:arma3_entry_point',
             'cnto-check-runner=monitoring_scripts.check_runner:runner_entry_point',
+            'cnto-check-daemon=monitoring_scripts.daemon:daemon_entry_point',
+            'cnto-monitor=monitoring_scripts.cli:cli_entry_point',
         ],
     },
 )
@@ -3,6 +3,8 @@ import json
 import os
 
 import socket
+import struct
+import threading
 import pytest
 import valve.source.a2s
 
@@ -11,6 +13,14 @@ from monitoring_scripts.nagios_common import Codes
 from . import common
 
 
+@pytest.fixture(autouse=True)
+def resolver(mocker):
+    """Resolve every host to the loopback address without querying DNS"""
+
+    return mocker.patch('socket.getaddrinfo', side_effect=lambda host, port, *_: [
+        (socket.AF_INET, socket.SOCK_DGRAM, 0, '', ('127.0.0.1', port))])
+
+
 # pylint: disable-msg=too-many-arguments
 def run_and_assert(capfd, expected_code=Codes.OK, expected_message_part=None,
                    host='arma.server.host', port=2303, timeout=10, debug=False):
@@ -67,3 +77,188 @@ def test_with_response(capfd, mocker, response, expected_code, message_part):
 
     run_and_assert(capfd=capfd, expected_code=expected_code,
                    expected_message_part=message_part)
+
+
+def test_query_servers(mocker):
+    """Assert every server is queried and reported separately"""
+
+    def querier(address, timeout):  # pylint: disable=W0613
+        mock_server = mocker.Mock()
+        if address[1] == 2304:
+            mock_server.info.side_effect = valve.source.NoResponseError
+        elif address[1] == 2305:
+            mock_server.info.side_effect = socket.gaierror
+        else:
+            mock_server.info.return_value = load_json_fixture('a2s_response.json')
+        return mock_server
+
+    mocker.patch('valve.source.a2s.ServerQuerier', side_effect=querier)
+    targets = [('arma.server.host', 2303), ('down.host', 2304), ('bad.host', 2305)]
+
+    results = unit.query_servers(targets, timeout=1, workers=2)
+
+    assert [result[:2] for result in results] == [
+        (targets[0], Codes.OK),
+        (targets[1], Codes.CRITICAL),
+        (targets[2], Codes.UNKNOWN),
+    ]
+
+
+def test_query_servers_garbage(mocker):
+    """Assert a server answering garbage is reported CRITICAL without failing the others"""
+
+    garbage = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    garbage.bind(('127.0.0.1', 0))
+    garbage_port = garbage.getsockname()[1]
+
+    def answer():
+        _, client = garbage.recvfrom(2048)
+        garbage.sendto(b'\xff\xff\xff\xffgarbage', client)
+
+    thread = threading.Thread(target=answer, daemon=True)
+    thread.start()
+    query_info = valve.source.a2s.ServerQuerier.info
+
+    def info(server):
+        if server.port == garbage_port:
+            return query_info(server)
+        return load_json_fixture('a2s_response.json')
+
+    mocker.patch.object(valve.source.a2s.ServerQuerier, 'info', info)
+    targets = [('arma.server.host', 2303), ('garbage.host', garbage_port)]
+
+    try:
+        results = unit.query_servers(targets, timeout=1, workers=2)
+    finally:
+        thread.join(5)
+        garbage.close()
+
+    assert [result[:3] for result in results] == [
+        (targets[0], Codes.OK, 'connection successful'),
+        (targets[1], Codes.CRITICAL, 'invalid response'),
+    ]
+
+
+def test_fleet_main(mocker, capfd):
+    """Assert the fleet mode returns the worst status with one line per server"""
+
+    mocker.patch.object(unit, 'query_servers', return_value=[
+        (('arma.one', 2303), Codes.OK, 'connection successful', []),
+        (('arma.two', 2403), Codes.UNKNOWN, 'invalid hostname/address or port', []),
+    ])
+
+    common.run_and_assert(unit.fleet_main, expected_code=Codes.UNKNOWN, capfd=None,
+                          targets=[('arma.one', 2303), ('arma.two', 2403)])
+
+    out = capfd.readouterr()[0]
+    assert out.startswith('UNKNOWN: 1 of 2 servers not OK')
+    assert 'UNKNOWN: arma.two:2403 invalid' in out
+
+
+def test_perfdata(mocker, capfd):
+    """Assert timings and players count are reported as perfdata"""
+
+    mock_querier = mocker.Mock()
+    mock_querier.return_value.info.return_value = load_json_fixture('a2s_response.json')
+    mocker.patch('valve.source.a2s.ServerQuerier', side_effect=mock_querier)
+
+    run_and_assert(capfd=None, expected_code=Codes.OK)
+
+    out = capfd.readouterr()[0]
+    assert out.startswith('OK: connection successful | dns=')
+    assert 'players=0;;;0;64 max_players=64;;;0' in out
+
+
+def test_unresolvable(resolver, capfd):  # pylint: disable=W0621
+    """Assert UNKNOWN status if the host name cannot be resolved"""
+
+    resolver.side_effect = socket.gaierror
+
+    run_and_assert(capfd=capfd, expected_code=Codes.UNKNOWN)
+
+
+CHALLENGE = b'\xff\xff\xff\xffA' + struct.pack('<l', 1234)
+PLAYERS = b''.join([b'\xff\xff\xff\xffD', bytes([2]),
+                    bytes([0]), b'Miller\x00', struct.pack('<lf', 3, 120.0),
+                    bytes([1]), b'\x00', struct.pack('<lf', 0, 5.0)])
+RULES = b'\xff\xff\xff\xffE' + struct.pack('<h', 2) + b'mission\x00co30\x00mods\x00cba\x00'
+
+
+@pytest.fixture
+def querier(mocker):
+    """Server querier answering the info query, the responses of the players and rules queries
+    are given to the returned raw datagrams mock"""
+
+    mock_querier = mocker.Mock()
+    mock_querier.return_value.info.return_value = load_json_fixture('a2s_response.json')
+    mocker.patch('valve.source.a2s.ServerQuerier', side_effect=mock_querier)
+    return mock_querier.return_value, mocker.patch('valve.source.BaseQuerier.get_response')
+
+
+def test_players_and_rules(querier, tmpdir):  # pylint: disable=W0621
+    """Assert the challenge number is requested once and reused by the following queries"""
+
+    server, datagrams = querier
+    datagrams.side_effect = [CHALLENGE, PLAYERS, RULES, PLAYERS]
+    challenges = unit.ChallengeCache(str(tmpdir.join('challenges.json')))
+
+    code, message, perfdata = unit.query_server('arma.server.host', 2303, players=True,
+                                                rules=True, challenges=challenges)
+    assert (code, message) == (Codes.OK, 'connection successful')
+    assert 'players_listed=1;;;0' in ' '.join(str(data) for data in perfdata)
+    assert 'rules=2;;;0' in ' '.join(str(data) for data in perfdata)
+    assert [call[0][0]['challenge'] for call in server.request.call_args_list] == [-1, 1234, 1234]
+
+    reloaded = unit.ChallengeCache(challenges.path)
+    assert reloaded.load()
+    unit.query_server('arma.server.host', 2303, players=True, challenges=reloaded)
+    assert server.request.call_args[0][0]['challenge'] == 1234
+
+
+def test_rate_limited(querier):  # pylint: disable=W0621
+    """Assert challenged queries are paused when the server keeps sending challenge numbers"""
+
+    server, datagrams = querier
+    datagrams.side_effect = [CHALLENGE, CHALLENGE]
+    challenges = unit.ChallengeCache()
+
+    code, message, _ = unit.query_server('arma.server.host', 2303, players=True,
+                                         challenges=challenges)
+    assert code == Codes.OK
+    assert message.endswith('players and rules queries paused for %ds' % unit.MIN_BACKOFF)
+
+    code, message, _ = unit.query_server('arma.server.host', 2303, players=True,
+                                         challenges=challenges)
+    assert 'paused' in message
+    assert server.request.call_count == 2
+
+
+def test_back_off():
+    """Assert the back off doubles up to its maximum and is forgotten after a success"""
+
+    challenges = unit.ChallengeCache()
+
+    assert challenges.back_off('server', now=0) == unit.MIN_BACKOFF
+    assert challenges.backing_off('server', now=10) == unit.MIN_BACKOFF - 10
+    assert challenges.back_off('server', now=0) == unit.MIN_BACKOFF * 2
+    for _ in range(10):
+        challenges.back_off('server', now=0)
+    assert challenges.backing_off('server', now=0) == unit.MAX_BACKOFF
+
+    challenges.reset_back_off('server')
+    assert challenges.backing_off('server', now=0) == 0
+    assert challenges.back_off('server', now=0) == unit.MIN_BACKOFF
+
+
+def test_split_rules(querier):  # pylint: disable=W0621
+    """Assert split responses are reassembled"""
+
+    _, datagrams = querier
+    payload = RULES[4:]
+    datagrams.side_effect = [CHALLENGE] + [
+        b'\xfe\xff\xff\xff' + struct.pack('<lBBh', 7, 2, index, 1248) + part
+        for index, part in enumerate([payload[:10], payload[10:]])]
+
+    _, _, perfdata = unit.query_server('arma.server.host', 2303, rules=True,
+                                       challenges=unit.ChallengeCache())
+    assert 'rules=2;;;0' in ' '.join(str(data) for data in perfdata)
@@ -0,0 +1,120 @@
+"""Test suite for monitoring_scripts.cachet_updater"""
+
+import threading
+import time
+
+import pytest
+
+from monitoring_scripts import cachet_updater as unit
+
+
+def test_put(mocker):
+    """Assert put sends the update and returns the client result"""
+
+    components = mocker.Mock()
+    components.put.return_value = 'done'
+    updater = unit.CachetUpdater(components, window=0)
+
+    assert updater.put(id=3, status=4) == 'done'
+    updater.close()
+
+    components.put.assert_called_once_with(id=3, status=4)
+
+
+def test_put_error(mocker):
+    """Assert request errors are propagated to the caller"""
+
+    components = mocker.Mock()
+    components.put.side_effect = RuntimeError('cachet is down')
+    updater = unit.CachetUpdater(components, window=0)
+
+    with pytest.raises(RuntimeError):
+        updater.put(id=3, status=4)
+    updater.close()
+
+
+def test_coalescing(mocker):
+    """Assert only the latest status of a component is sent within a window"""
+
+    components = mocker.Mock()
+    updater = unit.CachetUpdater(components, window=0.2)
+
+    futures = [updater.submit(1, 4), updater.submit(2, 4), updater.submit(1, 1)]
+    for future in futures:
+        future.result(5)
+    updater.close()
+
+    assert components.put.call_count == 2
+    components.put.assert_any_call(id=1, status=1)
+    components.put.assert_any_call(id=2, status=4)
+
+
+def test_concurrency(mocker):
+    """Assert updates are sent concurrently, at most `concurrency` at a time"""
+
+    lock = threading.Lock()
+    in_flight = {'current': 0, 'max': 0}
+
+    def put(**_):
+        with lock:
+            in_flight['current'] += 1
+            in_flight['max'] = max(in_flight['max'], in_flight['current'])
+        time.sleep(0.05)
+        with lock:
+            in_flight['current'] -= 1
+
+    components = mocker.Mock()
+    components.put.side_effect = put
+    updater = unit.CachetUpdater(components, window=0.05, concurrency=4)
+
+    start = time.monotonic()
+    futures = [updater.submit(component_id, 4) for component_id in range(16)]
+    for future in futures:
+        future.result(5)
+    elapsed = time.monotonic() - start
+    updater.close()
+
+    assert in_flight['max'] == 4
+    assert elapsed < 16 * 0.05
+
+
+def test_closed(mocker):
+    """Assert no update can be queued after close"""
+
+    updater = unit.CachetUpdater(mocker.Mock(), window=0)
+    updater.close()
+
+    with pytest.raises(RuntimeError):
+        updater.submit(1, 1)
+
+
+def test_metric_batches(mocker):
+    """Assert the samples of a metric within a window are published as a single point"""
+
+    points = mocker.Mock()
+    publisher = unit.MetricPublisher(points, window=0.2)
+
+    for value in (10, 20, 60):
+        assert publisher.add(5, value, timestamp=1000 + value)
+    publisher.add(6, 1.5, timestamp=2000)
+    publisher.close()
+
+    assert points.post.call_count == 2
+    points.post.assert_any_call(id=5, value=30, timestamp=1060)
+    points.post.assert_any_call(id=6, value=1.5, timestamp=2000)
+
+
+def test_metric_buffer_full(mocker):
+    """Assert samples of new metrics are dropped once the buffer is full and errors swallowed"""
+
+    points = mocker.Mock()
+    points.post.side_effect = RuntimeError('cachet is down')
+    publisher = unit.MetricPublisher(points, window=10, max_pending=2)
+
+    assert publisher.add(1, 1)
+    assert publisher.add(2, 1)
+    assert publisher.add(1, 2)
+    assert not publisher.add(3, 1)
+    publisher.close()
+
+    assert points.post.call_count == 2
@@ -1,19 +1,28 @@
 """Test suite for check_runner"""
 
+import os
+import sys
+import threading
+import time
 from unittest.mock import call
 
 import pytest
 
 from monitoring_scripts import check_runner as unit
+from monitoring_scripts import metrics
 from monitoring_scripts.nagios_common import Codes
+from monitoring_scripts.retry import QuorumPolicy, RetryPolicy
 from . import common
 
+POOL_RUN = 'monitoring_scripts.plugin_pool.PluginPool.run'
 
-class CompletedProcessMock():  # pylint: disable=R0903
-    """Mocks subprocess.CompletedProcess to test returncode"""
+
+class PluginResultMock():  # pylint: disable=R0903
+    """Mocks the plugin_pool.PluginResult of an external plugin to test returncode"""
 
     def __init__(self, returncode):
         self.returncode = returncode
+        self.output = None
 
 
 @pytest.fixture(scope='module')
@@ -70,12 +79,12 @@ def test_updating(mocker, config, script_return, expected_update,  # pylint: dis
     """Assert runner updates Cachet with expected codes"""
 
     try:
-        completed_processes = []
+        plugin_results = []
         for value in script_return:
-            completed_processes.append(CompletedProcessMock(value))
-        mocker.patch('subprocess.run', side_effect=completed_processes)
+            plugin_results.append(PluginResultMock(value))
+        mocker.patch(POOL_RUN, side_effect=plugin_results)
     except TypeError:
-        mocker.patch('subprocess.run', return_value=CompletedProcessMock(script_return))
+        mocker.patch(POOL_RUN, return_value=PluginResultMock(script_return))
 
     cachet_update = mocker.patch('cachetclient.cachet.Components.put')
     component = 99
@@ -95,7 +104,7 @@ def test_incompatible_plugin(mocker, config):  # pylint: disable=W0621
     mock_execution = mocker.Mock()
     mock_execution.returncode = return_code
 
-    mocker.patch('subprocess.run', return_value=mock_execution)
+    mocker.patch(POOL_RUN, return_value=mock_execution)
     cachet_update = mocker.patch('cachetclient.cachet.Components.put')
 
     common.run_and_assert(unit.main, expected_code=Codes.CRITICAL, script=mocker.Mock(),
@@ -110,7 +119,7 @@ def test_unknown_no_update(mocker, config):  # pylint: disable=W0621
     mock_execution = mocker.Mock()
     mock_execution.returncode = Codes.UNKNOWN.value
 
-    mocker.patch('subprocess.run', return_value=mock_execution)
+    mocker.patch(POOL_RUN, return_value=mock_execution)
     cachet_update = mocker.patch('cachetclient.cachet.Components.put')
 
     common.run_and_assert(unit.main, expected_code=Codes.UNKNOWN, script=mocker.Mock(),
@@ -125,7 +134,7 @@ def test_wait(mocker, config):  # pylint: disable=W0621
     mock_execution = mocker.Mock()
     mock_execution.returncode = Codes.CRITICAL.value
 
-    mocker.patch('subprocess.run', return_value=mock_execution)
+    mocker.patch(POOL_RUN, return_value=mock_execution)
     mocker.patch('cachetclient.cachet.Components.put')
     time_sleep = mocker.patch('time.sleep')
 
@@ -139,3 +148,323 @@ def test_wait(mocker, config):  # pylint: disable=W0621
     expected_calls = [call(10), call(10), call(10), call(10), call(10)]
 
     assert time_sleep.call_args_list == expected_calls
+
+
+@pytest.mark.parametrize(
+    'script',
+    [
+        'cnto-http-monitor',
+        '/usr/local/bin/cnto-http-monitor',
+    ]
+)
+def test_bundled_in_process(mocker, capfd, script):
+    """Assert bundled plugins are called in-process and their output is captured"""
+
+    pool_run = mocker.patch(POOL_RUN)
+    mocker.patch('monitoring_scripts.net.resolve', return_value=(('127.0.0.1', 80), 0.001))
+    http_head = mocker.patch('requests.Session.head')
+    http_head.return_value.status_code = 503
+    http_head.return_value.elapsed.total_seconds.return_value = 0.1
+
+    result = unit.run_plugin([script, 'http://foo.bar'])
+
+    assert not pool_run.called
+    assert http_head.called
+    assert result.returncode == Codes.CRITICAL.value
+    assert result.output.startswith('CRITICAL:')
+    assert not capfd.readouterr()[0]
+
+
+def test_bundled_invalid_arguments(mocker):
+    """Assert argument errors of in-process plugins map to the same exit status as a subprocess"""
+
+    mocker.patch(POOL_RUN)
+
+    assert unit.run_plugin(['cnto-http-monitor', '--no-such-option']).returncode == 2
+
+
+def test_bundled_force_subprocess(mocker):
+    """Assert bundled plugins are executed as subprocess if in-process execution is disabled"""
+
+    pool_run = mocker.patch(POOL_RUN, return_value=PluginResultMock(0))
+
+    result = unit.run_plugin(['cnto-http-monitor', 'http://foo.bar'], in_process=False)
+
+    pool_run.assert_called_once_with(['cnto-http-monitor', 'http://foo.bar'], timeout=None,
+                                     cancel=None)
+    assert result.returncode == Codes.OK.value
+
+
+def test_custom_mapping(mocker, tmpdir):
+    """Assert the status mapping from the configuration file is used to update Cachet"""
+
+    config_file = tmpdir.join('config.ini')
+    config_file.write('[Cachet]\nbase-url: http://some.url\napi-key: namaste\n'
+                      '[StatusMapping]\nWARNING: 2\n')
+    mocker.patch(POOL_RUN, return_value=PluginResultMock(Codes.WARNING.value))
+    cachet_update = mocker.patch('cachetclient.cachet.Components.put')
+
+    common.run_and_assert(unit.main, expected_code=Codes.OK, script=mocker.Mock(),
+                          component_id=99, config_file=config_file.strpath, retries=0)
+
+    cachet_update.assert_called_with(id=99, status=2)
+
+
+def test_status_cache(mocker, tmpdir):
+    """Assert Cachet is updated only when the component status changes"""
+
+    config_file = tmpdir.join('config.ini')
+    config_file.write('[Cachet]\nbase-url: http://some.url\napi-key: namaste\n'
+                      'status-cache: ' + tmpdir.join('cache.json').strpath + '\n')
+    mocker.patch(POOL_RUN, return_value=PluginResultMock(Codes.OK.value))
+    mocker.patch('cachetclient.cachet.Components.get',
+                 return_value='{"data": [{"id": 99, "status": 4}]}')
+    cachet_update = mocker.patch('cachetclient.cachet.Components.put')
+
+    for _ in range(3):
+        common.run_and_assert(unit.main, expected_code=Codes.OK, script=mocker.Mock(),
+                              component_id=99, config_file=config_file.strpath, retries=0)
+
+    cachet_update.assert_called_once_with(id=99, status=1)
+
+
+def test_journal(mocker, tmpdir):
+    """Assert the update is acknowledged while Cachet is down and delivered by a later run"""
+
+    config_file = tmpdir.join('config.ini')
+    config_file.write('[Cachet]\nbase-url: http://some.url\napi-key: namaste\n'
+                      'journal: ' + tmpdir.join('journal').strpath + '\n')
+    mocker.patch(POOL_RUN, return_value=PluginResultMock(Codes.CRITICAL.value))
+    cachet_update = mocker.patch('cachetclient.cachet.Components.put',
+                                 side_effect=[RuntimeError('cachet is down'), None])
+
+    common.run_and_assert(unit.main, expected_code=Codes.OK, script=mocker.Mock(),
+                          component_id=99, config_file=config_file.strpath, retries=0)
+    assert tmpdir.join('journal').read().count('"component": 99') == 1
+
+    common.run_and_assert(unit.main, expected_code=Codes.OK, script=mocker.Mock(),
+                          component_id=99, config_file=config_file.strpath, retries=0)
+    assert tmpdir.join('journal').read() == ''
+    assert cachet_update.call_count == 2
+    cachet_update.assert_called_with(id=99, status=4)
+
+
+def test_journal_unresponsive(mocker, tmpdir):
+    """Assert the runner does not wait for an unresponsive Cachet once the update is journaled"""
+
+    config_file = tmpdir.join('config.ini')
+    config_file.write('[Cachet]\nbase-url: http://some.url\napi-key: namaste\n'
+                      'journal: ' + tmpdir.join('journal').strpath + '\njournal-timeout: 0.2\n')
+    mocker.patch(POOL_RUN, return_value=PluginResultMock(Codes.CRITICAL.value))
+    release = threading.Event()
+    mocker.patch('cachetclient.cachet.Components.put', side_effect=lambda **_: release.wait(10))
+    start = time.monotonic()
+
+    try:
+        common.run_and_assert(unit.main, expected_code=Codes.OK, script=mocker.Mock(),
+                              component_id=99, config_file=config_file.strpath, retries=0)
+        assert time.monotonic() - start < 2
+        assert tmpdir.join('journal').read().count('"component": 99') == 1
+    finally:
+        release.set()
+
+
+def test_flapping(mocker, tmpdir):
+    """Assert a flapping component is reported as WARNING and its retries are skipped"""
+
+    config_file = tmpdir.join('config.ini')
+    config_file.write('[Cachet]\nbase-url: http://some.url\napi-key: namaste\n'
+                      '[Flapping]\nsize: 5\nhistory: ' + tmpdir.join('history.json').strpath +
+                      '\n')
+    pool_run = mocker.patch(POOL_RUN)
+    cachet_update = mocker.patch('cachetclient.cachet.Components.put')
+    mocker.patch('time.sleep')
+
+    for code in (Codes.OK, Codes.CRITICAL, Codes.OK, Codes.CRITICAL):
+        pool_run.return_value = PluginResultMock(code.value)
+        common.run_and_assert(unit.main, expected_code=Codes.OK, script=mocker.Mock(),
+                              component_id=99, config_file=config_file.strpath, retries=3)
+    cachet_update.assert_called_with(id=99, status=3)
+
+    pool_run.reset_mock()
+    common.run_and_assert(unit.main, expected_code=Codes.OK, script=mocker.Mock(),
+                          component_id=99, config_file=config_file.strpath, retries=3)
+    assert pool_run.call_count == 1
+
+
+def test_flapping_without_history(mocker, tmpdir, caplog):
+    """Assert the runner warns that a [Flapping] section without history detects nothing"""
+
+    config_file = tmpdir.join('config.ini')
+    config_file.write('[Cachet]\nbase-url: http://some.url\napi-key: namaste\n'
+                      '[Flapping]\nconfirmations: 2\n')
+    mocker.patch(POOL_RUN, return_value=PluginResultMock(Codes.OK.value))
+    mocker.patch('cachetclient.cachet.Components.put')
+
+    common.run_and_assert(unit.main, expected_code=Codes.OK, script=mocker.Mock(),
+                          component_id=99, config_file=config_file.strpath, retries=0)
+
+    assert 'no history file in the [Flapping] section' in caplog.text
+
+
+def test_deadline_timeout(mocker):
+    """Assert plugins get their time budget and are killed once it is exceeded"""
+
+    pool_run = mocker.patch(POOL_RUN, return_value=unit.PluginResult(
+        Codes.CRITICAL.value, 'CRITICAL: plugin timed out'))
+    mocker.patch('time.sleep')
+    policy = RetryPolicy(retries=1, interval=1, deadline=10)
+
+    status = unit.execute_plugin('/usr/lib/nagios/plugins/check_foo', ['-H', 'foo.bar'], policy,
+                                 pass_timeout=True)
+
+    assert status == Codes.CRITICAL
+    assert pool_run.call_count == 2
+    invocation = pool_run.call_args_list[0][0][0]
+    timeout = pool_run.call_args_list[0][1]['timeout']
+    assert invocation[:3] == ['/usr/lib/nagios/plugins/check_foo', '-H', 'foo.bar']
+    assert invocation[3] == '--timeout'
+    assert float(invocation[4]) == pytest.approx(timeout * unit.PLUGIN_TIMEOUT_RATIO, abs=0.001)
+    assert 0 < timeout <= 4.5
+
+
+def test_foreign_no_timeout_argument(mocker):
+    """Assert foreign plugins do not get --timeout unless requested"""
+
+    pool_run = mocker.patch(POOL_RUN, return_value=PluginResultMock(0))
+
+    unit.execute_plugin('check_foo', ['-H', 'foo.bar'], RetryPolicy(deadline=10))
+
+    assert pool_run.call_args[0][0] == ['check_foo', '-H', 'foo.bar']
+
+
+def test_quorum_early_decision(mocker):
+    """Assert the quorum status is returned as soon as decided, cancelling remaining attempts"""
+
+    pool_run = mocker.patch(POOL_RUN, return_value=PluginResultMock(
+        Codes.CRITICAL.value))
+
+    status = unit.execute('check_foo', [], QuorumPolicy(attempts=3, stagger=0.2))
+
+    assert status == Codes.CRITICAL
+    assert pool_run.call_count == 2
+
+
+def test_quorum_first_ok(mocker):
+    """Assert first-ok decision reports OK as soon as one attempt succeeds"""
+
+    mocker.patch(POOL_RUN, side_effect=[PluginResultMock(Codes.CRITICAL.value),
+                                        PluginResultMock(Codes.OK.value),
+                                        PluginResultMock(Codes.CRITICAL.value)])
+
+    status = unit.execute('check_foo', [], QuorumPolicy(attempts=3, decision='first-ok',
+                                                        stagger=0.05))
+
+    assert status == Codes.OK
+
+
+def test_quorum_kills_abandoned(tmpdir):
+    """Assert subprocess attempts still running once the status is decided are killed"""
+
+    pids = tmpdir.mkdir('pids')
+    plugin = tmpdir.join('check_race')
+    # The first attempt reports OK after a while, the other ones hang
+    source = ('#!%s\n'
+              'import os, time\n'
+              'open(os.path.join(%r, str(os.getpid())), "w").close()\n'
+              'try:\n'
+              '    os.close(os.open(%r, os.O_CREAT | os.O_EXCL))\n'
+              '    time.sleep(0.6)\n'
+              'except FileExistsError:\n'
+              '    time.sleep(30)\n')
+    plugin.write(source % (sys.executable, pids.strpath, tmpdir.join('first').strpath))
+    plugin.chmod(0o755)
+
+    status = unit.execute(plugin.strpath, [], QuorumPolicy(attempts=3, decision='first-ok',
+                                                           stagger=0.2))
+
+    assert status == Codes.OK
+    assert len(pids.listdir()) == 3
+    deadline = time.monotonic() + 5
+    while any(os.path.exists('/proc/' + pid.basename) for pid in pids.listdir()):
+        assert time.monotonic() < deadline
+        time.sleep(0.05)
+
+
+def test_quorum_incompatible(mocker):
+    """Assert incompatible exit codes are reported in quorum mode too"""
+
+    mocker.patch(POOL_RUN, return_value=PluginResultMock(42))
+
+    with pytest.raises(unit.IncompatiblePluginError):
+        unit.execute('check_foo', [], QuorumPolicy(attempts=3, stagger=0))
+
+
+def test_probe_metrics(mocker):
+    """Assert attempts, retries, durations and final status are recorded per component"""
+
+    mocker.patch(POOL_RUN, side_effect=[PluginResultMock(Codes.CRITICAL.value),
+                                        PluginResultMock(Codes.OK.value)])
+    mocker.patch('time.sleep')
+    probe = metrics.ProbeMetrics.of(42)
+    attempts, retries = probe.attempts.value, probe.retries.value
+    observations = sum(probe.duration.counts)
+
+    status = unit.execute('check_foo', [], RetryPolicy(retries=3), component_id=42)
+    unit.update_component(mocker.Mock(), 42, status)
+
+    assert probe.attempts.value - attempts == 2
+    assert probe.retries.value - retries == 1
+    assert sum(probe.duration.counts) - observations == 2
+    assert metrics.CHECK_STATUS.labels(42).value == Codes.OK.value
+
+
+def test_publish_perfdata(mocker, config):  # pylint: disable=W0621
+    """Assert mapped perfdata of the plugin output is published to Cachet metrics"""
+
+    mocker.patch(POOL_RUN, return_value=unit.PluginResult(
+        Codes.OK.value, 'OK: fine | rtt=0.25s;1;2;0 loss=0%\nlong output | players=12'))
+    mocker.patch('cachetclient.cachet.Components.put')
+    points_post = mocker.patch('cachetclient.cachet.Points.post')
+
+    common.run_and_assert(unit.main, expected_code=Codes.OK, script='check_foo',
+                          component_id=99, config_file=config, retries=0,
+                          metric_ids={'rtt': 7, 'players': 8, 'jitter': 9})
+
+    assert points_post.call_count == 2
+    assert sorted((call[1]['id'], call[1]['value']) for call in points_post.call_args_list) == [
+        (7, 0.25), (8, 12)]
+
+
+def test_publish_timeout(mocker, tmpdir):
+    """Assert metric points are posted with the Cachet requests timeout"""
+
+    config_file = tmpdir.join('config.ini')
+    config_file.write('[Cachet]\nbase-url: http://some.url\napi-key: namaste\ntimeout: 2\n')
+    mocker.patch(POOL_RUN,
+                 return_value=unit.PluginResult(Codes.OK.value, 'OK: fine | rtt=0.25s'))
+    mocker.patch('cachetclient.cachet.Components.put')
+    points = mocker.patch('cachetclient.cachet.Points')
+
+    common.run_and_assert(unit.main, expected_code=Codes.OK, script='check_foo',
+                          component_id=99, config_file=config_file.strpath, retries=0,
+                          metric_ids={'rtt': 7})
+
+    assert points.call_args[1]['timeout'] == 2
+    assert points.return_value.post.call_count == 1
+
+
+def test_metrics_file(mocker, config, tmpdir):  # pylint: disable=W0621
+    """Assert the run metrics are written to the metrics file along with published perfdata"""
+
+    mocker.patch(POOL_RUN,
+                 return_value=unit.PluginResult(Codes.OK.value, 'OK: fine | rtt=0.25s'))
+    mocker.patch('cachetclient.cachet.Components.put')
+    mocker.patch('cachetclient.cachet.Points.post')
+    metrics_file = tmpdir.join('runner.prom')
+
+    common.run_and_assert(unit.main, expected_code=Codes.OK, script='check_foo',
+                          component_id=99, config_file=config, retries=0,
+                          metric_ids={'rtt': 7}, metrics_file=metrics_file.strpath)
+
+    assert 'cnto_check_status{component="99"} 0' in metrics_file.read()
@@ -0,0 +1,44 @@
+"""Test suite for monitoring_scripts.cli"""
+
+import subprocess
+import sys
+
+import pytest
+
+from monitoring_scripts import cli as unit
+
+HEAVY_DEPENDENCIES = ('requests', 'valve', 'cachetclient', 'http.server', 'socketserver')
+
+
+@pytest.mark.parametrize('command', list(unit.COMMANDS))
+def test_dispatch(mocker, command):
+    """Assert the arguments following the command are passed to its entry point"""
+
+    module, entry_point = unit.COMMANDS[command]
+    command_entry_point = mocker.patch(module + '.' + entry_point)
+
+    unit.cli_entry_point([command, '--timeout', '5', 'foo'])
+
+    command_entry_point.assert_called_once_with(['--timeout', '5', 'foo'])
+
+
+def test_unknown_command():
+    """Assert unknown commands are rejected"""
+
+    with pytest.raises(SystemExit) as execution_result:
+        unit.cli_entry_point(['foo'])
+
+    assert execution_result.value.code == 2
+
+
+@pytest.mark.parametrize('command', list(unit.COMMANDS))
+def test_lazy_imports(command):
+    """Assert heavy dependencies are not imported before the command arguments are validated"""
+
+    module, _ = unit.COMMANDS[command]
+    code = 'import sys, %s; print(",".join(sorted(set(%r) & set(sys.modules))))' % (
+        module, HEAVY_DEPENDENCIES)
+
+    output = subprocess.check_output([sys.executable, '-c', code], universal_newlines=True)
+
+    assert output.strip() == ''
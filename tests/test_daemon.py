@@ -0,0 +1,253 @@
+"""Test suite for monitoring_scripts.daemon"""
+
+import threading
+import time
+
+import pytest
+
+from monitoring_scripts import daemon as unit
+from monitoring_scripts import check_runner
+from monitoring_scripts import metrics
+from monitoring_scripts import settings
+from monitoring_scripts.nagios_common import Codes
+from monitoring_scripts.retry import RetryPolicy
+from monitoring_scripts.settings import Check
+
+
+def make_check(name='website', component_id=1, interval=0.01):
+    """Build a check declaration with sensible test defaults"""
+
+    return Check(name=name, script='cnto-http-monitor', args=['http://foo.bar'],
+                 component_id=component_id, interval=interval,
+                 retry_policy=RetryPolicy(retries=0), pass_timeout=False)
+
+
+def test_run_check_updates(mocker):
+    """Assert a check result is forwarded to Cachet through the shared client"""
+
+    mocker.patch('monitoring_scripts.check_runner.execute_plugin', return_value=Codes.CRITICAL)
+    components = mocker.Mock()
+
+    unit.CheckDaemon([], components).run_check(make_check(component_id=7))
+
+    components.put.assert_called_once_with(id=7, status=check_runner.codes_mapping[
+        Codes.CRITICAL])
+
+
+@pytest.mark.parametrize(
+    'exception',
+    [
+        check_runner.IncompatiblePluginError(42),
+        RuntimeError('cachet is down'),
+    ]
+)
+def test_run_check_survives(mocker, exception):
+    """Assert check failures do not propagate out of the daemon"""
+
+    mocker.patch('monitoring_scripts.check_runner.execute_plugin', side_effect=exception)
+
+    unit.CheckDaemon([], mocker.Mock()).run_check(make_check())
+
+
+def test_periodic_save(mocker, tmpdir):
+    """Assert the status cache and metrics file are saved periodically and on stop, not after
+    every check"""
+
+    mocker.patch('monitoring_scripts.check_runner.execute_plugin', return_value=Codes.OK)
+    status_cache = mocker.Mock(dirty=True)
+    status_cache.needs_update.return_value = True
+    metrics_file = tmpdir.join('daemon.prom')
+    daemon = unit.CheckDaemon([make_check()], mocker.Mock(), status_cache=status_cache,
+                              metrics_file=metrics_file.strpath, save_interval=0.2)
+
+    thread = threading.Thread(target=daemon.run)
+    thread.start()
+    time.sleep(0.5)
+    daemon.stop()
+    thread.join(5)
+
+    assert status_cache.record.call_count > 10
+    assert 2 <= status_cache.save.call_count <= 4
+    assert 'cnto_scheduler_lag_seconds' in metrics_file.read()
+
+
+def test_scheduling(mocker):
+    """Assert every check is executed repeatedly with a single Cachet client"""
+
+    executions = {'website': threading.Event(), 'teamspeak': threading.Event()}
+    counts = {'website': 0, 'teamspeak': 0}
+
+    def run_check(check):
+        counts[check.name] += 1
+        if counts[check.name] >= 3:
+            executions[check.name].set()
+
+    components = mocker.Mock()
+    checks = [make_check('website', 1), make_check('teamspeak', 2)]
+    daemon = unit.CheckDaemon(checks, components, workers=2)
+    mocker.patch.object(daemon, 'run_check', side_effect=run_check)
+
+    thread = threading.Thread(target=daemon.run)
+    thread.start()
+    try:
+        for event in executions.values():
+            assert event.wait(5)
+    finally:
+        daemon.stop()
+        thread.join(5)
+
+    assert not thread.is_alive()
+
+
+def test_lag_saturated(mocker):
+    """Assert the scheduling lag includes the wait for a free worker"""
+
+    started = []
+
+    def run_check(check):
+        started.append(check.name)
+        time.sleep(0.3)
+
+    daemon = unit.CheckDaemon([make_check('website', 1, 60), make_check('teamspeak', 2, 60)],
+                              mocker.Mock(), workers=1, spread=False)
+    mocker.patch.object(daemon, 'run_check', side_effect=run_check)
+    lag = metrics.SCHEDULER_LAG.labels()
+    observed, total = sum(lag.counts), lag.sum
+
+    thread = threading.Thread(target=daemon.run)
+    thread.start()
+    try:
+        while len(started) < 2:
+            time.sleep(0.01)
+    finally:
+        daemon.stop()
+        thread.join(5)
+
+    assert sum(lag.counts) - observed == 2
+    assert lag.sum - total >= 0.3
+
+
+def test_no_checks(tmpdir):
+    """Assert the daemon refuses to start without checks"""
+
+    config_file = tmpdir.join('config.ini')
+    config_file.write('[Cachet]\nbase-url: http://some.url\napi-key: namaste\n')
+
+    with pytest.raises(ValueError):
+        unit.main(config_file.strpath)
+
+
+@pytest.mark.parametrize('journal,timeout', [(False, None), (True, 5.0)])
+def test_main_timeout(mocker, tmpdir, journal, timeout):
+    """Assert Cachet requests are bounded by default once a journal is configured"""
+
+    config_file = tmpdir.join('config.ini')
+    config_file.write('[Cachet]\nbase-url: http://some.url\napi-key: namaste\n' +
+                      ('journal: %s\n' % tmpdir.join('journal').strpath if journal else '') +
+                      '[Check:website]\nscript: cnto-http-monitor\ncomponent-id: 1\n')
+    components = mocker.patch('cachetclient.cachet.Components')
+    points = mocker.patch('cachetclient.cachet.Points')
+    mocker.patch.object(unit.CheckDaemon, 'run')
+    mocker.patch('signal.signal')
+
+    unit.main(config_file.strpath)
+
+    assert components.call_args[1]['timeout'] == timeout
+    assert points.call_args[1]['timeout'] == timeout
+
+
+def test_reload(mocker):
+    """Assert only the added and modified checks are rescheduled after a reload"""
+
+    runs = []
+    executed = threading.Event()
+
+    def run_check(check):
+        runs.append((check.name, check.interval))
+        if check.name == 'forum':
+            executed.set()
+
+    daemon = unit.CheckDaemon([make_check('website', 1, 60), make_check('teamspeak', 2, 60)],
+                              mocker.Mock(), workers=2, spread=False)
+    mocker.patch.object(daemon, 'run_check', side_effect=run_check)
+
+    thread = threading.Thread(target=daemon.run)
+    thread.start()
+    try:
+        while len(runs) < 2:
+            time.sleep(0.01)
+        diff = daemon.reload([make_check('teamspeak', 2, 30), make_check('forum', 3, 60)])
+        assert executed.wait(5)
+        time.sleep(0.05)
+    finally:
+        daemon.stop()
+        thread.join(5)
+
+    assert diff == settings.ChecksDiff(added=['forum'], removed=['website'],
+                                       modified=['teamspeak'])
+    assert sorted(runs) == [('forum', 60), ('teamspeak', 30), ('teamspeak', 60),
+                            ('website', 60)]
+
+
+def test_reload_added_again(mocker):
+    """Assert a check modified, removed then added again is scheduled only once"""
+
+    runs = []
+    daemon = unit.CheckDaemon([make_check('website', 1, 60)], mocker.Mock(), workers=2,
+                              spread=False)
+    mocker.patch.object(daemon, 'run_check', side_effect=lambda _: runs.append(time.monotonic()))
+
+    thread = threading.Thread(target=daemon.run)
+    thread.start()
+    try:
+        while not runs:
+            time.sleep(0.01)
+        daemon.reload([make_check('website', 1, 0.5)])
+        daemon.reload([])
+        daemon.reload([make_check('website', 1, 0.5)])
+        start = time.monotonic()
+        time.sleep(1.2)
+    finally:
+        daemon.stop()
+        thread.join(5)
+
+    assert len([run for run in runs if run >= start]) <= 3
+
+
+CONFIG = '[Cachet]\nbase-url: http://some.url\napi-key: namaste\n'
+CHECK = '[Check:website]\nscript: cnto-http-monitor\ncomponent-id: %s\n'
+
+
+def test_config_watcher(mocker, tmpdir):
+    """Assert the checks of a changed configuration are passed on and invalid ones rejected"""
+
+    config_file = tmpdir.join('config.ini')
+    config_file.write(CONFIG + CHECK % 1)
+    callback = mocker.Mock()
+    watcher = unit.ConfigWatcher(config_file.strpath, callback)
+
+    assert not watcher.poll()
+
+    config_file.write(CONFIG + CHECK % 'one')
+    assert not watcher.poll()
+    callback.assert_not_called()
+
+    config_file.write(CONFIG + CHECK % 12)
+    assert watcher.poll()
+    assert callback.call_args[0][0][0].component_id == 12
+
+    assert watcher.poll(force=True)
+    assert callback.call_count == 2
+
+
+def test_phase_delay():
+    """Assert checks run at a fixed phase of their interval, spread among checks"""
+
+    delays = [unit.phase_delay('check-%d' % index, 60, now=0) for index in range(1000)]
+    assert all(0 <= delay < 60 for delay in delays)
+    assert [sum(1 for delay in delays if 6 * bucket <= delay < 6 * (bucket + 1))
+            for bucket in range(10)] == pytest.approx([100] * 10, abs=30)
+
+    delay = unit.phase_delay('website', 60, now=0)
+    assert unit.phase_delay('website', 60, now=15) == pytest.approx((delay - 15) % 60)
+    assert unit.phase_delay('website', 60, now=60) == pytest.approx(delay)
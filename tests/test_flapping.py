@@ -0,0 +1,71 @@
+"""Test suite for monitoring_scripts.flapping"""
+
+import pytest
+
+from monitoring_scripts import flapping as unit
+from monitoring_scripts.nagios_common import Codes
+
+
+def test_confirmations():
+    """Assert a status change is reported once seen `confirmations` times in a row"""
+
+    detector = unit.FlapDetector(confirmations=2)
+
+    reported = [detector.record(99, status) for status in
+                (Codes.OK, Codes.CRITICAL, Codes.OK, Codes.CRITICAL, Codes.CRITICAL, Codes.OK)]
+
+    assert reported == [Codes.OK, Codes.OK, Codes.OK, Codes.OK, Codes.CRITICAL, Codes.CRITICAL]
+
+
+def test_flapping():
+    """Assert an alternating component is reported flapping until it settles"""
+
+    detector = unit.FlapDetector(size=11)
+
+    reported = [detector.record(99, status) for status in [Codes.OK, Codes.CRITICAL] * 4]
+    assert detector.is_flapping(99)
+    assert reported[-1] == unit.FLAPPING_STATUS
+    assert not detector.is_flapping(98)
+
+    reported = [detector.record(99, Codes.OK) for _ in range(10)]
+    assert not detector.is_flapping(99)
+    assert reported[-1] == Codes.OK
+
+
+def test_flap_percentage():
+    """Assert state changes are weighted from the oldest to the newest"""
+
+    history = unit.History(size=3)
+    history.append(Codes.OK)
+    history.reported = Codes.OK
+    history.append(Codes.OK)
+    history.append(Codes.CRITICAL)
+    assert history.flap_percentage() == pytest.approx(60.0)
+
+    history.append(Codes.CRITICAL)
+    assert history.flap_percentage() == pytest.approx(40.0)
+    assert len(history.states) == 3
+
+
+def test_persistence(tmpdir):
+    """Assert histories are saved and loaded along with the pending confirmation"""
+
+    path = tmpdir.join('history.json').strpath
+    detector = unit.FlapDetector(confirmations=2, path=path)
+    detector.record(99, Codes.OK)
+    detector.record(99, Codes.CRITICAL)
+    detector.save()
+
+    detector = unit.FlapDetector(confirmations=2, path=path)
+    assert detector.load()
+    assert detector.record(99, Codes.CRITICAL) == Codes.CRITICAL
+    assert not unit.FlapDetector(path=tmpdir.join('missing.json').strpath).load()
+
+
+def test_invalid_settings():
+    """Assert inconsistent settings are rejected"""
+
+    with pytest.raises(ValueError):
+        unit.FlapDetector(size=2)
+    with pytest.raises(ValueError):
+        unit.FlapDetector(low_threshold=60, high_threshold=50)
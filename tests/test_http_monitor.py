@@ -1,5 +1,10 @@
 """Test suite for monitoring_scripts.http_monitor"""
 
+import datetime
+import http.server
+import socket
+import threading
+
 import pytest
 import requests
 
@@ -8,6 +13,14 @@ from monitoring_scripts.nagios_common import Codes
 from . import common
 
 
+@pytest.fixture(autouse=True)
+def resolver(mocker):
+    """Resolve every host to the loopback address without querying DNS"""
+
+    return mocker.patch('socket.getaddrinfo', side_effect=lambda host, port, *_: [
+        (socket.AF_INET, socket.SOCK_DGRAM, 0, '', ('127.0.0.1', port))])
+
+
 # pylint: disable-msg=too-many-arguments
 def run_and_assert(capfd, expected_code=Codes.OK, url='http://foo.bar',
                    timeout=30, redirect_unknown=True, debug=False):
@@ -23,6 +36,7 @@ def generate_response(mocker, status_code=200):
 
     response = mocker.Mock()
     response.status_code = status_code
+    response.elapsed = datetime.timedelta(milliseconds=42)
 
     return response
 
@@ -51,7 +65,7 @@ def test_invalid_url(capfd, url):
 def test_exception(mocker, capfd, exception, expected_code):
     """Assert correct status when exception is raised"""
 
-    mocker.patch('requests.head', side_effect=exception)
+    mocker.patch('requests.Session.head', side_effect=exception)
 
     run_and_assert(capfd=capfd, expected_code=expected_code)
 
@@ -65,7 +79,7 @@ def test_exception(mocker, capfd, exception, expected_code):
 def test_nominal(mocker, capfd, status_code, kwargs):
     """Assert OK status with successful HTTP status code"""
 
-    mocker.patch('requests.head',
+    mocker.patch('requests.Session.head',
                  return_value=generate_response(mocker, status_code))
 
     run_and_assert(capfd=capfd, expected_code=Codes.OK, **kwargs)
@@ -80,7 +94,7 @@ def test_nominal(mocker, capfd, status_code, kwargs):
 def test_unknown(mocker, capfd, status_code, kwargs):
     """Assert UNKNOWN status with successful HTTP status code"""
 
-    mocker.patch('requests.head',
+    mocker.patch('requests.Session.head',
                  return_value=generate_response(mocker, status_code))
 
     run_and_assert(capfd=capfd, expected_code=Codes.UNKNOWN, **kwargs)
@@ -96,7 +110,187 @@ def test_unknown(mocker, capfd, status_code, kwargs):
 def test_critical(mocker, capfd, status_code, kwargs):
     """Assert UNKNOWN status with successful HTTP status code"""
 
-    mocker.patch('requests.head',
+    mocker.patch('requests.Session.head',
                  return_value=generate_response(mocker, status_code))
 
     run_and_assert(capfd=capfd, expected_code=Codes.CRITICAL, **kwargs)
+
+
+def test_batch(mocker, capfd, tmpdir):
+    """Assert batch mode reports every URL and returns the worst status"""
+
+    status_codes = {
+        'http://foo.bar/': 200,
+        'http://foo.bar/down': 503,
+        'https://other.bar/': 302,
+    }
+
+    def head(_, url, **__):
+        return generate_response(mocker, status_codes[url])
+
+    mocker.patch('requests.Session.head', autospec=True, side_effect=head)
+    url_file = tmpdir.join('urls.txt')
+    url_file.write('# comment\n\nhttp://foo.bar/down\n')
+
+    common.run_and_assert(unit.batch_main, expected_code=Codes.CRITICAL, capfd=None,
+                          urls=['http://foo.bar/', 'https://other.bar/'],
+                          url_file=url_file.strpath, workers=2)
+
+    out = capfd.readouterr()[0]
+    assert out.startswith('CRITICAL: 2 of 3 URLs not OK | ')
+    assert "'http://foo.bar/ ttfb'=0.042s;;;0" in out
+    assert 'OK: http://foo.bar/ status code is 200' in out
+    assert 'CRITICAL: http://foo.bar/down status code is 503' in out
+    assert 'UNKNOWN: https://other.bar/ redirection' in out
+
+
+def test_batch_exceptions(mocker):
+    """Assert batch mode keeps the single URL exception mapping"""
+
+    mocker.patch('requests.Session.head', side_effect=requests.ConnectTimeout)
+
+    results = unit.check_urls(['http://foo.bar', 'http:/invalid'], workers=2)
+
+    assert [result[:3] for result in results] == [
+        ('http://foo.bar', Codes.CRITICAL, 'connection timeout'),
+        ('http:/invalid', Codes.UNKNOWN, 'provided URL is not valid'),
+    ]
+
+
+def test_check_urls_isolated(mocker):
+    """Assert a URL which cannot be requested is UNKNOWN without failing the others"""
+
+    mocker.patch('requests.Session.head', return_value=mocker.Mock(
+        status_code=200, elapsed=datetime.timedelta(seconds=0.1)))
+
+    results = unit.check_urls(['http://foo.bar', 'http://foo.bar:abc/'], workers=2)
+
+    assert [result[:2] for result in results] == [
+        ('http://foo.bar', Codes.OK),
+        ('http://foo.bar:abc/', Codes.UNKNOWN),
+    ]
+    assert 'abc' in results[1][2]
+
+
+def test_batch_no_url(capfd):
+    """Assert UNKNOWN status if batch mode has nothing to check"""
+
+    common.run_and_assert(unit.batch_main, expected_code=Codes.UNKNOWN, capfd=capfd,
+                          expected_message='no URL', urls=[])
+
+
+def test_unresolvable(resolver, capfd):  # pylint: disable=W0621
+    """Assert UNKNOWN status if the host name cannot be resolved"""
+
+    resolver.side_effect = socket.gaierror
+
+    run_and_assert(capfd=capfd, expected_code=Codes.UNKNOWN)
+
+
+def test_perfdata(mocker, capfd):
+    """Assert phase timings are reported as perfdata"""
+
+    mocker.patch('requests.Session.head', return_value=generate_response(mocker))
+
+    run_and_assert(capfd=None, expected_code=Codes.OK)
+
+    out = capfd.readouterr()[0]
+    assert out.startswith('OK: status code is 200 | dns=')
+    assert 'ttfb=0.042s;;;0 total=' in out
+
+
+@pytest.mark.parametrize(
+    'thresholds,expected_code',
+    [
+        ({'warning_latency': 0}, Codes.WARNING),
+        ({'warning_latency': 0, 'critical_latency': 0}, Codes.CRITICAL),
+        ({'warning_latency': 60}, Codes.OK),
+    ]
+)
+def test_latency_thresholds(mocker, capfd, thresholds, expected_code):
+    """Assert slow responses trigger a WARNING or CRITICAL status"""
+
+    mocker.patch('requests.Session.head', return_value=generate_response(mocker))
+
+    common.run_and_assert(unit.main, expected_code=expected_code, capfd=capfd,
+                          url='http://foo.bar', **thresholds)
+
+
+def test_phases_perfdata(mocker):
+    """Assert connection phases are reported and excluded from the time to first byte"""
+
+    mocker.patch('requests.Session.head', return_value=generate_response(mocker))
+    mocker.patch('monitoring_scripts.http_pool.phases', return_value=(0.01, 0.02))
+
+    code, _, perfdata = unit.check_url('https://foo.bar', fresh_every=5)
+
+    values = {item.label: item.value for item in perfdata}
+    assert code == Codes.OK
+    assert (values['connect'], values['tls']) == (0.01, 0.02)
+    assert values['ttfb'] == pytest.approx(0.012)
+
+
+def test_single_resolution(resolver):  # pylint: disable=W0621
+    """Assert the host is resolved once, the request connecting to the resolved address"""
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        """Answer HEAD requests"""
+
+        def do_HEAD(self):  # pylint: disable=C0103
+            """Answer HEAD requests"""
+
+            self.send_response(200)
+            self.end_headers()
+
+        def log_message(self, *_):  # pylint: disable=W0221
+            pass
+
+    server = http.server.HTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        code, _, _ = unit.check_url('http://foo.bar:%d/' % server.server_address[1])
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    assert code == Codes.OK
+    assert resolver.call_count == 1
+
+
+@pytest.mark.parametrize(
+    'pattern,regex,max_bytes,expected',
+    [
+        ('healthy', False, 100, (True, 16)),
+        ('heal', False, 100, (True, 12)),
+        (r'he[a-z]+y', True, 100, (True, 16)),
+        ('missing', False, 100, (False, 16)),
+        ('healthy', False, 10, (False, 10)),
+    ]
+)
+def test_body_expectation(mocker, pattern, regex, max_bytes, expected):
+    """Assert the pattern is found across chunk boundaries within the byte limit"""
+
+    response = mocker.Mock()
+    response.iter_content.return_value = iter([b'stat', b'us: ', b'heal', b'thy!'])
+
+    expectation = unit.BodyExpectation(pattern, regex, max_bytes, chunk_size=4)
+
+    assert expectation.scan(response) == expected
+
+
+@pytest.mark.parametrize('body,expected_code', [(b'status: ok', Codes.OK),
+                                                (b'database error', Codes.CRITICAL)])
+def test_expect_body(mocker, body, expected_code):
+    """Assert a streamed GET is sent and its body decides the status"""
+
+    response = generate_response(mocker)
+    response.iter_content.return_value = iter([body])
+    http_get = mocker.patch('requests.Session.get', return_value=response)
+
+    code, _, perfdata = unit.check_url('http://foo.bar',
+                                       expectation=unit.BodyExpectation('status: ok'))
+
+    assert code == expected_code
+    http_get.assert_called_once_with('http://foo.bar', timeout=30, stream=True)
+    response.close.assert_called_once_with()
+    assert {item.label: item.value for item in perfdata}['bytes'] == len(body)
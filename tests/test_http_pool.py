@@ -0,0 +1,86 @@
+"""Test suite for monitoring_scripts.http_pool"""
+
+import http.server
+import threading
+
+import pytest
+
+from monitoring_scripts import http_pool as unit
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    """Answer HEAD requests on kept-alive connections"""
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_HEAD(self):  # pylint: disable=C0103
+        """Answer HEAD requests, echoing the Host header"""
+
+        self.send_response(200)
+        self.send_header('X-Host', self.headers['Host'])
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *_):  # pylint: disable=W0221
+        pass
+
+
+@pytest.fixture
+def server():
+    """Serve HTTP on the loopback interface"""
+
+    http_server = http.server.HTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=http_server.serve_forever, daemon=True)
+    thread.start()
+    yield 'http://127.0.0.1:%d/' % http_server.server_address[1]
+    http_server.shutdown()
+    http_server.server_close()
+
+
+def head(sessions, url, fresh_every=0):
+    """Send a HEAD request through the origin session, return the timed connection phases"""
+
+    unit.reset_phases()
+    sessions.get(url, fresh_every).head(url, timeout=5)
+    return unit.phases()
+
+
+def test_connection_reuse(server):
+    """Assert the connection is timed when opened and reused by the following checks"""
+
+    sessions = unit.OriginSessions()
+    try:
+        assert head(sessions, server)[0] > 0
+        assert head(sessions, server) == (0, 0)
+        assert head(sessions, server) == (0, 0)
+    finally:
+        sessions.close()
+
+
+def test_fresh_connection(server):
+    """Assert every N-th check of an origin opens a new connection"""
+
+    sessions = unit.OriginSessions()
+    try:
+        connect_times = [head(sessions, server, fresh_every=2)[0] for _ in range(4)]
+    finally:
+        sessions.close()
+
+    assert [connect_time > 0 for connect_time in connect_times] == [True, True, False, True]
+
+
+def test_pinned_address(server):
+    """Assert connections use the pinned address while the Host header keeps the host name"""
+
+    port = int(server.rsplit(':', 1)[1].strip('/'))
+    url = 'http://pinned.invalid:%d/' % port
+    sessions = unit.OriginSessions()
+    unit.pin_address('pinned.invalid', port, '127.0.0.1')
+    try:
+        response = sessions.get(url).head(url, timeout=5)
+    finally:
+        unit.unpin_addresses()
+        sessions.close()
+
+    assert response.status_code == 200
+    assert response.headers['X-Host'] == 'pinned.invalid:%d' % port
@@ -0,0 +1,120 @@
+"""Test suite for monitoring_scripts.journal"""
+
+import threading
+
+from monitoring_scripts import cachet_updater
+from monitoring_scripts import journal as unit
+
+
+def test_collapse(tmpdir):
+    """Assert only the latest status of each component is pending"""
+
+    journal = unit.UpdateJournal(tmpdir.join('journal').strpath)
+    journal.put(id=1, status=4)
+    journal.put(id=2, status=3)
+    journal.put(id=1, status=1)
+
+    assert list(journal.pending().items()) == [(2, 3), (1, 1)]
+
+
+def test_drain(mocker, tmpdir):
+    """Assert delivered updates are removed from the journal and failed ones are kept"""
+
+    components = mocker.Mock()
+    components.put.side_effect = [None, RuntimeError('cachet is down'), None]
+    journal = unit.UpdateJournal(tmpdir.join('journal').strpath)
+    journal.put(id=1, status=4)
+    journal.put(id=2, status=3)
+    updater = cachet_updater.CachetUpdater(components, window=0, concurrency=1)
+
+    assert journal.drain(updater) == 1
+    assert dict(journal.pending()) == {2: 3}
+    assert journal.drain(updater) == 1
+    assert not journal.pending()
+    updater.close()
+
+
+def test_replay_after_crash(mocker, tmpdir):
+    """Assert a line truncated by a crash is skipped and does not corrupt later updates"""
+
+    path = tmpdir.join('journal')
+    path.write('{"component": 1, "status": 4}\n{"component": 2, "sta')
+    journal = unit.UpdateJournal(path.strpath)
+    journal.put(id=3, status=1)
+    components = mocker.Mock()
+    updater = cachet_updater.CachetUpdater(components, window=0, concurrency=1)
+
+    assert journal.drain(updater) == 2
+    updater.close()
+
+    assert components.put.call_count == 2
+    components.put.assert_any_call(id=1, status=4)
+    components.put.assert_any_call(id=3, status=1)
+
+
+def test_circuit_breaker(mocker, tmpdir):
+    """Assert nothing is sent while the circuit is open and a single update is tried once half
+    open"""
+
+    components = mocker.Mock()
+    components.put.side_effect = RuntimeError('cachet is down')
+    journal = unit.UpdateJournal(tmpdir.join('journal').strpath)
+    journal.put(id=1, status=4)
+    journal.put(id=2, status=4)
+    breaker = unit.CircuitBreaker(failure_threshold=2, reset_timeout=60,
+                                  path=tmpdir.join('breaker').strpath)
+    updater = cachet_updater.CachetUpdater(components, window=0, concurrency=1)
+
+    journal.drain(updater, breaker)
+    journal.drain(updater, breaker)
+    assert breaker.state() == 'open'
+    assert components.put.call_count == 4
+    journal.drain(updater, breaker)
+    assert components.put.call_count == 4
+
+    # The state is shared with the next process
+    breaker = unit.CircuitBreaker(failure_threshold=2, reset_timeout=60,
+                                  path=tmpdir.join('breaker').strpath)
+    assert breaker.state() == 'open'
+    breaker.opened_at -= 60
+    assert breaker.state() == 'half-open'
+    journal.drain(updater, breaker)
+    assert components.put.call_count == 5
+    assert breaker.state() == 'open'
+
+    components.put.side_effect = None
+    breaker.opened_at -= 60
+    assert journal.drain(updater, breaker) == 2
+    assert breaker.state() == 'closed'
+    assert not journal.pending()
+    updater.close()
+
+
+def test_concurrent_drains(mocker, tmpdir):
+    """Assert a drain started while another one sends is skipped, and updates journaled
+    meanwhile survive the rewrite of the journal by the first drain"""
+
+    path = tmpdir.join('journal').strpath
+    first, second = unit.UpdateJournal(path), unit.UpdateJournal(path)
+    for component_id in range(1, 6):
+        first.put(id=component_id, status=1)
+    sending, release = threading.Event(), threading.Event()
+
+    def put(**_):
+        sending.set()
+        release.wait(5)
+        raise RuntimeError('cachet is down')
+
+    components = mocker.Mock()
+    components.put.side_effect = put
+    thread = threading.Thread(target=first.drain, args=(components,))
+    thread.start()
+    assert sending.wait(5)
+
+    assert second.drain(mocker.Mock()) == 0
+    second.put(id=3, status=4)
+    release.set()
+    thread.join(5)
+
+    assert dict(second.pending()) == {1: 1, 2: 1, 3: 4, 4: 1, 5: 1}
+    assert components.put.call_count == 1
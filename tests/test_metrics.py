@@ -0,0 +1,83 @@
+"""Test suite for monitoring_scripts.metrics"""
+
+import urllib.request
+
+import pytest
+
+from monitoring_scripts import metrics as unit
+
+
+def test_counter_render():
+    """Assert counters are rendered with their labels"""
+
+    counter = unit.Counter('checks_total', 'Checks', ['component'])
+    counter.labels(2).inc()
+    counter.labels(1).inc(3)
+
+    assert counter.render() == ('# HELP checks_total Checks\n'
+                                '# TYPE checks_total counter\n'
+                                'checks_total{component="1"} 3\n'
+                                'checks_total{component="2"} 1\n')
+
+
+def test_unlabeled_metric():
+    """Assert metrics without labels are rendered before any observation"""
+
+    gauge = unit.Gauge('status', 'Status')
+
+    assert gauge.render().endswith('status 0\n')
+    gauge.labels().set(2.5)
+    assert gauge.render().endswith('status 2.5\n')
+
+
+def test_wrong_labels():
+    """Assert label values must match the label names"""
+
+    with pytest.raises(ValueError):
+        unit.Counter('checks_total', 'Checks', ['component']).labels()
+
+
+def test_histogram():
+    """Assert observations are counted in cumulative buckets"""
+
+    histogram = unit.Histogram('latency_seconds', 'Latency', buckets=(0.1, 1))
+    child = histogram.labels()
+    for value in (0.05, 0.1, 0.5, 2):
+        child.observe(value)
+
+    lines = histogram.render().splitlines()
+    assert lines[2:] == ['latency_seconds_bucket{le="0.1"} 2',
+                         'latency_seconds_bucket{le="1"} 3',
+                         'latency_seconds_bucket{le="+Inf"} 4',
+                         'latency_seconds_sum 2.65',
+                         'latency_seconds_count 4']
+
+
+def test_textfile(tmpdir):
+    """Assert the registry is written to a textfile"""
+
+    registry = unit.Registry()
+    registry.register(unit.Counter('checks_total', 'Checks')).labels().inc()
+    path = tmpdir.join('metrics.prom')
+
+    registry.write_textfile(path.strpath)
+
+    assert path.read() == registry.render()
+    assert len(tmpdir.listdir()) == 1
+
+
+def test_serve():
+    """Assert the registry is served on /metrics"""
+
+    registry = unit.Registry()
+    registry.register(unit.Counter('checks_total', 'Checks')).labels().inc()
+    server = registry.serve('127.0.0.1', 0)
+    url = 'http://127.0.0.1:%d' % server.server_address[1]
+    try:
+        with urllib.request.urlopen(url + '/metrics') as response:
+            assert response.read().decode('utf-8') == registry.render()
+        with pytest.raises(urllib.error.HTTPError):
+            urllib.request.urlopen(url + '/foo')
+    finally:
+        server.shutdown()
+        server.server_close()
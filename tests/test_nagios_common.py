@@ -62,3 +62,107 @@ def test_plugin_exit_code():
         unit.plugin_exit(exit_code)
 
     assert exit_info.value.code == expected_exit_value
+
+
+def test_plugin_exit_captured(capfd):
+    """Assert nothing is printed within captured_output and the output is carried by the
+    raised PluginExit"""
+
+    with pytest.raises(unit.PluginExit) as exit_info:
+        with unit.captured_output():
+            unit.plugin_exit(unit.Codes.WARNING, message='message')
+
+    assert not capfd.readouterr()[0]
+    assert exit_info.value.status == unit.Codes.WARNING
+    assert exit_info.value.code == unit.Codes.WARNING.value
+    assert exit_info.value.output == 'WARNING: message'
+
+
+@pytest.mark.parametrize(
+    'codes,expected',
+    [
+        ([], unit.Codes.OK),
+        ([unit.Codes.OK, unit.Codes.UNKNOWN], unit.Codes.UNKNOWN),
+        ([unit.Codes.WARNING, unit.Codes.UNKNOWN], unit.Codes.WARNING),
+        ([unit.Codes.OK, unit.Codes.CRITICAL, unit.Codes.WARNING], unit.Codes.CRITICAL),
+    ]
+)
+def test_worst_status(codes, expected):
+    """Assert statuses are aggregated by severity"""
+
+    assert unit.worst_status(codes) == expected
+
+
+@pytest.mark.parametrize(
+    'perfdata,expected',
+    [
+        (unit.PerfData('time', 0.0123, 's'), 'time=0.0123s'),
+        (unit.PerfData('players', 3, warn=50, crit=60, minimum=0, maximum=64),
+         'players=3;50;60;0;64'),
+        (unit.PerfData('total time', 1.5, 's', minimum=0), "'total time'=1.5s;;;0"),
+        (unit.PerfData("it's", 2.0), "'it''s'=2"),
+        (unit.PerfData('tiny', 1e-9, 's'), 'tiny=0s'),
+    ]
+)
+def test_perfdata_format(perfdata, expected):
+    """Assert perfdata is formatted according to Nagios plugins guidelines"""
+
+    assert str(perfdata) == expected
+
+
+def test_plugin_exit_perfdata(capfd):
+    """Assert perfdata is appended to the first output line, before the long output"""
+
+    with pytest.raises(SystemExit):
+        unit.plugin_exit(unit.Codes.OK, 'summary\nline 1\nline 2',
+                         [unit.PerfData('a', 1), unit.PerfData('b', 2)])
+    stdout = capfd.readouterr()[0]
+
+    assert stdout == 'OK: summary | a=1 b=2\nline 1\nline 2\n'
+
+
+@pytest.mark.parametrize(
+    'code,latency,expected',
+    [
+        (unit.Codes.OK, 0.5, unit.Codes.OK),
+        (unit.Codes.OK, 1.5, unit.Codes.WARNING),
+        (unit.Codes.OK, 2.5, unit.Codes.CRITICAL),
+        (unit.Codes.UNKNOWN, 2.5, unit.Codes.UNKNOWN),
+    ]
+)
+def test_thresholds(code, latency, expected):
+    """Assert only an OK status is turned into WARNING or CRITICAL by latency thresholds"""
+
+    assert unit.Thresholds(1, 2).check(code, 'message', latency)[0] == expected
+
+
+def test_thresholds_disabled():
+    """Assert no status change happens without thresholds"""
+
+    assert unit.Thresholds().check(unit.Codes.OK, 'message', 1000) == (unit.Codes.OK, 'message')
+    assert str(unit.Thresholds(1, 2).perfdata('rtt', 0.5)) == 'rtt=0.5s;1;2;0'
+
+
+def test_parse_output():
+    """Assert status text, long output and perfdata of both places are parsed"""
+
+    output = unit.parse_output("DISK OK - free space: 42% | /=2643MB;5948;5958;0;5968 "
+                               "'/boot mount'=68MB;;;0 u=U\n"
+                               "/ 15272 MB (77% inode=99%);\n"
+                               "/boot 68 MB (69% inode=99%); | /home=69357MB;253404;253409;0;"
+                               "253414\n"
+                               "/var/log=818MB;970;975;0;980 range=5;10:20;@30\n")
+
+    assert output.text == 'DISK OK - free space: 42%'
+    assert output.long_output == '/ 15272 MB (77% inode=99%);\n/boot 68 MB (69% inode=99%);'
+    assert [point.label for point in output.perfdata] == [
+        '/', '/boot mount', '/home', '/var/log', 'range']
+    assert output.perfdata[0] == unit.PerfData('/', 2643, 'MB', 5948, 5958, 0, 5968)
+    assert str(output.perfdata[-1]) == 'range=5;10:20;@30'
+
+
+@pytest.mark.parametrize('output', [None, '', 'OK', 'OK |', 'OK | broken'])
+def test_parse_output_without_perfdata(output):
+    """Assert outputs without perfdata are parsed"""
+
+    assert unit.parse_output(output).perfdata == []
@@ -0,0 +1,118 @@
+"""Test suite for monitoring_scripts.net"""
+
+import socket
+
+import pytest
+
+from monitoring_scripts import net as unit
+
+
+@pytest.mark.parametrize(
+    'target,expected',
+    [
+        ('ts.some.server', ('ts.some.server', 9987)),
+        ('ts.some.server:9988', ('ts.some.server', 9988)),
+        ('127.0.0.1:1', ('127.0.0.1', 1)),
+        ('[::1]:9988', ('::1', 9988)),
+        ('[::1]', ('::1', 9987)),
+    ]
+)
+def test_parse_target(target, expected):
+    """Assert host and port are extracted from a target specification"""
+
+    assert unit.parse_target(target, 9987) == expected
+
+
+@pytest.mark.parametrize('target', ['host:port', 'host:0', ':9987', 'host:70000'])
+def test_parse_target_invalid(target):
+    """Assert ValueError is raised for invalid target specifications"""
+
+    with pytest.raises(ValueError):
+        unit.parse_target(target, 9987)
+
+
+def test_parse_target_mandatory_port():
+    """Assert ValueError is raised if no port is given nor defaulted"""
+
+    with pytest.raises(ValueError):
+        unit.parse_target('arma.server.host', None)
+
+
+ADDRESS = ('10.0.0.1', 9987)
+
+
+@pytest.fixture
+def getaddrinfo(mocker):
+    """Patch the system resolver to return ADDRESS"""
+
+    return mocker.patch('socket.getaddrinfo', return_value=[
+        (socket.AF_INET, socket.SOCK_DGRAM, 0, '', ADDRESS)])
+
+
+@pytest.fixture
+def resolver_cache():
+    """Configure the shared resolver cache for one test"""
+
+    yield unit.configure_resolver(ttl=60, serve_stale=30)
+    unit.configure_resolver(ttl=0)
+
+
+def test_resolve_cached(getaddrinfo, resolver_cache):
+    """Assert resolutions are served from the shared cache"""
+
+    assert unit.resolve('ts.some.server', 9987)[0] == ADDRESS
+    assert unit.resolve('ts.some.server', 9987)[0] == ADDRESS
+    assert getaddrinfo.call_count == 1
+    assert len(resolver_cache.entries) == 1
+
+
+def test_resolve_expired(getaddrinfo):
+    """Assert addresses are resolved again once expired"""
+
+    cache = unit.ResolverCache(ttl=60)
+    for now in (0, 59, 61):
+        cache.resolve('ts.some.server', 9987, socket.AF_INET, socket.SOCK_DGRAM, now=now)
+
+    assert getaddrinfo.call_count == 2
+
+
+@pytest.mark.parametrize('age,served', [(70, True), (100, False)])
+def test_resolve_stale(getaddrinfo, age, served):
+    """Assert an expired address is served only within the stale window if resolution fails"""
+
+    cache = unit.ResolverCache(ttl=60, serve_stale=30)
+    cache.resolve('ts.some.server', 9987, socket.AF_INET, socket.SOCK_DGRAM, now=0)
+    getaddrinfo.side_effect = socket.gaierror
+
+    if served:
+        assert cache.resolve('ts.some.server', 9987, socket.AF_INET, socket.SOCK_DGRAM,
+                             now=age) == ADDRESS
+    else:
+        with pytest.raises(socket.gaierror):
+            cache.resolve('ts.some.server', 9987, socket.AF_INET, socket.SOCK_DGRAM, now=age)
+
+
+def test_resolve_persisted(getaddrinfo, tmpdir):
+    """Assert resolved addresses are shared across processes through the cache file"""
+
+    path = tmpdir.join('dns.json').strpath
+    unit.ResolverCache(path=path).resolve('ts.some.server', 9987, socket.AF_INET,
+                                          socket.SOCK_DGRAM)
+    cache = unit.ResolverCache(path=path)
+
+    assert cache.load()
+    assert cache.resolve('ts.some.server', 9987, socket.AF_INET, socket.SOCK_DGRAM) == ADDRESS
+    assert getaddrinfo.call_count == 1
+
+
+def test_configure_resolver(getaddrinfo):
+    """Assert the shared cache is kept across identical configurations and can be disabled"""
+
+    cache = unit.configure_resolver(ttl=60)
+
+    assert unit.configure_resolver(ttl=60) is cache
+    assert unit.configure_resolver(ttl=120) is not cache
+    assert unit.configure_resolver(ttl=0) is None
+    unit.resolve('ts.some.server', 9987)
+    unit.resolve('ts.some.server', 9987)
+    assert getaddrinfo.call_count == 2
@@ -0,0 +1,34 @@
+"""Test suite for monitoring_scripts.persist"""
+
+import pytest
+
+from monitoring_scripts import persist as unit
+
+
+def test_save_and_load(tmpdir):
+    """Assert saved content is loaded back and missing or invalid files load as None"""
+
+    path = tmpdir.join('state.json')
+    unit.save_json(path.strpath, {'components': {'1': 4}})
+
+    assert unit.load_json(path.strpath) == {'components': {'1': 4}}
+    assert unit.load_json(tmpdir.join('missing.json').strpath, 'state') is None
+    path.write('{"components": ')
+    assert unit.load_json(path.strpath, 'state') is None
+
+
+def test_failed_write(tmpdir):
+    """Assert a failed write keeps the previous file and leaves no temporary file behind"""
+
+    path = tmpdir.join('state.json')
+    path.write('previous')
+
+    def write(state_file):
+        state_file.write('partial')
+        raise OSError('disk full')
+
+    with pytest.raises(OSError):
+        unit.write_atomic(path.strpath, write)
+
+    assert path.read() == 'previous'
+    assert tmpdir.listdir() == [path]
@@ -0,0 +1,108 @@
+"""Test suite for monitoring_scripts.plugin_pool"""
+
+import concurrent.futures
+import sys
+import threading
+import time
+
+from monitoring_scripts import plugin_pool as unit
+from monitoring_scripts.nagios_common import Codes
+
+
+def python(code):
+    """Build the invocation of a plugin running the given Python code"""
+
+    return [sys.executable, '-c', code]
+
+
+def is_running(pid):
+    """Tell if a process exists and is not a zombie"""
+
+    try:
+        with open('/proc/%d/stat' % pid) as stat:
+            return stat.read().rsplit(')', 1)[1].split()[0] != 'Z'
+    except OSError:
+        return False
+
+
+def test_exit_code_and_output():
+    """Assert the exit code and the standard output of a plugin are returned"""
+
+    result = unit.PluginPool().run(python('print("WARNING: disk at 85%"); exit(1)'))
+
+    assert result == unit.PluginResult(Codes.WARNING.value, 'WARNING: disk at 85%')
+
+
+def test_output_limit():
+    """Assert the output is capped without blocking a plugin writing more than a pipe holds"""
+
+    result = unit.PluginPool(output_limit=10).run(
+        python('import sys; sys.stdout.write("x" * 1000000)'), timeout=10)
+
+    assert result == unit.PluginResult(0, 'x' * 10)
+
+
+def test_kill_escalation(tmpdir):
+    """Assert a plugin ignoring SIGTERM is killed along with its children once timed out"""
+
+    pid_file = tmpdir.join('child.pid')
+    pool = unit.PluginPool(kill_grace=0.2)
+    start = time.monotonic()
+
+    result = pool.run(python(
+        'import signal, subprocess, sys, time\n'
+        'signal.signal(signal.SIGTERM, signal.SIG_IGN)\n'
+        'child = subprocess.Popen([sys.executable, "-c", "import time; time.sleep(30)"])\n'
+        'open(%r, "w").write(str(child.pid))\n'
+        'time.sleep(30)\n' % pid_file.strpath
+    ), timeout=1)
+
+    assert result == unit.PluginResult(Codes.CRITICAL.value, 'CRITICAL: plugin timed out')
+    assert time.monotonic() - start < 5
+    # The orphaned child is not ours to wait for, give the kill some time to land
+    pid = int(pid_file.read())
+    for _ in range(100):
+        if not is_running(pid):
+            break
+        time.sleep(0.01)
+    assert not is_running(pid)
+
+
+def test_cancel():
+    """Assert a running plugin is killed once cancelled and a waiting one is not started"""
+
+    pool = unit.PluginPool(concurrency=1, kill_grace=0.2)
+    cancel = threading.Event()
+    threading.Timer(0.2, cancel.set).start()
+    start = time.monotonic()
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+        results = list(executor.map(
+            lambda _: pool.run(python('import time; time.sleep(30)'), cancel=cancel), range(2)))
+
+    assert results == [unit.PluginResult(Codes.UNKNOWN.value, 'UNKNOWN: plugin cancelled')] * 2
+    assert time.monotonic() - start < 5
+
+
+def test_concurrency():
+    """Assert at most `concurrency` plugins run at the same time"""
+
+    pool = unit.PluginPool(concurrency=2)
+    start = time.monotonic()
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=4) as executor:
+        results = list(executor.map(lambda _: pool.run(python('import time; time.sleep(0.3)')),
+                                    range(4)))
+
+    assert [result.returncode for result in results] == [0] * 4
+    assert time.monotonic() - start >= 0.6
+
+
+def test_configure():
+    """Assert the pool is kept while its settings do not change"""
+
+    pool = unit.configure(concurrency=3)
+
+    assert unit.pool() is pool
+    assert unit.configure(concurrency=3) is pool
+    assert unit.configure(concurrency=4) is not pool
@@ -0,0 +1,132 @@
+"""Test suite for monitoring_scripts.retry"""
+
+import pytest
+
+from monitoring_scripts import retry as unit
+from monitoring_scripts.nagios_common import Codes
+
+
+@pytest.mark.parametrize(
+    'kwargs',
+    [
+        {'retries': -1},
+        {'backoff': 0.5},
+        {'jitter': 1.5},
+        {'deadline': 0},
+    ]
+)
+def test_invalid_policy(kwargs):
+    """Assert invalid policies are rejected"""
+
+    with pytest.raises(ValueError):
+        unit.RetryPolicy(**kwargs)
+
+
+def test_backoff():
+    """Assert waits grow exponentially up to the maximum interval"""
+
+    policy = unit.RetryPolicy(retries=5, interval=1, backoff=2, max_interval=5)
+
+    assert [policy.delay(retry) for retry in range(1, 6)] == [1, 2, 4, 5, 5]
+
+
+def test_attempts_without_deadline(mocker):
+    """Assert every attempt is generated without time budget, waiting in between"""
+
+    time_sleep = mocker.patch('time.sleep')
+    policy = unit.RetryPolicy(retries=3, interval=1, backoff=2)
+
+    assert list(policy.attempts()) == [(0, None), (1, None), (2, None), (3, None)]
+    assert time_sleep.call_args_list == [mocker.call(1), mocker.call(2), mocker.call(4)]
+
+
+def test_jitter(mocker):
+    """Assert jitter shortens waits by at most the given fraction"""
+
+    time_sleep = mocker.patch('time.sleep')
+    mocker.patch('random.random', return_value=0.5)
+
+    list(unit.RetryPolicy(retries=1, interval=2, jitter=0.5).attempts())
+
+    time_sleep.assert_called_once_with(1.5)
+
+
+def test_deadline_budget(mocker):
+    """Assert the deadline is split between the attempts after setting aside the waits"""
+
+    clock = {'now': 0}
+    mocker.patch('time.monotonic', side_effect=lambda: clock['now'])
+    mocker.patch('time.sleep', side_effect=lambda delay: clock.update(now=clock['now'] + delay))
+    policy = unit.RetryPolicy(retries=2, interval=1, deadline=11)
+
+    budgets = []
+    for attempt, budget in policy.attempts():
+        budgets.append(budget)
+        if attempt == 0:
+            # first attempt returns immediately, its unused budget goes to the next ones
+            continue
+        clock['now'] += budget
+
+    assert budgets == [pytest.approx(3), pytest.approx(4.5), pytest.approx(4.5)]
+    assert clock['now'] <= 11
+
+
+def test_deadline_exhausted(mocker):
+    """Assert attempts stop when the deadline leaves no usable budget"""
+
+    clock = {'now': 0}
+    mocker.patch('time.monotonic', side_effect=lambda: clock['now'])
+    mocker.patch('time.sleep', side_effect=lambda delay: clock.update(now=clock['now'] + delay))
+    policy = unit.RetryPolicy(retries=5, interval=0, deadline=1)
+
+    attempts = 0
+    for _, budget in policy.attempts():
+        attempts += 1
+        clock['now'] += 0.6
+
+    assert attempts == 2
+    assert budget == pytest.approx(unit.MIN_ATTEMPT_TIMEOUT)  # pylint: disable=W0631
+
+
+@pytest.mark.parametrize(
+    'kwargs',
+    [
+        {'attempts': 0},
+        {'decision': 'unanimity'},
+        {'stagger': -1},
+        {'timeout': 0},
+    ]
+)
+def test_invalid_quorum(kwargs):
+    """Assert invalid quorum policies are rejected"""
+
+    with pytest.raises(ValueError):
+        unit.QuorumPolicy(**kwargs)
+
+
+@pytest.mark.parametrize(
+    'decision,statuses,final,expected',
+    [
+        ('majority', [Codes.CRITICAL], False, None),
+        ('majority', [Codes.CRITICAL, Codes.CRITICAL], False, Codes.CRITICAL),
+        ('majority', [Codes.OK, Codes.CRITICAL], False, None),
+        ('majority', [Codes.OK, Codes.CRITICAL, Codes.WARNING], True, Codes.OK),
+        ('majority', [Codes.WARNING, Codes.CRITICAL, Codes.CRITICAL], True, Codes.CRITICAL),
+        ('first-ok', [Codes.CRITICAL, Codes.OK], False, Codes.OK),
+        ('first-ok', [Codes.CRITICAL, Codes.CRITICAL], False, None),
+        ('first-ok', [Codes.CRITICAL, Codes.CRITICAL, Codes.WARNING], True, Codes.CRITICAL),
+    ]
+)
+def test_quorum_decision(decision, statuses, final, expected):
+    """Assert the status is decided by majority or by the first OK"""
+
+    assert unit.QuorumPolicy(3, decision).decide(statuses, final) == expected
+
+
+def test_single_attempt():
+    """Assert a single attempt keeps the time budget of the original policy"""
+
+    assert unit.single_attempt(unit.RetryPolicy(retries=5, deadline=10)) == \
+        unit.RetryPolicy(retries=0, deadline=10)
+    assert unit.single_attempt(unit.QuorumPolicy(3, timeout=4)) == \
+        unit.RetryPolicy(retries=0, deadline=4)
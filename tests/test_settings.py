@@ -3,6 +3,8 @@
 import pytest
 
 from monitoring_scripts import settings
+from monitoring_scripts.nagios_common import Codes
+from monitoring_scripts.retry import QuorumPolicy, RetryPolicy
 
 
 def test_unloaded_configurator():
@@ -34,3 +36,111 @@ def test_configurator_fetching(config):  # pylint: disable=W0621
     config_parser = settings.RunnerConfigParser()
     config_parser.read(config)
     assert config_parser.get('TestSection', 'key') == "value"
+
+
+@pytest.fixture(scope="module")
+def checks_config(tmpdir_factory):  # pylint: disable=W0621
+    """Fixture that generates a configuration file declaring checks."""
+    tmpfile = tmpdir_factory.mktemp('data').join('config.ini')
+    tmpfile.write(
+        "[Cachet]\n"
+        "base-url: http://some.url\n"
+        "[Check:website]\n"
+        "script: cnto-http-monitor\n"
+        "args: http://foo.bar --timeout 10\n"
+        "component-id: 3\n"
+        "interval: 30\n"
+        "backoff: 2\n"
+        "deadline: 20\n"
+        "[Check:teamspeak]\n"
+        "script: cnto-ts3-monitor\n"
+        "component-id: 4\n"
+        "metrics: rtt=12, packet loss=13\n"
+    )
+    return tmpfile.strpath
+
+
+def test_checks_parsing(checks_config):  # pylint: disable=W0621
+    """Assert RunnerConfigParser reads checks declarations with their defaults."""
+    config_parser = settings.RunnerConfigParser()
+    config_parser.read(checks_config)
+    checks = {check.name: check for check in config_parser.checks()}
+
+    assert checks['website'] == settings.Check('website', 'cnto-http-monitor',
+                                               ['http://foo.bar', '--timeout', '10'], 3, 30.0,
+                                               RetryPolicy(5, 0.5, 2.0, None, 0.0, 20.0), False)
+    assert checks['teamspeak'].args == []
+    assert checks['teamspeak'].interval == 60.0
+    assert checks['teamspeak'].retry_policy == RetryPolicy()
+    assert checks['website'].metrics == {}
+    assert checks['teamspeak'].metrics == {'rtt': 12, 'packet loss': 13}
+
+
+@pytest.mark.parametrize(
+    'section',
+    [
+        "[Check:broken]\nscript: foo\n",
+        "[Check:broken]\nscript: foo\ncomponent-id: bar\n",
+        "[Check:broken]\nscript: foo\ncomponent-id: 1\ninterval: 0\n",
+        "[Check:broken]\nscript: foo\ncomponent-id: 1\njitter: 2\n",
+        "[Check:broken]\nscript: foo\ncomponent-id: 1\nmetrics: rtt\n",
+    ]
+)
+def test_checks_invalid(tmpdir, section):
+    """Assert ValueError is raised for malformed checks declarations."""
+    tmpfile = tmpdir.join('config.ini')
+    tmpfile.write(section)
+    config_parser = settings.RunnerConfigParser()
+    config_parser.read(tmpfile.strpath)
+    with pytest.raises(ValueError):
+        config_parser.checks()
+
+
+def test_status_mapping(tmpdir):
+    """Assert the status mapping section overrides the given defaults."""
+    tmpfile = tmpdir.join('config.ini')
+    tmpfile.write("[StatusMapping]\nWARNING: 2\ncritical: 3\nOK:\n")
+    config_parser = settings.RunnerConfigParser()
+    config_parser.read(tmpfile.strpath)
+    defaults = {Codes.OK: 1, Codes.WARNING: 3, Codes.CRITICAL: 4, Codes.UNKNOWN: None}
+
+    assert config_parser.status_mapping(defaults) == {
+        Codes.OK: None, Codes.WARNING: 2, Codes.CRITICAL: 3, Codes.UNKNOWN: None
+    }
+
+
+@pytest.mark.parametrize('option', ["BROKEN: 1\n", "WARNING: 5\n", "WARNING: two\n"])
+def test_status_mapping_invalid(tmpdir, option):
+    """Assert ValueError is raised for unknown codes or statuses."""
+    tmpfile = tmpdir.join('config.ini')
+    tmpfile.write("[StatusMapping]\n" + option)
+    config_parser = settings.RunnerConfigParser()
+    config_parser.read(tmpfile.strpath)
+    with pytest.raises(ValueError):
+        config_parser.status_mapping({})
+
+
+def test_checks_quorum(tmpdir):
+    """Assert a check declaring a quorum gets a quorum policy."""
+    tmpfile = tmpdir.join('config.ini')
+    tmpfile.write("[Check:quorum]\nscript: foo\ncomponent-id: 1\nquorum: 5\ndeadline: 3\n"
+                  "quorum-decision: first-ok\n")
+    config_parser = settings.RunnerConfigParser()
+    config_parser.read(tmpfile.strpath)
+
+    assert config_parser.checks()[0].retry_policy == QuorumPolicy(5, 'first-ok', 0.005, 3.0)
+
+
+def test_diff_checks():
+    """Assert checks are compared by name and declaration"""
+
+    def check(name, interval=60.0, retry_policy=RetryPolicy()):
+        return settings.Check(name=name, script='cnto-ts3-monitor', args=[], component_id=1,
+                              interval=interval, retry_policy=retry_policy, pass_timeout=False)
+
+    old = [check('kept'), check('removed'), check('slower'), check('quorum')]
+    new = [check('kept'), check('added'), check('slower', interval=120.0),
+           check('quorum', retry_policy=QuorumPolicy())]
+
+    assert settings.diff_checks(old, new) == settings.ChecksDiff(
+        added=['added'], removed=['removed'], modified=['quorum', 'slower'])
@@ -0,0 +1,81 @@
+"""Test suite for monitoring_scripts.status_cache"""
+
+import json
+
+import pytest
+
+from monitoring_scripts import status_cache as unit
+
+
+@pytest.fixture
+def cache_path(tmpdir):
+    """Path to a not yet existing cache file"""
+
+    return tmpdir.join('cache.json').strpath
+
+
+def test_load_missing(cache_path):  # pylint: disable=W0621
+    """Assert loading a missing cache file is reported"""
+
+    assert not unit.StatusCache(cache_path).load()
+
+
+def test_needs_update(cache_path):  # pylint: disable=W0621
+    """Assert updates are needed only on status change or after the TTL"""
+
+    status_cache = unit.StatusCache(cache_path, ttl=60)
+    assert status_cache.needs_update(1, 1, now=0)
+
+    status_cache.record(1, 1, now=0)
+
+    assert not status_cache.needs_update(1, 1, now=30)
+    assert status_cache.needs_update(1, 4, now=30)
+    assert status_cache.needs_update(1, 1, now=61)
+    assert status_cache.writes_sent == 1
+    assert status_cache.writes_avoided == 1
+
+
+def test_seed(mocker, cache_path):  # pylint: disable=W0621
+    """Assert the cache is seeded with a single bulk read of the components"""
+
+    components = mocker.Mock()
+    components.get.return_value = json.dumps({'data': [{'id': 1, 'status': 1},
+                                                       {'id': 2, 'status': '4'}]})
+    status_cache = unit.StatusCache(cache_path)
+
+    status_cache.seed(components)
+
+    components.get.assert_called_once_with()
+    assert not status_cache.needs_update(1, 1)
+    assert not status_cache.needs_update(2, 4)
+
+
+def test_save_and_load(cache_path):  # pylint: disable=W0621
+    """Assert entries and counters survive across processes"""
+
+    status_cache = unit.StatusCache(cache_path)
+    status_cache.record(1, 2)
+    status_cache.needs_update(1, 2)
+    status_cache.save()
+
+    reloaded = unit.StatusCache(cache_path)
+
+    assert reloaded.load()
+    assert not reloaded.needs_update(1, 2)
+    assert reloaded.writes_sent == 1
+    assert reloaded.writes_avoided == 2
+
+
+def test_save_merges(cache_path):  # pylint: disable=W0621
+    """Assert concurrent writers do not drop each other's entries"""
+
+    first, second = unit.StatusCache(cache_path), unit.StatusCache(cache_path)
+    first.record(1, 1)
+    second.record(2, 4)
+    first.save()
+    second.save()
+
+    reloaded = unit.StatusCache(cache_path)
+    reloaded.load()
+
+    assert set(reloaded.entries) == {'1', '2'}
@@ -1,6 +1,8 @@
 """Test suite for monitoring_scripts.ts3_monitor"""
 
 import socket
+import threading
+
 import pytest
 
 from monitoring_scripts import ts3_monitor as unit
@@ -8,6 +10,14 @@ from monitoring_scripts.nagios_common import Codes
 from . import common
 
 
+@pytest.fixture(autouse=True)
+def resolver(mocker):
+    """Resolve every host to the loopback address without querying DNS"""
+
+    return mocker.patch('socket.getaddrinfo', side_effect=lambda host, port, *_: [
+        (socket.AF_INET, socket.SOCK_DGRAM, 0, '', ('127.0.0.1', port))])
+
+
 # pylint: disable-msg=too-many-arguments
 def run_and_assert(capfd, expected_code=Codes.OK, expected_message_part=None,
                    host='ts.some.server', port=9987, timeout=10, debug=False):
@@ -53,3 +63,166 @@ def test_with_response(capfd, mocker, response_string, expected_code,
 
     run_and_assert(capfd=capfd, expected_message_part=message_part,
                    expected_code=expected_code)
+    mock_socket.return_value.close.assert_called_once_with()
+
+
+@pytest.fixture
+def udp_responders():
+    """Local UDP servers answering the handshake with a valid, an invalid or no response"""
+
+    sockets = []
+    for reply in (unit.VALID_CONNECTION_MARKER + b'\x00' * 16, b'nope', None):
+        responder = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        responder.bind(('127.0.0.1', 0))
+        sockets.append((responder, reply))
+
+    def respond():
+        for responder, reply in sockets:
+            _, address = responder.recvfrom(1024)
+            if reply:
+                responder.sendto(reply, address)
+
+    thread = threading.Thread(target=respond, daemon=True)
+    thread.start()
+    yield [('127.0.0.1', responder.getsockname()[1]) for responder, _ in sockets]
+    thread.join(1)
+    for responder, _ in sockets:
+        responder.close()
+
+
+def test_probe_servers(mocker, udp_responders):  # pylint: disable=W0621
+    """Assert every server gets its own result when probed from a single socket"""
+
+    getaddrinfo = socket.getaddrinfo
+
+    def resolve(host, *args):
+        if host == 'bad.host':
+            raise socket.gaierror
+        return getaddrinfo(host, *args)
+
+    mocker.patch('socket.getaddrinfo', side_effect=resolve)
+    targets = udp_responders + [('bad.host', 9987)]
+
+    results = unit.probe_servers(targets, timeout=0.5)
+
+    assert [result[:2] for result in results] == [
+        (targets[0], Codes.OK),
+        (targets[1], Codes.CRITICAL),
+        (targets[2], Codes.CRITICAL),
+        (targets[3], Codes.UNKNOWN),
+    ]
+    assert 'invalid' in results[1][2]
+    assert 'timed out' in results[2][2]
+
+
+def test_fleet_main(mocker, capfd):
+    """Assert the multi-server mode reports each server and returns the worst status"""
+
+    mocker.patch.object(unit, 'probe_servers', return_value=[
+        (('ts.one', 9987), Codes.OK, 'connection successful',
+         [unit.nagios.PerfData('rtt', 0.01, 's')]),
+        (('ts.two', 9988), Codes.CRITICAL, 'response timed out', []),
+    ])
+
+    common.run_and_assert(unit.fleet_main, expected_code=Codes.CRITICAL, capfd=None,
+                          targets=[('ts.one', 9987), ('ts.two', 9988)])
+
+    out = capfd.readouterr()[0]
+    assert out.startswith("CRITICAL: 1 of 2 servers not OK | 'ts.one:9987 rtt'=0.01s")
+    assert 'CRITICAL: ts.two:9988 response timed out' in out
+
+
+def test_perfdata(mocker, capfd):
+    """Assert round trip timings are reported as perfdata"""
+
+    mock_socket = mocker.Mock()
+    mock_socket.return_value.recv.return_value = unit.VALID_CONNECTION_MARKER
+    mocker.patch('socket.socket', side_effect=mock_socket)
+
+    run_and_assert(capfd=None, expected_code=Codes.OK)
+
+    out = capfd.readouterr()[0]
+    assert out.startswith('OK: connection successful | dns=')
+    assert ' rtt=' in out and ' total=' in out
+
+
+def test_latency_thresholds(mocker, capfd):
+    """Assert a slow response triggers a WARNING status"""
+
+    mock_socket = mocker.Mock()
+    mock_socket.return_value.recv.return_value = unit.VALID_CONNECTION_MARKER
+    mocker.patch('socket.socket', side_effect=mock_socket)
+
+    common.run_and_assert(unit.main, expected_code=Codes.WARNING, capfd=capfd,
+                          expected_message='warning threshold', host='ts.some.server',
+                          warning_latency=0)
+
+
+@pytest.fixture
+def burst_responder():
+    """Local UDP server echoing the handshake random bytes, dropping every third handshake"""
+
+    responder = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    responder.bind(('127.0.0.1', 0))
+    responder.settimeout(2)
+
+    def respond():
+        received = 0
+        while True:
+            try:
+                datagram, address = responder.recvfrom(1024)
+            except OSError:
+                return
+            received += 1
+            if received % 3:
+                responder.sendto(unit.VALID_CONNECTION_MARKER + bytes(25) +
+                                 datagram[unit.HANDSHAKE_RANDOM][::-1], address)
+
+    thread = threading.Thread(target=respond, daemon=True)
+    thread.start()
+    yield responder.getsockname()
+    responder.close()
+    thread.join(3)
+
+
+def test_burst_probe(burst_responder):  # pylint: disable=W0621
+    """Assert replies are matched to their handshake and lost handshakes are reported"""
+
+    rtts, invalid = unit.burst_probe(burst_responder, 6, 0.001, timeout=0.5)
+
+    assert invalid == 0
+    assert [rtt is not None for rtt in rtts] == [True, True, False, True, True, False]
+
+
+@pytest.mark.parametrize(
+    'rtts,expected',
+    [
+        ([0.01, None, 0.03, 0.02], (25.0, 0.01, 0.02, 0.03, 0.015)),
+        ([0.01], (0.0, 0.01, 0.01, 0.01, 0.0)),
+        ([None, None], (100.0, None, None, None, None)),
+    ]
+)
+def test_burst_statistics(rtts, expected):
+    """Assert loss, round trip times and jitter are computed from the answered handshakes"""
+
+    assert unit.burst_statistics(rtts) == pytest.approx(expected)
+
+
+@pytest.mark.parametrize(
+    'rtts,expected_code,message_part',
+    [
+        ([0.01, 0.01, 0.01, 0.01], Codes.OK, '4 of 4'),
+        ([0.01, None, 0.01, 0.01], Codes.CRITICAL, 'packet loss'),
+        ([0.01, 0.05, 0.01, 0.05], Codes.WARNING, 'jitter'),
+        ([None, None, None, None], Codes.CRITICAL, 'no response'),
+    ]
+)
+def test_burst_main(capfd, mocker, rtts, expected_code, message_part):
+    """Assert loss and jitter thresholds map to WARNING or CRITICAL"""
+
+    mocker.patch.object(unit, 'burst_probe', return_value=(rtts, 0))
+
+    common.run_and_assert(unit.burst_main, expected_code=expected_code, capfd=capfd,
+                          expected_message=message_part, host='ts.some.server', count=4,
+                          loss=unit.nagios.Thresholds(10, 20),
+                          jitter=unit.nagios.Thresholds(0.03, 0.1))